@@ -0,0 +1,63 @@
+"""
+file that contains the benchmark of the vectorized peer-price comparison (see car_scraping.peer_prices) on the
+synthetic cars, in one process or split between the worker processes (--workers). The averages of the sample of the
+cars are checked against the row-by-row comparison
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from car_scraping.peer_prices import peer_mean_prices
+
+
+def make_cars(n_cars: int, n_models=50, seed=0):
+    """
+    Method that returns the DataFrame with the synthetic cars, with some of the compared values missing
+    :param n_cars: Number of the cars
+    :param n_models: Number of the distinct models (per brand)
+    :param seed: Seed of the random generator
+    :return: DataFrame with the brand, model, gearbox, year, mileage and price_pln columns
+    """
+    rng = np.random.default_rng(seed)
+    cars_df = pd.DataFrame({
+        'brand': rng.choice(['BMW', 'Audi', 'Volkswagen', 'Toyota'], n_cars),
+        'model': rng.integers(0, n_models, n_cars).astype(str),
+        'gearbox': rng.choice(['Manualna', 'Automatyczna'], n_cars),
+        'year': rng.integers(1995, 2025, n_cars).astype(float),
+        'mileage': rng.integers(0, 400000, n_cars).astype(float),
+        'price_pln': rng.integers(5000, 300000, n_cars).astype(float),
+    })
+    for column in ['year', 'mileage', 'price_pln']:
+        cars_df.loc[rng.random(n_cars) < 0.01, column] = np.nan
+    return cars_df
+
+
+def naive_peer_mean_prices(cars_df, sample) -> np.ndarray:
+    # Row-by-row comparison of the sampled cars with all the cars
+    return np.array([cars_df[(cars_df['brand'] == car.brand) & (cars_df['model'] == car.model)
+                             & (cars_df['gearbox'] == car.gearbox) & (abs(cars_df['year'] - car.year) <= 2)
+                             & (abs(cars_df['mileage'] - car.mileage) <= 20000)]['price_pln'].mean()
+                     for car in sample.itertuples()])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the vectorized peer-price comparison')
+    parser.add_argument('--cars', type=int, default=50000, help='Number of the synthetic cars')
+    parser.add_argument('--check', type=int, default=200, help='Number of the cars checked row by row')
+    parser.add_argument('--workers', type=int, default=1, help='Number of the worker processes')
+    args = parser.parse_args()
+
+    cars_df = make_cars(args.cars)
+    start = time.perf_counter()
+    average_prices = peer_mean_prices(cars_df, n_workers=args.workers)
+    elapsed = time.perf_counter() - start
+    print(f'{args.cars} cars, {args.workers} workers: {elapsed * 1000:.1f} ms ({args.cars / elapsed:.0f} cars/s)')
+
+    sample = cars_df.sample(min(args.check, len(cars_df)), random_state=0)
+    expected = naive_peer_mean_prices(cars_df, sample)
+    matches = np.allclose(average_prices[cars_df.index.get_indexer(sample.index)], expected, equal_nan=True)
+    print(f'Row-by-row check of {len(sample)} cars: {"OK" if matches else "MISMATCH"}')
+
+
+if __name__ == '__main__':
+    main()
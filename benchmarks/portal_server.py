@@ -0,0 +1,317 @@
+"""
+file that contains the local stand-in of the Otomoto and Olx portals. It serves the listing and offer pages with the
+markup expected by the scraper (synthetic ones, or the ones recorded in the response cache), with the configurable
+latency and error rate, so the crawl can be measured without sending a single request to the live portals
+"""
+import argparse
+import hashlib
+import html
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from car_scraping.response_cache import ResponseCache
+
+# Origins of the live portals, the recorded pages are looked up (and rewritten) with them
+LIVE_ORIGINS = {'otomoto': 'https://www.otomoto.pl', 'olx': 'https://www.olx.pl'}
+
+BRANDS = {
+    'BMW': ['Seria 3', 'Seria 5', 'X3', 'X5'],
+    'Audi': ['A3', 'A4', 'A6', 'Q5'],
+    'Toyota': ['Corolla', 'Yaris', 'Avensis', 'RAV4'],
+    'Volkswagen': ['Golf', 'Passat', 'Polo', 'Tiguan'],
+    'Skoda': ['Octavia', 'Fabia', 'Superb', 'Kodiaq'],
+}
+LOCATIONS = [('Łódź', 'Łódzkie'), ('Warszawa', 'Mazowieckie'), ('Kraków', 'Małopolskie'),
+             ('Poznań', 'Wielkopolskie'), ('Gdańsk', 'Pomorskie'), ('Wrocław', 'Dolnośląskie')]
+FUEL_TYPES = ['Benzyna', 'Diesel', 'Benzyna+LPG', 'Hybryda']
+GEARBOXES = ['Manualna', 'Automatyczna']
+BODY_TYPES = ['Sedan', 'Kombi', 'Hatchback', 'SUV']
+COLOURS = ['Czarny', 'Biały', 'Srebrny', 'Szary', 'Niebieski']
+
+
+class PortalServer:
+    """
+    Threaded HTTP server imitating both portals, Otomoto is served under /otomoto and Olx under /olx
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0., jitter=0., error_rate=0., offers_per_page=32,
+                 cache_dir: str = None, seed=0):
+        """
+        :param host: Host the server listens on
+        :param port: Port the server listens on, 0 picks a free one
+        :param latency: Delay of every response in seconds
+        :param jitter: Maximum random delay in seconds added to the latency
+        :param error_rate: Fraction of the requests answered with 503 Service Unavailable
+        :param offers_per_page: Number of offers on one listing page
+        :param cache_dir: Directory of the response cache with the recorded pages, served instead of the synthetic
+            ones when the page is recorded
+        :param seed: Seed of the latency jitter and the errors
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.offers_per_page = offers_per_page
+        self.cache = ResponseCache(cache_dir, ttl=None) if cache_dir is not None else None
+        self.n_requests = 0
+        self.n_errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+
+    @property
+    def origins(self) -> dict[str, str]:
+        """
+        Origins of the stand-in portals by portal name ('otomoto' and 'olx')
+        """
+        host, port = self._server.server_address[:2]
+        return {name: f'http://{host}:{port}/{name}' for name in LIVE_ORIGINS}
+
+    def start(self) -> 'PortalServer':
+        """
+        Method that starts serving the requests on the background thread
+        :return: The started server
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='portal-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Method that stops the server and closes its socket
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def respond(self, path: str) -> tuple[int, str]:
+        """
+        Method that builds the response to the request of the path
+        :param path: Requested path with the query, e.g. /otomoto/osobowe?page=2
+        :return: Status code and html of the response
+        """
+        with self._lock:
+            self.n_requests += 1
+            delay = self.latency + self._random.uniform(0., self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.n_errors += 1
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            return 503, '<html><body>Service Unavailable</body></html>'
+
+        url = urlsplit(path)
+        portal, _, portal_path = url.path.lstrip('/').partition('/')
+        if portal not in LIVE_ORIGINS:
+            return 404, '<html><body>Not Found</body></html>'
+        portal_path = '/' + portal_path
+
+        recorded = self._get_recorded(portal, portal_path + (f'?{url.query}' if url.query else ''))
+        if recorded is not None:
+            return 200, recorded
+
+        page_number = int(parse_qs(url.query).get('page', ['1'])[0])
+        if portal == 'otomoto' and portal_path == '/osobowe':
+            return 200, self._listing_otomoto(page_number)
+        if portal == 'olx' and portal_path == '/motoryzacja/samochody/':
+            return 200, self._listing_olx(page_number)
+        if portal == 'otomoto' and portal_path.startswith('/osobowe/oferta/'):
+            return 200, _offer_otomoto(_synthetic_car(portal_path))
+        if portal == 'olx' and portal_path.startswith('/d/oferta/'):
+            return 200, _offer_olx(_synthetic_car(portal_path))
+        return 404, '<html><body>Not Found</body></html>'
+
+    def _get_recorded(self, portal: str, portal_path: str) -> str | None:
+        if self.cache is None:
+            return None
+        recorded = self.cache.get(LIVE_ORIGINS[portal] + portal_path)
+        if recorded is None:
+            return None
+        # Links of the recorded page have to lead to the stand-in portal as well
+        for name, origin in LIVE_ORIGINS.items():
+            recorded = recorded.replace(origin, self.origins[name])
+        return recorded
+
+    def _listing_otomoto(self, page_number: int) -> str:
+        articles = ''.join(
+            f'<article class="ooa-yca59n e1oqyyyi0"><a href="{self.origins["otomoto"]}/osobowe/oferta/'
+            f'synthetic-car-ID{page_number}x{i}.html">Offer {i}</a></article>'
+            for i in range(self.offers_per_page)
+        )
+        return f'<html><body><div class="ooa-r53y0q ezh3mkl11">{articles}</div></body></html>'
+
+    def _listing_olx(self, page_number: int) -> str:
+        offers = ''.join(
+            f'<div class="css-1sw7q4x"><a href="/d/oferta/synthetic-car-CID5-ID{page_number}x{i}.html">'
+            f'Offer {i}</a></div>'
+            for i in range(self.offers_per_page)
+        )
+        return f'<html><body><div class="css-oukcj3">{offers}</div></body></html>'
+
+
+def _make_handler(portal_server: PortalServer):
+
+    class PortalHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            status, body = portal_server.respond(self.path)
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PortalHandler
+
+
+def _synthetic_car(portal_path: str) -> dict:
+    # The same offer path always gives the same car
+    generator = random.Random(hashlib.blake2b(portal_path.encode('utf-8'), digest_size=8).digest())
+    brand = generator.choice(list(BRANDS))
+    year = generator.randint(2005, 2024)
+    mileage = generator.randint(0, 15) if generator.random() < 0.05 else generator.randint(5, 350) * 1000
+    city, region = generator.choice(LOCATIONS)
+    return {
+        'brand': brand,
+        'model': generator.choice(BRANDS[brand]),
+        'mileage': mileage,
+        'engine_capacity': generator.choice([999, 1395, 1598, 1968, 1995, 2993]),
+        'engine_power': generator.randint(75, 350),
+        'year': year,
+        'fuel_type': generator.choice(FUEL_TYPES),
+        'gearbox': generator.choice(GEARBOXES),
+        'body_type': generator.choice(BODY_TYPES),
+        'colour': generator.choice(COLOURS),
+        'type_of_color': generator.choice(['Metalik', 'Perłowy', 'Matowy']),
+        'accident_free': generator.choice(['Tak', 'Nie']),
+        'state': 'Nowy' if mileage < 500 else 'Używany',
+        'price_pln': int(round(generator.randint(8, 400) * 1000 * (1 + (year - 2005) / 20), -2)),
+        'city': city,
+        'region': region,
+    }
+
+
+def _format_number(number: int) -> str:
+    # Numbers on the portals are grouped with spaces, e.g. 120 000
+    return f'{number:,}'.replace(',', ' ')
+
+
+def _offer_otomoto(car: dict) -> str:
+    details = [
+        ('Marka pojazdu', car['brand'], True),
+        ('Model pojazdu', car['model'], True),
+        ('Przebieg', f'{_format_number(car["mileage"])} km', False),
+        ('Pojemność skokowa', f'{_format_number(car["engine_capacity"])} cm3', False),
+        ('Moc', f'{car["engine_power"]} KM', False),
+        ('Rok produkcji', str(car['year']), False),
+        ('Rodzaj paliwa', car['fuel_type'], True),
+        ('Skrzynia biegów', car['gearbox'], True),
+        ('Typ nadwozia', car['body_type'], True),
+        ('Kolor', car['colour'], True),
+        ('Rodzaj koloru', car['type_of_color'], False),
+        ('Bezwypadkowy', car['accident_free'], True),
+        ('Stan', car['state'], True),
+    ]
+    address = f'{car["city"]}, {car["region"]}'
+    next_data = {'props': {'pageProps': {'advert': {
+        'details': [{'label': label, 'value': value} for label, value, _ in details],
+        'price': {'value': str(car['price_pln']), 'currency': 'PLN'},
+        'seller': {'location': {'address': address}},
+    }}}}
+    details_html = ''.join(
+        f'<div class="ooa-162vy3d e18eslyg3"><p class="e18eslyg4 ooa-12b2ph5">{html.escape(label)}</p>'
+        + (f'<a class="e16lfxpc1 ooa-1ftbcn2" href="#">{html.escape(value)}</a>' if is_link else
+           f'<p class="e16lfxpc0 ooa-1pe3502 er34gjf0">{html.escape(value)}</p>')
+        + '</div>'
+        for label, value, is_link in details
+    )
+    return (
+        '<html><head>'
+        f'<script id="__NEXT_DATA__" type="application/json">{json.dumps(next_data)}</script>'
+        '</head><body>'
+        f'<h3 class="offer-price__number eqdspoq4 ooa-o7wv9s er34gjf0">{_format_number(car["price_pln"])}</h3>'
+        f'<a class="edhv9y51 ooa-oxkwx3" href="#">{html.escape(address)}</a>'
+        f'{details_html}'
+        '</body></html>'
+    )
+
+
+def _offer_olx(car: dict) -> str:
+    params = [
+        ('Model', car['model']),
+        ('Przebieg', f'{_format_number(car["mileage"])} km'),
+        ('Poj. silnika', f'{_format_number(car["engine_capacity"])} cm³'),
+        ('Moc silnika', f'{car["engine_power"]} KM'),
+        ('Rok produkcji', str(car['year'])),
+        ('Paliwo', car['fuel_type']),
+        ('Skrzynia biegów', car['gearbox']),
+        ('Typ nadwozia', car['body_type']),
+        ('Kolor', car['colour']),
+        ('Stan techniczny', 'Nieuszkodzony' if car['accident_free'] == 'Tak' else 'Uszkodzony'),
+    ]
+    brand_href = '/motoryzacja/samochody/' + car['brand'].lower() + '/'
+    state = {'ad': {'ad': {
+        'params': [{'name': name, 'value': value} for name, value in params],
+        'breadcrumbs': [{'label': 'Samochody osobowe', 'href': '/motoryzacja/samochody/'},
+                        {'label': car['brand'], 'href': brand_href}],
+        'price': {'regularPrice': {'value': car['price_pln'], 'currencyCode': 'PLN'}},
+        'location': {'cityName': car['city'], 'regionName': car['region']},
+    }}}
+    params_html = ''.join(f'<li class="css-1r0si1e"><p class="css-b5m1rv er34gjf0">{html.escape(name)}: '
+                          f'{html.escape(value)}</p></li>' for name, value in params)
+    return (
+        '<html><head>'
+        f'<script>window.__PRERENDERED_STATE__ = {json.dumps(json.dumps(state))};</script>'
+        '</head><body>'
+        '<a class="css-tyi2d1" href="/motoryzacja/samochody/">Samochody osobowe</a>'
+        f'<a class="css-tyi2d1" href="{brand_href}">{html.escape(car["brand"])}</a>'
+        f'<h3 class="css-93ez2t">{_format_number(car["price_pln"])} zł</h3>'
+        f'<ul>{params_html}</ul>'
+        f'<p class="css-1cju8pu er34gjf0">{html.escape(car["city"])},</p>'
+        f'<p class="css-b5m1rv er34gjf0">{html.escape(car["region"])}</p>'
+        '</body></html>'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of the Otomoto and Olx portals')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0., help='Delay of every response in seconds')
+    parser.add_argument('--jitter', type=float, default=0., help='Maximum random delay added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0., help='Fraction of the requests answered with 503')
+    parser.add_argument('--offers-per-page', type=int, default=32)
+    parser.add_argument('--cache-dir', help='Response cache with the recorded pages to serve')
+    args = parser.parse_args()
+
+    server = PortalServer(args.host, args.port, args.latency, args.jitter, args.error_rate,
+                          args.offers_per_page, args.cache_dir)
+    print(f'Serving the stand-in portals at {server.origins["otomoto"]} and {server.origins["olx"]}')
+    with server:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
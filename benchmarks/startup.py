@@ -0,0 +1,95 @@
+"""
+file that contains the startup-time check of the command line interface. The help of every subcommand and the cheap
+real invocations (against the empty database) are run in a fresh interpreter, their wall time is compared with the
+budgets and the heavy libraries are checked not to be imported before the subcommand runs
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Maximum median wall time of 'main.py <command> --help' in seconds (the bare interpreter start is ~20ms)
+STARTUP_BUDGET = 0.25
+# Maximum median wall time of the real invocations, they import the libraries the subcommand needs (pandas and
+# SQLAlchemy alone take ~0.8s) and (except the ones reading only the snapshot) migrate the schema of the database
+RUN_BUDGET = 2.0
+
+COMMANDS = [[], ['scrape'], ['analyze'], ['best-price'], ['backfill'], ['init-db']]
+
+# Invocations doing almost no work on the empty database ({snapshot} is the directory of the empty snapshot)
+RUN_COMMANDS = [['init-db'], ['best-price', 'bmw'], ['best-price', 'bmw', '--snapshot', '{snapshot}']]
+
+# Libraries only the subcommands need, importing them at startup costs hundreds of milliseconds
+HEAVY_MODULES = ['pandas', 'numpy', 'matplotlib', 'sqlalchemy', 'selenium', 'requests', 'bs4', 'pyarrow', 'aiohttp']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_startup(command: list[str], n_runs=5, env: dict = None) -> float:
+    """
+    Method that measures the median wall time of running main.py with the arguments in a fresh interpreter
+    :param command: Arguments of main.py, e.g. ['best-price', '--help']
+    :param n_runs: Number of measured runs
+    :param env: Environment variables of the runs, if None the current environment is used
+    :return: Median wall time in seconds
+    """
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), *command],
+                       cwd=ROOT, env=env, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def get_imported_heavy_modules() -> list[str]:
+    """
+    Method that returns the heavy libraries imported by building the parser of main.py
+    :return: Names of the imported heavy libraries
+    """
+    code = ('import sys, main; main.build_parser(); '
+            f'print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return output.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup-time check of the command line interface')
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET, help='Maximum median help time in seconds')
+    parser.add_argument('--run-budget', type=float, default=RUN_BUDGET,
+                        help='Maximum median time of the real invocations in seconds')
+    parser.add_argument('--runs', type=int, default=5, help='Number of measured runs of every command')
+    args = parser.parse_args()
+
+    over_budget = False
+
+    def report(command: list[str], elapsed: float, budget: float) -> None:
+        nonlocal over_budget
+        over_budget |= elapsed > budget
+        print(f'{" ".join(["main.py", *command]):<45} {elapsed * 1000:7.1f} ms'
+              f'{"  OVER BUDGET" if elapsed > budget else ""}')
+
+    for command in COMMANDS:
+        report([*command, '--help'], measure_startup([*command, '--help'], args.runs), args.budget)
+
+    # Real invocations use the empty database and snapshot of their own, the schema is created before they are timed
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, 'snapshot')
+        os.makedirs(snapshot)
+        env = {**os.environ, 'CAR_SCRAPING_DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'car-scraping.db')}
+        measure_startup(['init-db'], 1, env)
+        for command in RUN_COMMANDS:
+            arguments = [argument.format(snapshot=snapshot) for argument in command]
+            report(command, measure_startup(arguments, args.runs, env), args.run_budget)
+
+    if heavy_modules := get_imported_heavy_modules():
+        print(f'Heavy modules imported at startup: {", ".join(heavy_modules)}')
+    print(f'Budget: {args.budget * 1000:.0f} ms (help), {args.run_budget * 1000:.0f} ms (real invocations)')
+    sys.exit(1 if over_budget or heavy_modules else 0)
+
+
+if __name__ == '__main__':
+    main()
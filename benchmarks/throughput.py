@@ -0,0 +1,180 @@
+"""
+file that contains the end-to-end throughput benchmark of scrape_n_pages. The crawl runs against the local stand-in
+portal (see benchmarks.portal_server), every stage of it is timed and the scraped cars are counted instead of being
+written to the database, so the benchmark measures the scraper alone
+"""
+import argparse
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from benchmarks.portal_server import PortalServer
+import car_scraping.scraper as scraper
+from car_scraping.rate_limiter import rate_limiter, Politeness
+from car_scraping.scraper import Page, CrawlStats
+
+
+@dataclass
+class StageTimings:
+    n_calls: int
+    p50: float  # Median duration of the stage in seconds
+    p99: float  # 99th percentile duration of the stage in seconds
+
+
+@dataclass
+class BenchmarkResult:
+    stats: CrawlStats
+    elapsed: float
+    n_requests: int
+    n_errors: int
+    stages: dict[str, StageTimings] = field(default_factory=dict)
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.stats.n_listing_pages / self.elapsed if self.elapsed else 0.
+
+    @property
+    def cars_per_second(self) -> float:
+        return self.stats.n_cars / self.elapsed if self.elapsed else 0.
+
+
+class _CountingWriter:
+    """
+    Writer that only counts the cars, so the database does not take part in the benchmark
+    """
+
+    def __init__(self, on_add):
+        self.on_add = on_add
+        self.n_cars = 0
+        self._lock = threading.Lock()
+
+    def add(self, car) -> None:
+        start = time.perf_counter()
+        with self._lock:
+            self.n_cars += 1
+        self.on_add(time.perf_counter() - start)
+
+
+class _Timings:
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, duration: float) -> None:
+        with self._lock:
+            self.durations[stage].append(duration)
+
+    def timed(self, stage, function):
+        # Stage can be the name or the method choosing the name by the arguments of the call
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage(*args) if callable(stage) else stage, time.perf_counter() - start)
+        return wrapper
+
+    def summary(self) -> dict[str, StageTimings]:
+        return {stage: StageTimings(len(durations), percentile(durations, 50), percentile(durations, 99))
+                for stage, durations in sorted(self.durations.items())}
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Method that returns the percentile of the values with the nearest-rank method
+    :param values: Values to compute the percentile of
+    :param q: Percentile between 0 and 100
+    :return: Percentile of the values (0 if there are no values)
+    """
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[max(int(-(-q * len(values) // 100)) - 1, 0)]
+
+
+def run_benchmark(from_page=Page.otomoto, n_pages=5, latency=0.05, jitter=0., error_rate=0., offers_per_page=32,
+                  max_rate=200., cache_dir: str = None, **scrape_kwargs) -> BenchmarkResult:
+    """
+    Method that runs scrape_n_pages against the local stand-in portal and measures its throughput
+    :param from_page: Page to scrape from
+    :param n_pages: Number of listing pages to scrape
+    :param latency: Delay of every response of the portal in seconds
+    :param jitter: Maximum random delay in seconds added to the latency
+    :param error_rate: Fraction of the requests the portal answers with 503
+    :param offers_per_page: Number of offers on one listing page
+    :param max_rate: Maximum number of requests per second the rate limiter lets through to the portal
+    :param cache_dir: Directory of the response cache with the recorded pages served by the portal
+    :param scrape_kwargs: Other arguments of scrape_n_pages, e.g. async_fetch or n_drivers
+    :return: Result of the benchmark
+    """
+    timings = _Timings()
+    writer = _CountingWriter(lambda duration: timings.record('write', duration))
+    originals = {name: getattr(scraper, name) for name in
+                 ('get_page', 'fetch_pages', 'get_links_from_html', 'parse_car', 'scrape_car_info')}
+
+    def fetch_stage(page, *args):
+        return 'fetch_listing' if '?page=' in page else 'fetch_detail'
+
+    with PortalServer(latency=latency, jitter=jitter, error_rate=error_rate, offers_per_page=offers_per_page,
+                      cache_dir=cache_dir) as server:
+        scraper.use_portal_origins({Page.otomoto: server.origins['otomoto'], Page.olx: server.origins['olx']})
+        host = server.origins['otomoto'].split('/')[2]
+        rate_limiter.configure(host, Politeness(min_delay=1 / max_rate, max_delay=1., initial_delay=1 / max_rate,
+                                                slow_response=5., burst=max(int(max_rate // 10), 1)))
+        scraper.get_page = timings.timed(fetch_stage, originals['get_page'])
+        scraper.fetch_pages = timings.timed('fetch_listings_async', originals['fetch_pages'])
+        scraper.get_links_from_html = timings.timed('parse_listing', originals['get_links_from_html'])
+        scraper.parse_car = timings.timed('parse_detail', originals['parse_car'])
+        scraper.scrape_car_info = timings.timed('car', originals['scrape_car_info'])
+        try:
+            start = time.perf_counter()
+            stats = scraper.scrape_n_pages(from_page, n_pages, print_steps=False, skip_known=False,
+                                           car_writer=writer, **scrape_kwargs)
+            elapsed = time.perf_counter() - start
+        finally:
+            for name, function in originals.items():
+                setattr(scraper, name, function)
+            scraper.use_portal_origins(None)
+
+    return BenchmarkResult(stats, elapsed, server.n_requests, server.n_errors, timings.summary())
+
+
+def print_result(result: BenchmarkResult) -> None:
+    """
+    Method that prints the result of the benchmark
+    :param result: Result of the benchmark
+    :return: None
+    """
+    print(f'{result.stats.n_listing_pages} listing pages, {result.stats.n_cars} cars '
+          f'({result.stats.n_failed} failed) in {result.elapsed:.2f}s')
+    print(f'  {result.pages_per_second:.2f} pages/s, {result.cars_per_second:.2f} cars/s, '
+          f'{result.n_requests} requests ({result.n_errors} errors)')
+    print(f'  {"stage":<22}{"calls":>8}{"p50 ms":>10}{"p99 ms":>10}')
+    for stage, timing in result.stages.items():
+        print(f'  {stage:<22}{timing.n_calls:>8}{timing.p50 * 1000:>10.2f}{timing.p99 * 1000:>10.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmark of scrape_n_pages on the local stand-in portal')
+    parser.add_argument('--portal', choices=['otomoto', 'olx'], default='otomoto')
+    parser.add_argument('--pages', type=int, default=5, help='Number of listing pages to scrape')
+    parser.add_argument('--latency', type=float, default=0.05, help='Delay of every response in seconds')
+    parser.add_argument('--jitter', type=float, default=0., help='Maximum random delay added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0., help='Fraction of the requests answered with 503')
+    parser.add_argument('--offers-per-page', type=int, default=32)
+    parser.add_argument('--max-rate', type=float, default=200., help='Maximum number of requests per second')
+    parser.add_argument('--cache-dir', help='Response cache with the recorded pages to serve')
+    parser.add_argument('--async-fetch', action='store_true', help='Download the listing pages concurrently')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--drivers', type=int, default=1, help='Number of car pages scraped in parallel')
+    args = parser.parse_args()
+
+    result = run_benchmark(Page[args.portal], args.pages, args.latency, args.jitter, args.error_rate,
+                           args.offers_per_page, args.max_rate, args.cache_dir, async_fetch=args.async_fetch,
+                           concurrency=args.concurrency, n_drivers=args.drivers)
+    print_result(result)
+
+
+if __name__ == '__main__':
+    main()
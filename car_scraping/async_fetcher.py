@@ -0,0 +1,74 @@
+"""
+file that contains the asynchronous fetcher used to download many listing pages at once
+over one pooled, keep-alive HTTP client
+"""
+import asyncio
+import time
+import aiohttp
+from car_scraping.rate_limiter import RateLimiter
+
+
+async def _fetch_page(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, page: str,
+                      rate_limiter: RateLimiter | None) -> str | None:
+    """
+    Method that downloads a single page, waiting for a free slot in the concurrency limit
+    and for the permission of the rate limiter first
+    :param session: Shared aiohttp client session
+    :param semaphore: Semaphore limiting the number of requests in flight
+    :param page: Url of page to download
+    :param rate_limiter: Rate limiter of the page host
+    :return: Html of the page or None if the request failed
+    """
+    async with semaphore:
+        if rate_limiter is not None:
+            await rate_limiter.wait_async(page)
+        start = time.monotonic()
+        status = None
+        try:
+            async with session.get(page) as response:
+                status = response.status
+                response.raise_for_status()
+                return await response.text()
+        except Exception as e:
+            print(f'Encountered problem on the page {page}, error message: {e}')
+            return None
+        finally:
+            if rate_limiter is not None:
+                rate_limiter.report(page, status, time.monotonic() - start)
+
+
+async def _fetch_pages(pages: list[str], headers: dict, cookies: dict, concurrency: int,
+                       timeout: float, rate_limiter: RateLimiter | None) -> dict[str, str | None]:
+    """
+    Method that downloads all the pages with one client session, so connections are reused between requests
+    :param pages: Urls of pages to download
+    :param headers: Headers sent with every request
+    :param cookies: Cookies sent with every request
+    :param concurrency: Maximum number of requests in flight at the same time
+    :param timeout: Total timeout of a single request in seconds
+    :param rate_limiter: Rate limiter of the page hosts
+    :return: Dictionary mapping url of the page to its html (None if the request failed)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=30)
+    async with aiohttp.ClientSession(headers=headers, cookies=cookies, connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        responses = await asyncio.gather(*[_fetch_page(session, semaphore, page, rate_limiter) for page in pages])
+    return dict(zip(pages, responses))
+
+
+def fetch_pages(pages: list[str], headers: dict, cookies: dict = None, concurrency=8,
+                timeout=30., rate_limiter: RateLimiter = None) -> dict[str, str | None]:
+    """
+    Method that downloads many pages concurrently over a single pooled, keep-alive connection pool
+    :param pages: Urls of pages to download
+    :param headers: Headers sent with every request
+    :param cookies: Cookies sent with every request
+    :param concurrency: Maximum number of requests in flight at the same time
+    :param timeout: Total timeout of a single request in seconds
+    :param rate_limiter: Rate limiter of the page hosts, if None the requests are not rate limited
+    :return: Dictionary mapping url of the page to its html (None if the request failed)
+    """
+    if concurrency < 1:
+        raise ValueError(f'Concurrency has to be a positive number, got {concurrency}')
+    return asyncio.run(_fetch_pages(pages, headers, cookies or {}, concurrency, timeout, rate_limiter))
@@ -0,0 +1,39 @@
+"""
+file that contains the backfill jobs re-deriving the columns of the cars already stored in the database.
+They run on car_repository.backfill_cars, so only the changed values are written, in chunked transactions
+"""
+import re
+from repository import car_repository as car_repo
+from repository.models import Car
+
+
+def clean_locations(print_steps=True) -> int:
+    """
+    Method that removes the trailing commas and repeated whitespaces left in the scraped locations
+    :param print_steps: If True, method will print the number of updated cars
+    :return: Number of updated cars
+    """
+    def derive(row) -> dict:
+        location = re.sub(r'\s+,', ',', re.sub(r'\s+', ' ', row.location))
+        return {'location': location.strip().rstrip(',').strip()}
+
+    updated = car_repo.backfill_cars(derive, ['location'], Car.location.is_not(None))
+    if print_steps:
+        print(f'Cleaned the location of {updated} cars')
+    return updated
+
+
+def derive_olx_states(print_steps=True) -> int:
+    """
+    Method that sets the state of the Olx cars from their mileage, the same way as the scraper does
+    :param print_steps: If True, method will print the number of updated cars
+    :return: Number of updated cars
+    """
+    def derive(row) -> dict:
+        return {'state': 'Nowy' if row.mileage < 500 else 'Używany'}
+
+    updated = car_repo.backfill_cars(derive, ['state', 'mileage'],
+                                     Car.link.contains('olx.pl') & Car.mileage.is_not(None))
+    if print_steps:
+        print(f'Derived the state of {updated} Olx cars')
+    return updated
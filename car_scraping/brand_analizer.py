@@ -2,13 +2,61 @@
 file that contains all the logic needed to analise the data in the car repository to get the cars with the best prices
 (cheaper than the average price for the similar cars in the repository or with the best price per km)
 """
+from dataclasses import asdict, dataclass, field, fields, replace
 from repository import car_repository as car_repo
+from repository import peer_price_repository as peer_price_repo
+from car_scraping.car import Car
+from car_scraping.peer_prices import aggregate_peer_stats, peer_price_stats
+from car_scraping.utils import filter_mask, location_mask
+import numpy as np
 import pandas as pd
 
+# Columns of the cars loaded by the batch evaluation (the Car fields, the id and the columns of the filters)
+BATCH_COLUMNS = ['id', *[car_field.name for car_field in fields(Car)], 'brand_norm', 'model_norm', 'city',
+                 'voivodeship']
+
+
+@dataclass(frozen=True)
+class FilterSpec:
+    # Filters of one search, the same as the arguments of get_brands_with_best_price
+    brand: str = ''
+    model: tuple[str, ...] = ('',)
+    min_year: int = 1885
+    max_year: int = 2050
+    min_mileage: int = 0
+    max_mileage: int = 1000000
+    fuel_type: tuple[str, ...] = ('',)
+    gearbox: tuple[str, ...] = ('',)
+    status: str = ''
+    location: tuple[str, ...] = ('',)  # Locations to compare the cars locally in, not a filter of the cars
+    search: str | None = None
+
+
+@dataclass
+class Occasion:
+    car_id: int
+    car: Car
+    peer_average: float  # Average price of the similar cars
+    discount: float  # Difference between the average price of the similar cars and the price of the car
+    price_per_km: float | None
+    # Number of the standard deviations of the prices of the similar cars the price is under their average
+    deal_score: float | None
+
+
+@dataclass
+class BestPriceResult:
+    spec: FilterSpec
+    n_cars: int
+    n_local_cars: int
+    occasions: list[Occasion] = field(default_factory=list)  # Compared with the similar cars in whole Poland
+    local_occasions: list[Occasion] = field(default_factory=list)  # Compared with the similar cars in the locations
+
 
 def get_brands_with_best_price(brand: str, model=list[''], min_year=1885, max_year=2050,
                                min_mileage=0, max_mileage=1000000,
-                               fuel_type=list[''], gearbox=list[''], status='', location=list['']) -> list:
+                               fuel_type=list[''], gearbox=list[''], status='', location=list[''],
+                               search: str = None, snapshot_dir: str = None, use_aggregates=False,
+                               n_workers=1) -> list:
     """
     Method that returns the brand and model of cars with the best price
     in the repository
@@ -22,6 +70,15 @@ def get_brands_with_best_price(brand: str, model=list[''], min_year=1885, max_ye
     :param gearbox: gearbox (or gearboxes) of the car if empty string then all gearboxes
     :param status: used or new
     :param location: location (or locations) of the car to seek
+    :param search: free-form text the cars have to match, e.g. 'seria 3 kombi' (searched in brand, model, location,
+        body type and fuel type)
+    :param snapshot_dir: directory of the Parquet snapshot (see repository.snapshot) to load the cars from instead of
+        the database
+    :param use_aggregates: if True the cars are compared globally with the peer-price aggregates of all the cars in
+        the repository (see repository.peer_price_repository) instead of the cars matching the filters, the mileage
+        of the similar cars is then compared by 10000 km buckets
+    :param n_workers: number of the worker processes comparing the cars with the similar ones, the cars are split
+        between them by the brand, model and gearbox (useful for the scans of whole Poland over all the brands)
     :return: list of car offers with the best prices
     """
     if model is None:
@@ -32,107 +89,50 @@ def get_brands_with_best_price(brand: str, model=list[''], min_year=1885, max_ye
         gearbox = ['']
     if location is None:
         location = ['']
-    cars = car_repo.get_all_cars_filtered(brand, model, min_year, max_year, min_mileage, max_mileage,
-                                          fuel_type, gearbox, status, [''])
+    # Only the needed columns are loaded, without creating the ORM object for every car
+    columns = ['id', 'link', 'brand', 'model', 'mileage', 'engine_capacity', 'engine_power', 'year', 'fuel_type',
+               'gearbox', 'body_type', 'colour', 'type_of_color', 'accident_free', 'state', 'price_pln', 'location',
+               'city', 'voivodeship']
+    if snapshot_dir is not None:
+        if search:
+            raise ValueError('Text search is not supported on the snapshot')
+        from repository.snapshot import load_cars_filtered
+        cars_df = load_cars_filtered(snapshot_dir, brand, model, min_year, max_year, min_mileage, max_mileage,
+                                     fuel_type, gearbox, status, [''], columns)
+    else:
+        # Cars are loaded straight from the cursor to the typed columns (see car_repository.load_cars_frame)
+        cars_df = car_repo.load_cars_filtered(brand, model, min_year, max_year, min_mileage, max_mileage,
+                                              fuel_type, gearbox, status, [''], search, columns)
     pd.set_option('display.max_rows', None)
     pd.set_option('display.max_columns', None)
     pd.set_option('display.max_colwidth', None)
 
-    if not cars:
+    if cars_df.empty:
         print(f'No cars found for brand {brand} and model {model}')
         return []
 
-    # Create a list of dictionaries by extracting attributes from each Car object
-    cars_dict = [{'id': car.id,
-                  'link': car.link,
-                  'brand': car.brand,
-                  'model': car.model,
-                  'mileage': car.mileage,
-                  'engine_capacity': car.engine_capacity,
-                  'engine_power': car.engine_power,
-                  'year': car.year,
-                  'fuel_type': car.fuel_type,
-                  'gearbox': car.gearbox,
-                  'body_type': car.body_type,
-                  'colour': car.colour,
-                  'type_of_color': car.type_of_color,
-                  'accident_free': car.accident_free,
-                  'state': car.state,
-                  'price_pln': car.price_pln,
-                  'location': car.location} for car in cars]
-
-    # Convert the list of dictionaries to a DataFrame
-    cars_df = pd.DataFrame(cars_dict)
-
     local_cars_df = pd.DataFrame({})
-    if location[0] != '':
-        # Create a pattern that matches the location
-        location_pattern = '|'.join(location)
-
-        # Find rows where the 'location' column contains the pattern
-        local_cars_df = cars_df.copy()[cars_df['location'].str.contains(location_pattern, na=False)]
+    # Find the cars in the given locations by their parsed city and voivodeship
+    if (local_cars_mask := location_mask(cars_df, location)) is not None:
+        local_cars_df = cars_df.copy()[local_cars_mask]
 
     occasions_compared_locally = []
-    occasions_compared_globally = []
-
     if local_cars_df.size > 0:
         print(f'Found {len(local_cars_df)} cars in {location}')
         local_cars_df['price_per_km'] = local_cars_df['price_pln'] / local_cars_df['mileage']
 
-        for local_car in local_cars_df.itertuples():
-            # Get the similar cars locally
-            similar_cars_locally = local_cars_df.copy()[
-                (local_cars_df['brand'] == local_car.brand) &
-                (local_cars_df['model'] == local_car.model) &
-                (local_cars_df['gearbox'] == local_car.gearbox) &
-                (abs(local_cars_df['year'] - local_car.year) <= 2) &
-                (abs(local_cars_df['mileage'] - local_car.mileage) <= 20000)
-            ]
-            # Get the similar cars globally
-            similar_cars_globally = cars_df.copy()[
-                (cars_df['brand'] == local_car.brand) &
-                (cars_df['model'] == local_car.model) &
-                (cars_df['gearbox'] == local_car.gearbox) &
-                (abs(cars_df['year'] - local_car.year) <= 2) &
-                (abs(cars_df['mileage'] - local_car.mileage) <= 20000)
-            ]
-
-            # Calculate the average price for similar local cars
-            similar_cars_average_price_locally = similar_cars_locally['price_pln'].mean()
-            # Calculate the average price for similar global cars
-            similar_cars_average_price_globally = similar_cars_globally['price_pln'].mean()
-
-            # Add the car to the dictionary of cars with the best price if it has better price than average
-            if local_car.price_pln < similar_cars_average_price_locally:
-                occasions_compared_locally.append({'car': local_car,
-                                                   'avg_price_for_similar_car': similar_cars_average_price_locally})
-            if local_car.price_pln < similar_cars_average_price_globally:
-                occasions_compared_globally.append({'car': local_car,
-                                                    'avg_price_for_similar_car': similar_cars_average_price_globally})
-        occasions_compared_locally.sort(key=lambda x: x['avg_price_for_similar_car'] - x['car'].price_pln)
-        occasions_compared_globally.sort(key=lambda x: x['avg_price_for_similar_car'] - x['car'].price_pln)
+        # Average price of the similar cars (same brand, model and gearbox, year +/- 2, mileage +/- 20000 km)
+        # locally and globally, computed for all the local cars at once
+        occasions_compared_locally = get_occasions(local_cars_df, peer_price_stats(local_cars_df, n_workers=n_workers))
+        occasions_compared_globally = get_occasions(local_cars_df, get_global_peer_stats(local_cars_df, cars_df,
+                                                                                         use_aggregates, n_workers))
     else:
         print(f'Found {len(cars_df)} cars in whole Poland')
         cars_df['price_per_km'] = cars_df['price_pln'] / cars_df['mileage']
 
-        for car in cars_df.itertuples():
-            # Get the similar cars
-            similar_cars = cars_df.copy()[
-                (cars_df['brand'] == car.brand) &
-                (cars_df['model'] == car.model) &
-                (cars_df['gearbox'] == car.gearbox) &
-                (abs(cars_df['year'] - car.year) <= 2) &
-                (abs(cars_df['mileage'] - car.mileage) <= 20000)
-            ]
-
-            # Calculate the average price for similar cars
-            similar_cars_average_price = similar_cars['price_pln'].mean()
-
-            # Add the car to the dictionary of cars with the best price if it has better price than average
-            if car.price_pln < similar_cars_average_price:
-                occasions_compared_globally.append({'car': car,
-                                                    'avg_price_for_similar_car': similar_cars_average_price})
-        occasions_compared_globally.sort(key=lambda x: x['avg_price_for_similar_car'] - x['car'].price_pln)
+        # Average price of the similar cars, computed for all the cars at once
+        occasions_compared_globally = get_occasions(cars_df, get_global_peer_stats(cars_df, cars_df,
+                                                                                   use_aggregates, n_workers))
 
     print(f'Found {len(occasions_compared_globally)} cars with better price than average for similar cars in Poland\n'
           f'(same brand, model, year, fuel type, gearbox, state, mileage +/- 10000 km)\n'
@@ -141,7 +141,8 @@ def get_brands_with_best_price(brand: str, model=list[''], min_year=1885, max_ye
         print(f'    {car_occasion["car"].brand} {car_occasion["car"].model}, {car_occasion["car"].year},'
               f' {car_occasion["car"].fuel_type}, {car_occasion["car"].gearbox}, {car_occasion["car"].mileage} km:'
               f' {car_occasion["car"].link}\n        Price: {car_occasion["car"].price_pln} PLN\n'
-              f'        Average price for similar cars: {car_occasion["avg_price_for_similar_car"]} PLN')
+              f'        Average price for similar cars: {car_occasion["avg_price_for_similar_car"]} PLN\n'
+              f'        Deal score: {_format_deal_score(car_occasion["deal_score"])}')
 
     if len(occasions_compared_globally) > 0:
         n_otomoto_occasions = len([car_occasion for car_occasion in occasions_compared_globally if 'otomoto' in car_occasion['car'].link])
@@ -161,7 +162,8 @@ def get_brands_with_best_price(brand: str, model=list[''], min_year=1885, max_ye
                 print(f'    {car_occasion["car"].brand} {car_occasion["car"].model}, {car_occasion["car"].year},'
                       f' {car_occasion["car"].fuel_type}, {car_occasion["car"].gearbox}, {car_occasion["car"].mileage} km:'
                       f' {car_occasion["car"].link}\n        Price: {car_occasion["car"].price_pln} PLN\n'
-                      f'        Average price for similar cars: {car_occasion["avg_price_for_similar_car"]} PLN')
+                      f'        Average price for similar cars: {car_occasion["avg_price_for_similar_car"]} PLN\n'
+                      f'        Deal score: {_format_deal_score(car_occasion["deal_score"])}')
             n_otomoto_occasions = len(
                 [car_occasion for car_occasion in occasions_compared_locally if 'otomoto' in car_occasion['car'].link])
             n_olx_occasions = len(
@@ -196,3 +198,112 @@ def get_brands_with_best_price(brand: str, model=list[''], min_year=1885, max_ye
 
         print(f'Percentage of top {percent}% cars with best price per km from olx:')
         print(len(top_cars[top_cars['link'].str.contains('olx')]) / len(top_cars) * 100)
+
+
+def get_global_peer_stats(cars_df, all_cars_df, use_aggregates=False, n_workers=1) -> pd.DataFrame:
+    """
+    Method that returns the statistics of the prices of the similar cars in whole Poland for every car
+    :param cars_df: DataFrame with the cars to compare
+    :param all_cars_df: DataFrame with all the cars matching the filters
+    :param use_aggregates: if True the prices of the similar cars are looked up in the peer-price aggregates
+    :param n_workers: number of the worker processes comparing the cars (see peer_prices.peer_price_stats)
+    :return: DataFrame aligned with the cars with peer_count, peer_mean, peer_std and deal_score (see
+        peer_prices.aggregate_peer_stats)
+    """
+    if not use_aggregates:
+        return peer_price_stats(cars_df, all_cars_df, n_workers=n_workers)
+    aggregates = peer_price_repo.get_aggregates(zip(cars_df['brand'].astype(object), cars_df['model'].astype(object)))
+    return aggregate_peer_stats(cars_df, aggregates)
+
+
+def get_occasions(cars_df, peer_stats) -> list[dict]:
+    """
+    Method that returns the cars cheaper than the average price of the similar cars
+    :param cars_df: DataFrame with the cars
+    :param peer_stats: Statistics of the prices of the similar cars for every car (see get_global_peer_stats)
+    :return: list of {'car': car, 'avg_price_for_similar_car': average price, 'deal_score': deal score} dictionaries,
+        sorted by the difference between the average price and the price of the car
+    """
+    return [{'car': occasion.car, 'avg_price_for_similar_car': occasion.peer_average,
+             'deal_score': occasion.deal_score}
+            for occasion in _to_occasions(cars_df, peer_stats, biggest_first=False)]
+
+
+def evaluate_best_prices(specs: list[FilterSpec], snapshot_dir: str = None, use_aggregates=False,
+                         n_workers=1) -> list[BestPriceResult]:
+    """
+    Method that finds the cars with the best price for many searches at once. The cars matching any of the searches
+    are loaded with one query and every search is evaluated on them in memory, compared the same way as in
+    get_brands_with_best_price
+    :param specs: filters of the searches, e.g. one per brand of the watchlist
+    :param snapshot_dir: directory of the Parquet snapshot (see repository.snapshot) to load the cars from instead of
+        the database
+    :param use_aggregates: if True the cars are compared globally with the peer-price aggregates (see
+        get_brands_with_best_price)
+    :param n_workers: number of the worker processes comparing the cars with the similar ones
+    :return: list of the results in the order of the searches, the occasions sorted by the discount (the biggest
+        first)
+    """
+    if not specs:
+        return []
+    if snapshot_dir is not None:
+        if any(spec.search for spec in specs):
+            raise ValueError('Text search is not supported on the snapshot')
+        from repository.snapshot import load_snapshot
+        cars_df = load_snapshot(snapshot_dir, BATCH_COLUMNS)
+    else:
+        # Locations only select the cars compared locally, so they are not part of the query
+        cars_df = car_repo.load_cars_filtered_any([asdict(replace(spec, location=('',))) for spec in specs],
+                                                  BATCH_COLUMNS)
+
+    results = []
+    for spec in specs:
+        spec_filters = asdict(spec)
+        search = spec_filters.pop('search')
+        spec_filters['location'] = ['']
+        spec_df = cars_df[filter_mask(cars_df, **spec_filters)]
+        if search:
+            spec_df = spec_df[spec_df['id'].isin(car_repo.search_car_ids(search))]
+        spec_df = spec_df.reset_index(drop=True)
+
+        result = BestPriceResult(spec, len(spec_df), 0)
+        local_cars_mask = location_mask(spec_df, spec.location)
+        if local_cars_mask is not None and local_cars_mask.any():
+            local_cars_df = spec_df[local_cars_mask]
+            result.n_local_cars = len(local_cars_df)
+            result.local_occasions = _to_occasions(local_cars_df, peer_price_stats(local_cars_df, n_workers=n_workers))
+            result.occasions = _to_occasions(local_cars_df, get_global_peer_stats(local_cars_df, spec_df,
+                                                                                      use_aggregates, n_workers))
+        else:
+            result.occasions = _to_occasions(spec_df, get_global_peer_stats(spec_df, spec_df, use_aggregates,
+                                                                                n_workers))
+        results.append(result)
+    return results
+
+
+def _to_occasions(cars_df, peer_stats, biggest_first=True) -> list[Occasion]:
+    # Cars cheaper than the average price of the similar cars as the occasions, the biggest discount first (or last)
+    average_prices = peer_stats['peer_mean'].to_numpy()
+    prices = pd.to_numeric(cars_df['price_pln'], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    mileages = pd.to_numeric(cars_df['mileage'], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    is_cheaper = prices < average_prices
+    discounts = (average_prices - prices)[is_cheaper]
+    order = np.argsort(-discounts if biggest_first else discounts, kind='stable')
+    cheaper_cars = cars_df[is_cheaper].iloc[order]
+    # Only the occasions are converted to the Python objects, missing values to None
+    records = cheaper_cars[[car_field.name for car_field in fields(Car)]].astype(object)
+    records = records.where(records.notna(), None).to_dict('records')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prices_per_km = (prices / mileages)[is_cheaper][order]
+    deal_scores = peer_stats['deal_score'].to_numpy()[is_cheaper][order]
+    return [Occasion(int(car_id), Car(**record), float(average_price), float(discount),
+                     float(price_per_km) if np.isfinite(price_per_km) else None,
+                     float(deal_score) if np.isfinite(deal_score) else None)
+            for car_id, record, average_price, discount, price_per_km, deal_score
+            in zip(cheaper_cars['id'], records, average_prices[is_cheaper][order], discounts[order], prices_per_km,
+                   deal_scores)]
+
+
+def _format_deal_score(deal_score: float | None) -> str:
+    # Deal score with 2 decimals, n/a when the similar cars have all the same price
+    return 'n/a' if deal_score is None else f'{deal_score:.2f}'
@@ -0,0 +1,185 @@
+"""
+file that contains the coordinator of the sharded crawl. Page ranges of both portals are split into shards scraped by
+the pool of worker processes (each with its own browsers and HTTP client), while all the scraped cars are sent back
+to the single writer in the coordinator process, so the database is never written by more than one process
+"""
+import multiprocessing
+import multiprocessing.util
+import threading
+import time
+import requests
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from car_scraping import scraper
+from car_scraping.driver_pool import DriverPool
+from car_scraping.scraper import Page, CrawlStats, scrape_n_pages
+from car_scraping.rate_limiter import rate_limiter, POLITENESS
+from repository.car_writer import CarWriter
+from repository.known_links import KnownLinks
+from repository import db_connection
+
+
+@dataclass(frozen=True)
+class Shard:
+    page: Page
+    start_page: int
+    n_pages: int
+
+
+@dataclass
+class ShardResult:
+    shard: Shard
+    stats: CrawlStats = field(default_factory=CrawlStats)
+    elapsed: float = 0.
+    error: str | None = None
+
+
+@dataclass
+class RunResult:
+    shards: list[ShardResult]
+    n_inserted: int
+    elapsed: float
+
+    @property
+    def stats(self) -> CrawlStats:
+        """
+        Statistics of the whole run summed over all the shards
+        """
+        total = CrawlStats()
+        for result in self.shards:
+            for name in vars(total):
+                setattr(total, name, getattr(total, name) + getattr(result.stats, name))
+        return total
+
+    @property
+    def failed_shards(self) -> list[ShardResult]:
+        return [result for result in self.shards if result.error is not None]
+
+
+class _QueueWriter:
+    """
+    Writer used in the worker process, it sends the cars to the coordinator instead of writing them to the database
+    """
+
+    def __init__(self, cars_queue, known_links: KnownLinks = None):
+        self.cars_queue = cars_queue
+        self.known_links = known_links
+
+    def add(self, car) -> None:
+        # The index of the worker is loaded once, so the links it scrapes are added to it as they are sent
+        if self.known_links is not None:
+            self.known_links.add(car.link)
+        self.cars_queue.put(car)
+
+
+# State of the worker process created once by _init_worker and used by all the shards it scrapes
+_cars_queue = None
+_driver_pool = None
+_known_links = None
+
+
+def split_pages(page: Page, n_pages: int, start_page=1, pages_per_shard=5) -> list[Shard]:
+    """
+    Method that splits the range of listing pages into shards
+    :param page: Page to scrape from
+    :param n_pages: Number of pages to scrape
+    :param start_page: Number of page from which scrapping will start
+    :param pages_per_shard: Number of listing pages in one shard
+    :return: List of shards covering the whole range
+    """
+    return [Shard(page, first, min(pages_per_shard, start_page + n_pages - first))
+            for first in range(start_page, start_page + n_pages, pages_per_shard)]
+
+
+def crawl_sharded(ranges: dict[Page, tuple[int, int]], n_workers=4, pages_per_shard=5, print_steps=True,
+                  **scrape_kwargs) -> RunResult:
+    """
+    Method that scrapes the page ranges of the portals with the pool of worker processes
+    :param ranges: Dictionary mapping the page to scrape from to the (start_page, n_pages) range
+    :param n_workers: Number of worker processes
+    :param pages_per_shard: Number of listing pages scraped by the worker in one task
+    :param print_steps: If True, method (and the workers) will print the progress of the run
+    :param scrape_kwargs: Other arguments of scrape_n_pages used by every worker (job_name is not supported,
+        the frontier would be written by many processes)
+    :return: Results of all the shards with the number of inserted cars
+    """
+    if 'job_name' in scrape_kwargs:
+        raise ValueError('Sharded crawl does not support crawl jobs')
+    shards = [shard for page, (start_page, n_pages) in ranges.items()
+              for shard in split_pages(page, n_pages, start_page, pages_per_shard)]
+    start = time.monotonic()
+    results = []
+
+    # Interleave the portals, so the workers do not hit one host all at once
+    shards.sort(key=lambda shard: (shard.start_page, shard.page.value))
+
+    manager = multiprocessing.Manager()
+    cars_queue = manager.Queue()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(cars_queue, n_workers, scrape_kwargs)) as executor:
+            # With the fork start method all the workers are forked by the first submit, so they are forked before
+            # the writer and drain threads of the coordinator are started and never inherit their locks
+            futures = {executor.submit(_crawl_shard, shard, {**scrape_kwargs, 'print_steps': print_steps}): shard
+                       for shard in shards}
+            with CarWriter() as car_writer:
+                drain_thread = threading.Thread(target=_drain, args=(cars_queue, car_writer), name='car-drain')
+                drain_thread.start()
+                try:
+                    for future in as_completed(futures):
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            result = ShardResult(futures[future], error=str(e))
+                        results.append(result)
+                        if print_steps:
+                            status = 'failed: ' + result.error if result.error else f'{result.stats.n_cars} cars'
+                            print(f'Shard {result.shard.page.name} pages {result.shard.start_page}-'
+                                  f'{result.shard.start_page + result.shard.n_pages - 1} {status} '
+                                  f'({len(results)}/{len(shards)} shards done)')
+                finally:
+                    cars_queue.put(None)
+                    drain_thread.join()
+    finally:
+        manager.shutdown()
+
+    run = RunResult(sorted(results, key=lambda result: (result.shard.page.value, result.shard.start_page)),
+                    car_writer.n_inserted, time.monotonic() - start)
+    if print_steps:
+        print(f'Sharded crawl finished in {run.elapsed:.1f}s: {run.stats}, {run.n_inserted} new cars stored, '
+              f'{len(run.failed_shards)} shards failed')
+    return run
+
+
+def _drain(cars_queue, car_writer: CarWriter) -> None:
+    # Move the cars sent by the workers to the single writer of the coordinator
+    while (car := cars_queue.get()) is not None:
+        car_writer.add(car)
+
+
+def _init_worker(cars_queue, n_workers: int, scrape_kwargs: dict) -> None:
+    global _cars_queue, _driver_pool, _known_links
+    _cars_queue = cars_queue
+    # Connections of the pool inherited from the coordinator must not be used by the forked worker
+    db_connection.engine.dispose(close=False)
+    # The worker has its own HTTP session, browsers and index of the known links, created once and used by all the
+    # shards it scrapes. The browsers are closed when the worker exits
+    scraper.session = requests.Session()
+    scraper.session.cookies.update(scraper.cookies)
+    _driver_pool = DriverPool(scrape_kwargs.get('n_drivers', 1), scrape_kwargs.get('max_pages_per_driver', 100))
+    multiprocessing.util.Finalize(_driver_pool, _driver_pool.close, exitpriority=10)
+    if scrape_kwargs.get('skip_known', True):
+        _known_links = KnownLinks.load(scrape_kwargs.get('use_bloom_filter', False))
+    # Every worker has its own rate limiter, so the politeness budget of the host is split between the workers
+    for host, politeness in POLITENESS.items():
+        rate_limiter.configure(host, replace(politeness,
+                                             min_delay=politeness.min_delay * n_workers,
+                                             initial_delay=politeness.initial_delay * n_workers))
+
+
+def _crawl_shard(shard: Shard, scrape_kwargs: dict) -> ShardResult:
+    start = time.monotonic()
+    stats = scrape_n_pages(shard.page, shard.n_pages, shard.start_page,
+                           car_writer=_QueueWriter(_cars_queue, _known_links), driver_pool=_driver_pool,
+                           known_links=_known_links, **scrape_kwargs)
+    return ShardResult(shard, stats, time.monotonic() - start)
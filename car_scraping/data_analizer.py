@@ -1,14 +1,20 @@
 import pandas as pd
-import matplotlib.pyplot as plt
 import time
-from repository import db_connection
-from repository.models import Car
+from repository import car_repository as car_repo
 
+# Columns of the cars used by the analysis
+COLUMNS = ['id', 'link', 'brand', 'model', 'mileage', 'engine_capacity', 'engine_power', 'year', 'fuel_type',
+           'gearbox', 'body_type', 'colour', 'type_of_color', 'accident_free', 'state', 'price_pln', 'location']
 
-def analise_data(visualize_data=True) -> None:
-    # Fetch data from the database and create a DataFrame
-    query = db_connection.Session().query(Car)
-    cars_data = pd.read_sql(query.statement, query.session.bind)
+
+def analise_data(visualize_data=True, snapshot_dir: str = None) -> None:
+    if snapshot_dir is not None:
+        # Load the data from the Parquet snapshot (see repository.snapshot), without reading the database
+        from repository.snapshot import load_snapshot
+        cars_data = load_snapshot(snapshot_dir, COLUMNS)
+    else:
+        # Fetch data from the database and create a DataFrame with the compact dtypes
+        cars_data = car_repo.load_cars_frame(COLUMNS)
 
     pd.set_option('display.float_format', '{:.2f}'.format)
 
@@ -51,6 +57,9 @@ def analise_data(visualize_data=True) -> None:
     print(missing_data_percentage_otomoto)
 
     if visualize_data:
+        # Matplotlib is slow to import, so it is loaded only when the data is visualized
+        import matplotlib.pyplot as plt
+
         # Collective visualization
         # ------------------------
 
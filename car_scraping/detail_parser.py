@@ -0,0 +1,279 @@
+"""
+file that contains the logic needed to build the cars from the offer detail pages, both for the data extracted
+with Selenium and for the plain html parsing (fast path without the browser)
+"""
+import json
+import re
+from bs4 import BeautifulSoup
+from car_scraping.car import Car
+
+labels_to_find_otomoto = [
+    'Marka pojazdu',
+    'Model pojazdu',
+    'Przebieg',
+    'Pojemność skokowa',
+    'Moc',
+    'Rok produkcji',
+    'Rodzaj paliwa',
+    'Skrzynia biegów',
+    'Typ nadwozia',
+    'Kolor',
+    'Rodzaj koloru',
+    'Bezwypadkowy',
+    'Stan'
+]
+
+labels_to_find_olx = [
+    'Model',
+    'Przebieg',
+    'Poj. silnika',
+    'Moc silnika',
+    'Rok produkcji',
+    'Paliwo',
+    'Skrzynia biegów',
+    'Typ nadwozia',
+    'Kolor',
+    'Stan techniczny',
+]
+
+# Fields without which the car is useless for the analysis, if any of them is missing the browser has to be used
+REQUIRED_FIELDS = ['brand', 'model', 'mileage', 'year', 'price_pln']
+
+
+def to_int(text, unit='') -> int | None:
+    """
+    Method that converts the text like '120 000 km' to the integer
+    :param text: Text (or number) to convert
+    :param unit: Unit to remove from the text
+    :return: Converted integer or None if the text is empty
+    """
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return int(text)
+    text = re.sub(r'\s', '', str(text).replace(unit, '')) if unit else re.sub(r'\s', '', str(text))
+    return int(text) if text else None
+
+
+def has_required_fields(car: Car | None) -> bool:
+    """
+    Method that checks if the car has all the fields needed for the analysis
+    :param car: Car to check
+    :return: True if none of the required fields is missing
+    """
+    return car is not None and all(getattr(car, field) not in (None, '') for field in REQUIRED_FIELDS)
+
+
+def build_car_otomoto(link: str, car_details: dict, price, location: str) -> Car:
+    """
+    Method that creates the car from the label-value pairs found on the Otomoto offer
+    :param link: Url of the offer
+    :param car_details: Dictionary with label-value pairs of the offer
+    :param price: Price of the car (text or number)
+    :param location: Location of the car
+    :return: Car object
+    """
+    def detail(index: int):
+        return car_details.get(labels_to_find_otomoto[index])
+
+    return Car(
+        link=link,
+        brand=detail(0),
+        model=detail(1),
+        mileage=to_int(detail(2), 'km'),
+        engine_capacity=to_int(detail(3), 'cm3'),
+        engine_power=to_int(detail(4), 'KM'),
+        year=to_int(detail(5)),
+        fuel_type=detail(6),
+        gearbox=detail(7),
+        body_type=detail(8),
+        colour=detail(9),
+        type_of_color=detail(10),
+        accident_free=detail(11),
+        state=detail(12),
+        price_pln=to_int(price),
+        location=location
+    )
+
+
+def build_car_olx(link: str, brand: str | None, car_details: dict, price, location: str) -> Car:
+    """
+    Method that creates the car from the label-value pairs found on the Olx offer
+    :param link: Url of the offer
+    :param brand: Brand of the car
+    :param car_details: Dictionary with label-value pairs of the offer
+    :param price: Price of the car (text or number)
+    :param location: Location of the car
+    :return: Car object
+    """
+    def detail(index: int):
+        return car_details.get(labels_to_find_olx[index])
+
+    car = Car(
+        link=link,
+        brand=brand,
+        model=detail(0),
+        mileage=to_int(detail(1), 'km'),
+        engine_capacity=to_int(detail(2), 'cm³'),
+        engine_power=to_int(detail(3), 'KM'),
+        year=to_int(detail(4)),
+        fuel_type=detail(5),
+        gearbox=detail(6),
+        body_type=detail(7),
+        colour=detail(8),
+        type_of_color=None,
+        accident_free=detail(9),
+        state=None,
+        price_pln=to_int(price, 'zł'),
+        location=location
+    )
+
+    # Set the state of the car based on mileage
+    if car.mileage is not None:
+        car.state = 'Nowy' if car.mileage < 500 else 'Używany'
+
+    return car
+
+
+def parse_car_otomoto(link: str, html: str) -> Car | None:
+    """
+    Method that parses the server-rendered html of the Otomoto offer. The embedded Next.js state is used first
+    and the html elements fill the details missing in it
+    :param link: Url of the offer
+    :param html: Html of the offer
+    :return: Car object or None if the page could not be parsed
+    """
+    try:
+        soup = BeautifulSoup(html, 'lxml')
+        car_details, price, location = {}, None, ''
+
+        advert = _find_key(_load_script_json(soup, 'script#__NEXT_DATA__'), 'advert')
+        if isinstance(advert, dict):
+            for detail in advert.get('details') or []:
+                if isinstance(detail, dict) and detail.get('label') in labels_to_find_otomoto:
+                    car_details[detail['label']] = str(detail.get('value')).strip()
+            price = (advert.get('price') or {}).get('value')
+            address = _find_key(advert.get('seller'), 'address')
+            location = address.strip() if isinstance(address, str) else ''
+
+        # Fill the missing details with the server-rendered html
+        for detail in soup.select('div.ooa-162vy3d.e18eslyg3'):
+            label_element = detail.select_one('p.e18eslyg4.ooa-12b2ph5')
+            value_element = (detail.select_one('a.e16lfxpc1.ooa-1ftbcn2')
+                             or detail.select_one('p.e16lfxpc0.ooa-1pe3502.er34gjf0'))
+            if label_element is None or value_element is None:
+                continue
+            label = label_element.get_text(strip=True)
+            if label in labels_to_find_otomoto and label not in car_details:
+                car_details[label] = value_element.get_text(strip=True)
+
+        if price is None:
+            price_element = soup.select_one('h3.offer-price__number')
+            price = price_element.get_text(strip=True) if price_element is not None else None
+
+        location_elements = [element.get_text(strip=True) for element in soup.select('a.edhv9y51.ooa-oxkwx3')]
+        location_elements = [text for text in location_elements
+                             if 'Przejdź do' not in text and 'Zobacz więcej' not in text]
+        if location_elements:
+            location = location_elements[0]
+
+        return build_car_otomoto(link, car_details, price, location)
+    except Exception as e:
+        print(f'Encountered a problem while parsing car data from page {link}, error message: {e}')
+        return None
+
+
+def parse_car_olx(link: str, html: str) -> Car | None:
+    """
+    Method that parses the server-rendered html of the Olx offer. The embedded prerendered state is used first
+    and the html elements fill the details missing in it
+    :param link: Url of the offer
+    :param html: Html of the offer
+    :return: Car object or None if the page could not be parsed
+    """
+    try:
+        soup = BeautifulSoup(html, 'lxml')
+        car_details, brand, price, location = {}, None, None, ''
+
+        ad = _find_key(_load_prerendered_state(soup), 'ad')
+        ad = ad.get('ad', ad) if isinstance(ad, dict) else None
+        if isinstance(ad, dict):
+            for param in ad.get('params') or []:
+                if isinstance(param, dict) and param.get('name') in labels_to_find_olx:
+                    car_details[param['name']] = str(param.get('value')).strip()
+            brands = [breadcrumb.get('label') for breadcrumb in ad.get('breadcrumbs') or []
+                      if isinstance(breadcrumb, dict)
+                      and str(breadcrumb.get('href', '')).startswith('/motoryzacja/samochody/')]
+            brand = brands[1] if len(brands) > 1 else None
+            price = ((ad.get('price') or {}).get('regularPrice') or {}).get('value')
+            ad_location = ad.get('location') or {}
+            if ad_location.get('cityName'):
+                location = ad_location['cityName']
+                if ad_location.get('regionName'):
+                    location += ' - ' + ad_location['regionName']
+
+        # Fill the missing details with the server-rendered html
+        if brand is None:
+            brand_elements = soup.select('a.css-tyi2d1[href^="/motoryzacja/samochody/"]')
+            brand = brand_elements[1].get_text(strip=True) if len(brand_elements) > 1 else None
+
+        for p_element in soup.select('li.css-1r0si1e p.css-b5m1rv'):
+            # Skip the p elements containing a span (they are different and do not contain ':')
+            if p_element.find('span') is not None or ': ' not in p_element.get_text():
+                continue
+            label, value = p_element.get_text().split(': ', 1)
+            if label not in car_details:
+                car_details[label] = value
+
+        if price is None:
+            price_element = soup.select_one('h3.css-93ez2t')
+            price = price_element.get_text(strip=True) if price_element is not None else None
+
+        if not location:
+            location_element = soup.select_one('p.css-1cju8pu.er34gjf0')
+            region_element = soup.select('p.css-b5m1rv.er34gjf0')
+            if location_element is not None:
+                location = location_element.get_text(strip=True).removesuffix(',')
+            if region_element and region_element[-1].get_text(strip=True) != 'Więcej od tego ogłoszeniodawcy':
+                location += ' - ' + region_element[-1].get_text(strip=True)
+
+        return build_car_olx(link, brand, car_details, price, location)
+    except Exception as e:
+        print(f'Encountered a problem while parsing car data from page {link}, error message: {e}')
+        return None
+
+
+def _load_script_json(soup, selector: str):
+    script = soup.select_one(selector)
+    if script is None or not script.string:
+        return None
+    try:
+        return json.loads(script.string)
+    except ValueError:
+        return None
+
+
+def _load_prerendered_state(soup):
+    for script in soup.find_all('script'):
+        match = re.search(r'window\.__PRERENDERED_STATE__\s*=\s*(".*?");?\s*$', script.string or '', re.S | re.M)
+        if match:
+            try:
+                # The state is a json document serialized once more as a javascript string
+                return json.loads(json.loads(match.group(1)))
+            except ValueError:
+                return None
+    return None
+
+
+def _find_key(data, key: str):
+    # Depth-first search for the first value stored under the key in nested dictionaries and lists
+    if isinstance(data, dict):
+        if key in data:
+            return data[key]
+        data = list(data.values())
+    if isinstance(data, list):
+        for value in data:
+            found = _find_key(value, key)
+            if found is not None:
+                return found
+    return None
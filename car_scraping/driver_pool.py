@@ -0,0 +1,109 @@
+"""
+file that contains the pool of long-lived headless Chrome drivers that are leased for scraping the car detail pages
+"""
+import queue
+import threading
+from contextlib import contextmanager
+from selenium import webdriver
+
+
+class DriverPool:
+    """
+    Pool of long-lived headless Chrome drivers. Drivers are created lazily, health-checked when they are given back
+    and restarted after serving a configured number of pages, so the memory growth of a single browser stays capped
+    """
+
+    def __init__(self, size=1, max_pages_per_driver=100, page_load_timeout=30.):
+        """
+        :param size: Maximum number of drivers (browsers) running at the same time
+        :param max_pages_per_driver: Number of pages after which the driver is restarted
+        :param page_load_timeout: Time in seconds after which hanging page load is interrupted
+        """
+        if size < 1:
+            raise ValueError(f'Size of the driver pool has to be a positive number, got {size}')
+        self.size = size
+        self.max_pages_per_driver = max_pages_per_driver
+        self.page_load_timeout = page_load_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+        self._pages_served = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextmanager
+    def lease(self):
+        """
+        Method that leases a driver from the pool and gives it back when the with block ends
+        :return: Selenium WebDriver
+        """
+        if self._closed:
+            raise RuntimeError('Driver pool is already closed')
+        self._slots.acquire()
+        driver = None
+        try:
+            driver = self._get_idle_driver() or self._create_driver()
+            yield driver
+        finally:
+            if driver is not None:
+                self._give_back(driver)
+            self._slots.release()
+
+    def close(self) -> None:
+        """
+        Method that quits all idle drivers of the pool
+        :return: None
+        """
+        self._closed = True
+        while True:
+            try:
+                self._quit(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _get_idle_driver(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _create_driver(self):
+        chrome_options = webdriver.ChromeOptions()
+        chrome_options.add_argument('--headless')
+        driver = webdriver.Chrome(options=chrome_options)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        driver.set_script_timeout(self.page_load_timeout)
+        with self._lock:
+            self._pages_served[id(driver)] = 0
+        return driver
+
+    def _give_back(self, driver) -> None:
+        with self._lock:
+            self._pages_served[id(driver)] += 1
+            pages_served = self._pages_served[id(driver)]
+        if self._closed or pages_served >= self.max_pages_per_driver or not self._is_healthy(driver):
+            # Recycle the driver, the new one will be created on the next lease
+            self._quit(driver)
+        else:
+            self._idle.put(driver)
+
+    @staticmethod
+    def _is_healthy(driver) -> bool:
+        try:
+            return driver.execute_script('return 1') == 1
+        except Exception as e:
+            print(f'Driver stopped responding and will be restarted, error message: {e}')
+            return False
+
+    def _quit(self, driver) -> None:
+        with self._lock:
+            self._pages_served.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f'Encountered problem while closing the driver, error message: {e}')
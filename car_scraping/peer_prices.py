@@ -0,0 +1,294 @@
+"""
+file that contains the vectorized comparison of the car prices with the prices of their peers: the cars of the same
+brand, model and gearbox, at most 2 years and 20000 km apart. The peers are found for all the cars at once: the cars
+are sorted by the composite (group, year, mileage) key, so the peers from every year are one contiguous range of it
+(found with the binary search) and their prices are summed with the prefix sums. The peers can be also looked up in
+the peer-price aggregates maintained by the repository (see aggregate_peer_stats). The groups are independent, so
+the comparison can be also split by the groups between the worker processes (n_workers)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import pandas as pd
+from repository.models import MILEAGE_BUCKET
+
+# Columns the peers have to be equal on
+PEER_COLUMNS = ['brand', 'model', 'gearbox']
+
+YEAR_WINDOW = 2
+MILEAGE_WINDOW = 20000
+
+# Number of the shards (ranges of the groups) per worker process of the parallel comparison, more shards than the
+# workers even out the differently sized groups
+SHARDS_PER_WORKER = 4
+# Fewer cars are always compared in the current process, starting the workers would take longer than the comparison
+PARALLEL_MIN_CARS = 20000
+
+
+def peer_mean_prices(cars_df, peers_df=None, year_window=YEAR_WINDOW, mileage_window=MILEAGE_WINDOW,
+                     n_workers=1) -> np.ndarray:
+    """
+    Method that returns the average price of the peers of every car, the car itself included if it is in the peers
+    :param cars_df: DataFrame with the cars (brand, model, gearbox, year, mileage and price_pln columns)
+    :param peers_df: DataFrame with the cars to compare with, if None the cars are compared with each other
+    :param year_window: Maximum difference of the year of the peers
+    :param mileage_window: Maximum difference of the mileage of the peers (in km)
+    :param n_workers: Number of the worker processes comparing the groups of the cars in parallel, 1 compares them
+        in the current process
+    :return: Array with the average price of the peers for every car, NaN for the cars without peers (the cars with
+        any of the compared columns missing have no peers)
+    """
+    counts, sums = peer_price_sums(cars_df, peers_df, year_window, mileage_window, n_workers)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def peer_price_sums(cars_df, peers_df=None, year_window=YEAR_WINDOW, mileage_window=MILEAGE_WINDOW,
+                    n_workers=1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Method that returns the number of the peers with the price and the sum of their prices for every car
+    :param cars_df: DataFrame with the cars (brand, model, gearbox, year, mileage and price_pln columns)
+    :param peers_df: DataFrame with the cars to compare with, if None the cars are compared with each other
+    :param year_window: Maximum difference of the year of the peers
+    :param mileage_window: Maximum difference of the mileage of the peers (in km)
+    :param n_workers: Number of the worker processes comparing the groups of the cars in parallel
+    :return: (counts, sums) arrays aligned with the cars
+    """
+    if peers_df is None:
+        peers_df = cars_df
+    prices = _to_float(peers_df['price_pln'])
+    has_price = ~np.isnan(prices)
+    counts, sums = _window_sums(peers_df, _to_float(peers_df['mileage']), [has_price, np.where(has_price, prices, 0.)],
+                                cars_df, _to_float(cars_df['mileage']), year_window, mileage_window, n_workers)
+    return counts.astype(np.int64), sums
+
+
+def peer_price_stats(cars_df, peers_df=None, year_window=YEAR_WINDOW, mileage_window=MILEAGE_WINDOW,
+                     n_workers=1) -> pd.DataFrame:
+    """
+    Method that returns the statistics of the prices of the peers of every car, the car itself included if it is in
+    the peers, the same as aggregate_peer_stats returns from the peer-price aggregates
+    :param cars_df: DataFrame with the cars (brand, model, gearbox, year, mileage and price_pln columns)
+    :param peers_df: DataFrame with the cars to compare with, if None the cars are compared with each other
+    :param year_window: Maximum difference of the year of the peers
+    :param mileage_window: Maximum difference of the mileage of the peers (in km)
+    :param n_workers: Number of the worker processes comparing the groups of the cars in parallel
+    :return: DataFrame aligned with the cars with peer_count, peer_mean, peer_std and deal_score
+        (see aggregate_peer_stats)
+    """
+    if peers_df is None:
+        peers_df = cars_df
+    prices = _to_float(peers_df['price_pln'])
+    has_price = ~np.isnan(prices)
+    prices = np.where(has_price, prices, 0.)
+    counts, price_sums, price_sums_squares = _window_sums(
+        peers_df, _to_float(peers_df['mileage']), [has_price, prices, prices ** 2],
+        cars_df, _to_float(cars_df['mileage']), year_window, mileage_window, n_workers
+    )
+    return _price_stats(cars_df, counts, price_sums, price_sums_squares)
+
+
+def aggregate_peer_stats(cars_df, aggregates, year_window=YEAR_WINDOW, mileage_window=MILEAGE_WINDOW):
+    """
+    Method that returns the statistics of the prices of the peers of every car from the peer-price aggregates
+    (see repository.peer_price_repository). The mileage is compared by the buckets of MILEAGE_BUCKET km, so the peers
+    are the cars at most mileage_window // MILEAGE_BUCKET buckets apart
+    :param cars_df: DataFrame with the cars (brand, model, gearbox, year, mileage and price_pln columns)
+    :param aggregates: Rows (or DataFrame) of the aggregates of the brands and models of the cars
+    :param year_window: Maximum difference of the year of the peers
+    :param mileage_window: Maximum difference of the mileage of the peers (in km)
+    :return: DataFrame aligned with the cars with peer_count, peer_mean and peer_std of the prices of the peers and
+        deal_score: number of the standard deviations the price of the car is under the mean (NaN without the peers)
+    """
+    aggregates_df = pd.DataFrame(aggregates, columns=[*PEER_COLUMNS, 'year', 'mileage_bucket',
+                                                      'n_cars', 'price_sum', 'price_sum_squares'])
+    counts, price_sums, price_sums_squares = _window_sums(
+        aggregates_df, _to_float(aggregates_df['mileage_bucket']),
+        [_to_float(aggregates_df[column]) for column in ('n_cars', 'price_sum', 'price_sum_squares')],
+        cars_df, np.floor(_to_float(cars_df['mileage']) / MILEAGE_BUCKET), year_window, mileage_window // MILEAGE_BUCKET
+    )
+    return _price_stats(cars_df, counts, price_sums, price_sums_squares)
+
+
+def _price_stats(cars_df, counts: np.ndarray, price_sums: np.ndarray, price_sums_squares: np.ndarray) -> pd.DataFrame:
+    # Mean and standard deviation of the prices of the peers from their sums and the deal score of the cars
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, price_sums / counts, np.nan)
+        stds = np.sqrt(np.clip(price_sums_squares / counts - means ** 2, 0., None))
+        deal_scores = np.where(stds > 0, (means - _to_float(cars_df['price_pln'])) / stds, np.nan)
+    return pd.DataFrame({'peer_count': counts.astype(np.int64), 'peer_mean': means, 'peer_std': stds,
+                         'deal_score': deal_scores}, index=cars_df.index)
+
+
+def _window_sums(peers_df, peer_positions: np.ndarray, weights: list[np.ndarray], cars_df, car_positions: np.ndarray,
+                 year_window: int, position_window: int, n_workers=1) -> list[np.ndarray]:
+    # Sums of the weights of the peers of every car: the peers of the same group, at most year_window years and
+    # position_window (mileage or mileage bucket) apart
+    if len(cars_df) == 0 or len(peers_df) == 0:
+        return [np.zeros(len(cars_df), dtype=np.float64) for _ in weights]
+
+    groups = _number_groups(peers_df, cars_df)
+    peer_groups, car_groups = groups[:len(peers_df)], groups[len(peers_df):]
+    peer_years, car_years = _to_float(peers_df['year']), _to_float(cars_df['year'])
+    weights = [np.asarray(weight, dtype=np.float64) for weight in weights]
+    if n_workers > 1 and len(cars_df) >= PARALLEL_MIN_CARS:
+        return _parallel_window_sums(peer_groups, peer_years, peer_positions, weights, car_groups, car_years,
+                                     car_positions, year_window, position_window, n_workers)
+    return _group_window_sums(peer_groups, peer_years, peer_positions, weights, car_groups, car_years, car_positions,
+                              year_window, position_window)
+
+
+def _number_groups(peers_df, cars_df) -> np.ndarray:
+    # Groups are numbered on both DataFrames together, so the same group has the same number in both (-1 if any of
+    # the columns is missing). The columns are factorized one by one and their codes combined, which is much faster
+    # than grouping by the tuples of the values and keeps the part not split between the workers small
+    groups = np.zeros(len(peers_df) + len(cars_df), dtype=np.int64)
+    for column in PEER_COLUMNS:
+        codes, uniques = pd.factorize(pd.concat([peers_df[column], cars_df[column]], ignore_index=True))
+        missing = (groups < 0) | (codes < 0)
+        # Combined codes are factorized again, so they stay smaller than the number of the rows
+        groups = np.where(missing, -1, pd.factorize(groups * len(uniques) + codes)[0])
+    return groups
+
+
+def _group_window_sums(peer_groups, peer_years, peer_positions, weights, car_groups, car_years, car_positions,
+                       year_window: int, position_window: int) -> list[np.ndarray]:
+    # Sums of the weights of the peers of every car on the arrays of the numbered groups (-1 for the missing group)
+    sums = [np.zeros(len(car_groups), dtype=np.float64) for _ in weights]
+    peers = (peer_groups >= 0) & ~np.isnan(peer_years) & ~np.isnan(peer_positions)
+    cars = (car_groups >= 0) & ~np.isnan(car_years) & ~np.isnan(car_positions)
+    if not peers.any() or not cars.any():
+        return sums
+
+    # Composite key: group, then year (padded by the window, so the shifted years stay in the group), then position
+    # (shifted by the window, so the ranges of the positions never cross to the previous year)
+    year_min = int(min(peer_years[peers].min(), car_years[cars].min()))
+    year_max = int(max(peer_years[peers].max(), car_years[cars].max()))
+    position_min = int(min(peer_positions[peers].min(), car_positions[cars].min()))
+    position_max = int(max(peer_positions[peers].max(), car_positions[cars].max()))
+    n_years = year_max - year_min + 1 + 2 * year_window
+    position_span = position_max - position_min + 1 + 2 * position_window
+
+    def composite_key(group, year, position):
+        return ((group * n_years + (year.astype(np.int64) - year_min + year_window)) * position_span
+                + (position.astype(np.int64) - position_min + position_window))
+
+    peer_keys = composite_key(peer_groups[peers], peer_years[peers], peer_positions[peers])
+    order = np.argsort(peer_keys, kind='stable')
+    peer_keys = peer_keys[order]
+    # Prefix sums with the leading zero: the sum of the range [start, end) is prefix[end] - prefix[start]
+    prefixes = [np.concatenate(([0.], np.cumsum(weight[peers][order]))) for weight in weights]
+
+    # Keys of the peer ranges differ from the key of the car by the constants, so the ranges are searched in the order
+    # of the keys of the cars (binary search of the sorted values is much faster) and the results are put back after
+    car_keys = composite_key(car_groups[cars], car_years[cars], car_positions[cars])
+    car_order = np.argsort(car_keys, kind='stable')
+    car_keys = car_keys[car_order]
+    sorted_sums = [np.zeros(len(car_keys), dtype=np.float64) for _ in weights]
+    for year_offset in range(-year_window, year_window + 1):
+        starts = np.searchsorted(peer_keys, car_keys + year_offset * position_span - position_window, side='left')
+        ends = np.searchsorted(peer_keys, car_keys + year_offset * position_span + position_window, side='right')
+        for sorted_sum, prefix in zip(sorted_sums, prefixes):
+            sorted_sum += prefix[ends] - prefix[starts]
+    positions = np.flatnonzero(cars)[car_order]
+    for car_sum, sorted_sum in zip(sums, sorted_sums):
+        car_sum[positions] = sorted_sum
+    return sums
+
+
+def _parallel_window_sums(peer_groups, peer_years, peer_positions, weights, car_groups, car_years, car_positions,
+                          year_window: int, position_window: int, n_workers: int) -> list[np.ndarray]:
+    # The same sums computed by the pool of worker processes. The peers and the cars are sorted by the group, so every
+    # shard (range of the groups) is one contiguous slice of them, the sorted columns are put to the shared memory
+    # once and the workers get only the bounds of their slices and write the sums of their cars in place
+    sums = [np.zeros(len(car_groups), dtype=np.float64) for _ in weights]
+    peers = (peer_groups >= 0) & ~np.isnan(peer_years) & ~np.isnan(peer_positions)
+    cars = (car_groups >= 0) & ~np.isnan(car_years) & ~np.isnan(car_positions)
+    if not peers.any() or not cars.any():
+        return sums
+    peer_order = np.flatnonzero(peers)[np.argsort(peer_groups[peers], kind='stable')]
+    car_order = np.flatnonzero(cars)[np.argsort(car_groups[cars], kind='stable')]
+    shards = _split_groups(peer_groups[peer_order], car_groups[car_order], n_workers * SHARDS_PER_WORKER)
+
+    columns = {'peer_groups': peer_groups[peer_order], 'peer_years': peer_years[peer_order],
+               'peer_positions': peer_positions[peer_order], 'car_groups': car_groups[car_order],
+               'car_years': car_years[car_order], 'car_positions': car_positions[car_order]}
+    for i, weight in enumerate(weights):
+        columns[f'weight_{i}'] = weight[peer_order]
+        columns[f'sum_{i}'] = np.zeros(len(car_order), dtype=np.float64)
+    shared_memory, layout = _share_columns(columns)
+    try:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(shards)), initializer=_init_worker,
+                                 initargs=(shared_memory.name, layout)) as executor:
+            for future in [executor.submit(_shard_window_sums, shard, len(weights), year_window, position_window)
+                           for shard in shards]:
+                future.result()
+        shared_columns = _attach_columns(shared_memory, layout)
+        for i, car_sum in enumerate(sums):
+            car_sum[car_order] = shared_columns[f'sum_{i}']
+        del shared_columns
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
+    return sums
+
+
+def _split_groups(peer_groups: np.ndarray, car_groups: np.ndarray, n_shards: int) -> list[tuple[int, int, int, int]]:
+    # Contiguous ranges of the sorted groups with about the same number of the peers and the cars in every one,
+    # as the (peer_start, peer_end, car_start, car_end) bounds of the slices
+    groups = np.unique(car_groups)
+    peer_starts, peer_ends = (np.searchsorted(peer_groups, groups, side='left'),
+                              np.searchsorted(peer_groups, groups, side='right'))
+    car_starts, car_ends = (np.searchsorted(car_groups, groups, side='left'),
+                            np.searchsorted(car_groups, groups, side='right'))
+    sizes = np.cumsum(peer_ends - peer_starts + car_ends - car_starts)
+    bounds = np.searchsorted(sizes, sizes[-1] * np.arange(1, n_shards) / n_shards, side='left') + 1
+    bounds = np.unique(np.concatenate(([0], np.minimum(bounds, len(groups)), [len(groups)])))
+    return [(int(peer_starts[first]), int(peer_ends[last - 1]), int(car_starts[first]), int(car_ends[last - 1]))
+            for first, last in zip(bounds[:-1], bounds[1:])]
+
+
+def _share_columns(columns: dict[str, np.ndarray]):
+    # Copies the columns to one block of the shared memory, returns it with the (name, dtype, offset, length) layout
+    layout, size = [], 0
+    for name, column in columns.items():
+        layout.append((name, column.dtype.str, size, len(column)))
+        size += column.nbytes
+    shared_memory = SharedMemory(create=True, size=max(size, 1))
+    for name, column in _attach_columns(shared_memory, layout).items():
+        column[:] = columns[name]
+    return shared_memory, layout
+
+
+def _attach_columns(shared_memory: SharedMemory, layout: list) -> dict[str, np.ndarray]:
+    return {name: np.ndarray(length, dtype=dtype, buffer=shared_memory.buf, offset=offset)
+            for name, dtype, offset, length in layout}
+
+
+_shared_memory = None
+_shared_columns = None
+
+
+def _init_worker(name: str, layout: list) -> None:
+    global _shared_memory, _shared_columns
+    _shared_memory = SharedMemory(name=name)
+    _shared_columns = _attach_columns(_shared_memory, layout)
+
+
+def _shard_window_sums(shard: tuple[int, int, int, int], n_weights: int, year_window: int,
+                       position_window: int) -> None:
+    peer_start, peer_end, car_start, car_end = shard
+    peer_slice, car_slice = slice(peer_start, peer_end), slice(car_start, car_end)
+    columns = _shared_columns
+    shard_sums = _group_window_sums(
+        columns['peer_groups'][peer_slice], columns['peer_years'][peer_slice], columns['peer_positions'][peer_slice],
+        [columns[f'weight_{i}'][peer_slice] for i in range(n_weights)],
+        columns['car_groups'][car_slice], columns['car_years'][car_slice], columns['car_positions'][car_slice],
+        year_window, position_window
+    )
+    for i, shard_sum in enumerate(shard_sums):
+        columns[f'sum_{i}'][car_slice] = shard_sum
+
+
+def _to_float(column) -> np.ndarray:
+    return pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
@@ -0,0 +1,137 @@
+"""
+file that contains the adaptive per-host rate limiter shared by the listing fetcher, the detail scraper and the
+location backfill. Every host has its own token bucket, which speeds up while the responses are healthy and backs off
+exponentially on 429/5xx responses, errors and slow responses
+"""
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+
+@dataclass
+class Politeness:
+    min_delay: float  # Shortest allowed average delay between requests in seconds
+    max_delay: float  # Longest delay between requests the back off can reach in seconds
+    initial_delay: float  # Delay between requests at the start of the crawl in seconds
+    slow_response: float  # Response time in seconds above which the host is treated as overloaded
+    burst: int = 1  # Number of requests that can be sent at once after the idle period
+    speed_up: float = 0.9  # Factor applied to the delay after the healthy response
+    back_off: float = 2.  # Factor applied to the delay after the unhealthy response
+
+
+POLITENESS = {
+    'www.otomoto.pl': Politeness(min_delay=1., max_delay=60., initial_delay=4., slow_response=5.),
+    'www.olx.pl': Politeness(min_delay=.5, max_delay=60., initial_delay=2., slow_response=5.),
+}
+
+DEFAULT_POLITENESS = Politeness(min_delay=1., max_delay=60., initial_delay=4., slow_response=5.)
+
+
+class _HostBucket:
+
+    def __init__(self, politeness: Politeness):
+        self.politeness = politeness
+        self.delay = politeness.initial_delay
+        self.tokens = float(politeness.burst)
+        self.last_refill = time.monotonic()
+
+
+class RateLimiter:
+    """
+    Thread-safe per-host token bucket scheduler with the adaptive rate
+    """
+
+    def __init__(self, politeness: dict[str, Politeness] = None, default: Politeness = DEFAULT_POLITENESS):
+        """
+        :param politeness: Politeness budget by host name, missing hosts use the budget from POLITENESS
+        :param default: Politeness budget of the hosts without the configured one
+        """
+        self._politeness = {**POLITENESS, **(politeness or {})}
+        self._default = default
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def configure(self, host: str, politeness: Politeness) -> None:
+        """
+        Method that sets the politeness budget of the host, resetting its current rate
+        :param host: Host name, e.g. www.otomoto.pl
+        :param politeness: Politeness budget of the host
+        :return: None
+        """
+        with self._lock:
+            self._politeness[host] = politeness
+            self._buckets.pop(host, None)
+
+    def reserve(self, url: str) -> float:
+        """
+        Method that takes the token from the bucket of the url host
+        :param url: Url that is going to be requested
+        :return: Time in seconds the caller has to wait before sending the request
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._bucket(host)
+            now = time.monotonic()
+            bucket.tokens = min(bucket.tokens + (now - bucket.last_refill) / bucket.delay,
+                                float(bucket.politeness.burst))
+            bucket.last_refill = now
+            bucket.tokens -= 1
+            # Negative number of tokens means the requests queued before this one
+            return max(-bucket.tokens * bucket.delay, 0.)
+
+    def wait(self, url: str) -> None:
+        """
+        Method that blocks until the request to the url can be sent
+        :param url: Url that is going to be requested
+        :return: None
+        """
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, url: str) -> None:
+        """
+        Method that waits (without blocking the event loop) until the request to the url can be sent
+        :param url: Url that is going to be requested
+        :return: None
+        """
+        delay = self.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def report(self, url: str, status_code: int | None, elapsed: float) -> None:
+        """
+        Method that adapts the rate of the url host to the outcome of the request
+        :param url: Requested url
+        :param status_code: Http status code of the response or None if the request failed
+        :param elapsed: Response time in seconds
+        :return: None
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._bucket(host)
+            politeness = bucket.politeness
+            if status_code is None or status_code == 429 or status_code >= 500 or elapsed > politeness.slow_response:
+                bucket.delay = min(bucket.delay * politeness.back_off, politeness.max_delay)
+            else:
+                bucket.delay = max(bucket.delay * politeness.speed_up, politeness.min_delay)
+
+    def get_delay(self, url: str) -> float:
+        """
+        Method that returns the current average delay between requests to the url host
+        :param url: Url of the host
+        :return: Delay in seconds
+        """
+        with self._lock:
+            return self._bucket(urlparse(url).netloc).delay
+
+    def _bucket(self, host: str) -> _HostBucket:
+        if host not in self._buckets:
+            self._buckets[host] = _HostBucket(self._politeness.get(host, self._default))
+        return self._buckets[host]
+
+
+# Rate limiter shared by all the requests of the process
+rate_limiter = RateLimiter()
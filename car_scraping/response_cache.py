@@ -0,0 +1,159 @@
+"""
+file that contains the on-disk cache of the downloaded pages. Responses are stored compressed (zstd when the zstandard
+package is installed, gzip otherwise) in files addressed by the hash of the url, expire after the ttl and the oldest
+ones are evicted when the cache grows over its size limit
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Iterator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ResponseCache:
+    """
+    Compressed store of the page html keyed by url
+    """
+
+    def __init__(self, directory='.cache/responses', ttl=7 * 24 * 3600., max_size=2 * 1024 ** 3):
+        """
+        :param directory: Directory of the cache
+        :param ttl: Time in seconds after which the cached response expires (None means never)
+        :param max_size: Maximum size of the cache in bytes, the oldest responses are evicted above it
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.extension = '.zst' if zstandard is not None else '.gz'
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get(self, url: str, max_age: float = None) -> str | None:
+        """
+        Method that returns the cached html of the url
+        :param url: Url of the page
+        :param max_age: Maximum age of the response in seconds, if None the ttl of the cache is used
+        :return: Html of the page or None if it is not cached (or expired)
+        """
+        max_age = self.ttl if max_age is None else max_age
+        for path in (self._path(url, '.zst'), self._path(url, '.gz')):
+            try:
+                if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+                    return None
+                metadata, html = self._read(path)
+                return html if metadata.get('url') == url else None
+            except (FileNotFoundError, ValueError, OSError):
+                continue
+        return None
+
+    def put(self, url: str, html: str) -> None:
+        """
+        Method that stores the html of the url in the cache
+        :param url: Url of the page
+        :param html: Html of the page
+        :return: None
+        """
+        path = self._path(url, self.extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = json.dumps({'url': url, 'fetched_at': time.time()}) + '\n' + html
+        data = self._compress(payload.encode('utf-8'))
+
+        # Write to the temporary file first, so the reader never sees the partially written response
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(file_descriptor, 'wb') as file:
+            file.write(data)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temporary_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._compute_size()
+            else:
+                self._size += len(data) - old_size
+            if self._size > self.max_size:
+                self._evict_oldest()
+
+    def iter_entries(self) -> Iterator[tuple[str, str, float]]:
+        """
+        Method that iterates through all the cached responses, including the expired ones
+        :return: Iterator of (url, html, fetched_at) tuples
+        """
+        for path in self._iter_paths():
+            try:
+                metadata, html = self._read(path)
+            except (ValueError, OSError) as e:
+                print(f'Encountered problem while reading the cached response {path}, error message: {e}')
+                continue
+            yield metadata['url'], html, metadata['fetched_at']
+
+    def evict_expired(self) -> int:
+        """
+        Method that removes all the expired responses from the cache
+        :return: Number of removed responses
+        """
+        if self.ttl is None:
+            return 0
+        removed = 0
+        now = time.time()
+        with self._lock:
+            for path in self._iter_paths():
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+                    removed += 1
+            self._size = None
+        return removed
+
+    def _path(self, url: str, extension: str) -> str:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def _iter_paths(self) -> Iterator[str]:
+        if not os.path.isdir(self.directory):
+            return
+        for subdirectory in os.scandir(self.directory):
+            if subdirectory.is_dir():
+                for entry in os.scandir(subdirectory.path):
+                    if entry.name.endswith(('.zst', '.gz')):
+                        yield entry.path
+
+    def _compute_size(self) -> int:
+        return sum(os.path.getsize(path) for path in self._iter_paths())
+
+    def _evict_oldest(self) -> None:
+        # Remove the least recently written responses until the cache is 10% under its limit
+        files = sorted(((os.stat(path), path) for path in self._iter_paths()), key=lambda file: file[0].st_mtime)
+        for stat, path in files:
+            if self._size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= stat.st_size
+
+    @staticmethod
+    def _compress(data: bytes) -> bytes:
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=10).compress(data)
+        return gzip.compress(data, compresslevel=6)
+
+    @staticmethod
+    def _read(path: str) -> tuple[dict, str]:
+        with open(path, 'rb') as file:
+            data = file.read()
+        if path.endswith('.zst'):
+            if zstandard is None:
+                raise ValueError('zstandard package is needed to read the response compressed with zstd')
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = gzip.decompress(data)
+        header, html = data.decode('utf-8').split('\n', 1)
+        return json.loads(header), html
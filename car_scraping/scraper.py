@@ -1,11 +1,24 @@
 import random
+import threading
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
 from enum import Enum
 from bs4 import BeautifulSoup
 from car_scraping.car import Car
+from car_scraping.async_fetcher import fetch_pages
+from car_scraping.driver_pool import DriverPool
+from car_scraping.rate_limiter import rate_limiter
+from car_scraping.response_cache import ResponseCache
+from car_scraping.detail_parser import (labels_to_find_otomoto, build_car_otomoto, build_car_olx,
+                                        parse_car_otomoto, parse_car_olx, has_required_fields)
 import repository.car_repository as car_repo
-from selenium import webdriver
+import repository.crawl_repository as crawl_repo
+import repository.peer_price_repository as peer_price_repo
+from repository.car_writer import CarWriter
+from repository.known_links import KnownLinks
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -17,6 +30,13 @@ class Page(Enum):
     olx = 'olx'
     olx_url = 'https://www.olx.pl/motoryzacja/samochody/'
 
+# Origins of the portals, they can be pointed at the local stand-in portal with use_portal_origins
+DEFAULT_PORTAL_ORIGINS = {Page.otomoto: 'https://www.otomoto.pl', Page.olx: 'https://www.olx.pl'}
+portal_origins = dict(DEFAULT_PORTAL_ORIGINS)
+
+# Paths of the listing pages relative to the origin of the portal
+LISTING_PATHS = {Page.otomoto: '/osobowe', Page.olx: '/motoryzacja/samochody/'}
+
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
@@ -33,66 +53,190 @@ headers = {
     'User-Agent': USER_AGENTS[0]
 }
 
-labels_to_find_otomoto = [
-    'Marka pojazdu',
-    'Model pojazdu',
-    'Przebieg',
-    'Pojemność skokowa',
-    'Moc',
-    'Rok produkcji',
-    'Rodzaj paliwa',
-    'Skrzynia biegów',
-    'Typ nadwozia',
-    'Kolor',
-    'Rodzaj koloru',
-    'Bezwypadkowy',
-    'Stan'
-]
+cookies = {'cookie_name': 'cookie_value'}
 
-labels_to_find_olx = [
-    'Model',
-    'Przebieg',
-    'Poj. silnika',
-    'Moc silnika',
-    'Rok produkcji',
-    'Paliwo',
-    'Skrzynia biegów',
-    'Typ nadwozia',
-    'Kolor',
-    'Stan techniczny',
-]
+# Session shared by all synchronous listing requests, so the connection (and TLS handshake) is reused between pages
+session = requests.Session()
+session.cookies.update(cookies)
+
+# Cache of the downloaded pages (None means the pages are always downloaded), set with use_response_cache
+response_cache: ResponseCache | None = None
+
+# Listing pages change all the time, so their cached version is used only for a short time
+LISTING_CACHE_MAX_AGE = 3600.
+
+
+@dataclass
+class CrawlStats:
+    n_listing_pages: int = 0  # Number of listing pages scraped
+    n_links: int = 0  # Number of car links found on the listing pages
+    n_skipped: int = 0  # Number of car links skipped because they are already in the database
+    n_cars: int = 0  # Number of cars scraped and saved
+    n_failed: int = 0  # Number of car pages that could not be scraped
+
+
+class _JobWriter:
+    """
+    Writer used by the crawl job, it marks the car page as done only after its car is committed by the writer, so the
+    cars still waiting in the buffer are scraped again by the resumed job instead of being lost
+    """
+
+    def __init__(self, car_writer: CarWriter, job_id: int, url: str):
+        self.car_writer = car_writer
+        self.job_id = job_id
+        self.url = url
+
+    def add(self, car: Car) -> None:
+        self.car_writer.add(car, on_written=lambda: crawl_repo.mark_url(self.job_id, self.url, True, None))
 
 
 def scrape_n_pages(from_page=Page.otomoto, n_pages=1, start_page=1,
-                   min_sleep=4., max_sleep=7., print_steps=True) -> None:
+                   print_steps=True, async_fetch=False, concurrency=8,
+                   n_drivers=1, max_pages_per_driver=100, fast_path=True, skip_known=True,
+                   use_bloom_filter=False, job_name: str = None, max_attempts=3, car_writer=None,
+                   cache_dir: str = None, driver_pool: DriverPool = None,
+                   known_links: KnownLinks = None) -> CrawlStats:
     """
-    Main scraping method. It will iterate through pages and scrape cars info and update total number of cars in db
+    Main scraping method. It will iterate through pages and scrape cars info and update total number of cars in db.
+    Requests are spaced by the adaptive per-host rate limiter (see car_scraping.rate_limiter)
     :param from_page: Page to scrape from
     :param n_pages: Number of pages to scrape
     :param start_page: Number of page from which scrapping will start
-    :param min_sleep: Minimum time delay after request
-    :param max_sleep: Maximum time delay after request
     :param print_steps: If True, method will print the steps it's taking
-    :return: None
+    :param async_fetch: If True, all listing pages are downloaded concurrently before scraping the cars
+    :param concurrency: Maximum number of listing pages downloaded at the same time when async_fetch is True
+    :param n_drivers: Number of browsers scraping the car pages in parallel
+    :param max_pages_per_driver: Number of car pages after which the browser is restarted
+    :param fast_path: If True, car pages are parsed without the browser whenever they contain all required fields
+    :param skip_known: If True, links that are already in the database are skipped before fetching the car page,
+        if False they are scraped again and their pages are downloaded even when they are in the response cache
+    :param use_bloom_filter: If True, the known links are held in the compact Bloom filter instead of the set
+    :param job_name: Name of the crawl job. If given, the frontier (listing and car pages with their status)
+        is stored in the database and the interrupted run with the same job name continues where it stopped
+    :param max_attempts: Maximum number of attempts for the failed url of the crawl job
+    :param car_writer: Writer (object with add(car) method) to store the cars with, if None the new CarWriter is used.
+        With job_name it has to be the CarWriter, the car pages are marked as done when it commits their cars
+    :param cache_dir: Directory of the response cache, if given the pages are read from and written to the cache
+    :param driver_pool: Pool of drivers to scrape the car pages with, owned by the caller (e.g. the worker of the
+        sharded crawl scraping many page ranges), if None the new pool of n_drivers is used
+    :param known_links: Index of the known links used when skip_known is True, if None it is loaded from the database
+    :return: Statistics of the crawl
     """
     if print_steps:
         print(f'Scraping cars...')
 
-    for i in range(start_page, start_page + n_pages):
-        if print_steps:
-            print(f'  Scraping page {i} of cars from {from_page.value}?page={i}')
+    if cache_dir is not None:
+        use_response_cache(ResponseCache(cache_dir))
 
-        links = scrape_links_from_page(from_page.value + f'?page={i}')
+    stats = CrawlStats()
+    stats_lock = threading.Lock()
 
-        for car_link in links:
-            # Rotate between different User-Agents to mimic different browsers or devices
-            headers['User-Agent'] = random.choice(USER_AGENTS)
+    if not skip_known:
+        known_links = None
+    elif known_links is None:
+        known_links = KnownLinks.load(use_bloom_filter)
 
-            scrape_car_info(car_link)
+    # Known offers are scraped again to record the changes of their price, so their pages are never read from the
+    # response cache then
+    detail_max_age = None if skip_known else 0.
 
+    pages = {i: get_listing_url(from_page) + f'?page={i}' for i in range(start_page, start_page + n_pages)}
+
+    job_id = None
+    if job_name is not None:
+        # Listing pages already done by the previous runs of the job are not fetched again
+        job_id = crawl_repo.get_or_create_job(job_name)
+        crawl_repo.add_urls(job_id, pages.values(), crawl_repo.LISTING)
+        pending_pages = set(crawl_repo.get_pending_urls(job_id, crawl_repo.LISTING, max_attempts))
+        pages = {i: page for i, page in pages.items() if page in pending_pages}
+
+    links_by_page = {}
+    if async_fetch:
+        if print_steps:
+            print(f'  Fetching {len(pages)} listing pages with up to {concurrency} requests at once...')
+        responses = {page: get_cached_page(page, LISTING_CACHE_MAX_AGE) for page in pages.values()}
+        fetched = fetch_pages([page for page, html in responses.items() if html is None], headers, cookies,
+                              concurrency, rate_limiter=rate_limiter)
+        responses.update(fetched)
+        if response_cache is not None:
+            for page, html in fetched.items():
+                if html is not None:
+                    response_cache.put(page, html)
+        links_by_page = {i: get_links_from_html(page, responses[page]) if responses[page] is not None else []
+                         for i, page in pages.items()}
+
+    def scrape_car(car_link: str, page_number: int | None) -> None:
+        # Rotate between different User-Agents to mimic different browsers or devices
+        headers['User-Agent'] = random.choice(USER_AGENTS)
+
+        writer = car_writer if job_id is None else _JobWriter(car_writer, job_id, car_link)
+        succeeded = scrape_car_info(car_link, driver_pool, writer, fast_path, detail_max_age)
+        with stats_lock:
+            if succeeded:
+                stats.n_cars += 1
+            else:
+                stats.n_failed += 1
+        if job_id is not None and not succeeded:
+            crawl_repo.mark_url(job_id, car_link, False, 'Car could not be scraped')
+
+        if print_steps:
+            print(f'    Scraped car at link {car_link}'
+                  + (f' from page number {page_number}' if page_number is not None else ''))
+
+    # The writer and the driver pool given by the caller are owned (and closed) by the caller
+    writer_context = nullcontext(car_writer) if car_writer is not None else CarWriter(known_links=known_links)
+    pool_context = nullcontext(driver_pool) if driver_pool is not None else DriverPool(n_drivers, max_pages_per_driver)
+    with writer_context as car_writer, pool_context as driver_pool, \
+            ThreadPoolExecutor(max_workers=driver_pool.size) as executor:
+        def scrape_cars(links: list[str], page_number: int | None) -> None:
+            # Consume the results, so the page is finished before moving to the next one
+            list(executor.map(scrape_car, links, [page_number] * len(links)))
+
+        if job_id is not None:
+            # Finish the car pages left by the interrupted run first
+            leftover_links = crawl_repo.get_pending_urls(job_id, crawl_repo.DETAIL, max_attempts)
+            if print_steps and leftover_links:
+                print(f'  Resuming {len(leftover_links)} car pages left by the previous run of job {job_name}')
+            scrape_cars(leftover_links, None)
+
+        for i, page in pages.items():
             if print_steps:
-                print(f'    Delay after car at link {car_link} from page number {i}...')
-            time.sleep(random.uniform(min_sleep, max_sleep))  # Wait some time delay to mimic human behavior
+                print(f'  Scraping page {i} of cars from {page}')
+
+            links = links_by_page[i] if async_fetch else scrape_links_from_page(page)
+            n_links = len(links)
+            stats.n_listing_pages += 1
+            stats.n_links += n_links
+            if known_links is not None:
+                links = [link for link in links if link and link not in known_links]
+                stats.n_skipped += n_links - len(links)
+                if print_steps:
+                    print(f'  Skipping {n_links - len(links)} offers that are already in the database')
+            if job_id is not None:
+                # Listing page without any offer means that it could not be fetched or parsed
+                crawl_repo.add_urls(job_id, links, crawl_repo.DETAIL)
+                crawl_repo.mark_url(job_id, page, n_links > 0, None if n_links else 'No offers found on the page')
+                links = crawl_repo.get_pending_urls(job_id, crawl_repo.DETAIL, max_attempts, urls=links)
+
+            scrape_cars(links, i)
+
+        if job_id is not None:
+            # Retry the failed car pages until they succeed or run out of attempts. The buffered cars are written
+            # first, so their pages are marked as done and not taken for the failed ones
+            car_writer.flush()
+            while retry_links := crawl_repo.get_pending_urls(job_id, crawl_repo.DETAIL, max_attempts):
+                if print_steps:
+                    print(f'  Retrying {len(retry_links)} failed car pages of job {job_name}')
+                scrape_cars(retry_links, None)
+                car_writer.flush()
+
+    if job_id is not None:
+        if print_steps:
+            print(f'  Progress of job {job_name} (kind, status): {crawl_repo.get_job_progress(job_id)}')
+        if not crawl_repo.get_pending_urls(job_id, crawl_repo.LISTING, max_attempts, limit=1):
+            crawl_repo.finish_job(job_id)
+
+    return stats
 
 
 def scrape_links_from_page(page: str) -> list[str]:
@@ -102,23 +246,131 @@ def scrape_links_from_page(page: str) -> list[str]:
     :return: List of links to cars
     """
     try:
-        cookie = {'cookie_name': 'cookie_value'}
-        session = requests.Session()
-        session.cookies.update(cookie)
-
-        response = session.get(page, headers=headers).text
-        soup = BeautifulSoup(response, 'html.parser')
-        # Check if page is otomoto or olx
-        if str(Page.otomoto_url.value) in page:
-            return get_links_otomoto(soup)
-        elif str(Page.olx_url.value) in page:
-            return get_links_olx(soup)
-        return []
+        response = get_page(page, LISTING_CACHE_MAX_AGE)
+        return get_links_from_html(page, response)
     except Exception as e:
         print(f'Encountered problem on the page {page}, error message: {e}')
         return []
 
 
+def use_portal_origins(origins: dict[Page, str] | None) -> None:
+    """
+    Method that sets the origins the portals are scraped from, e.g. the local stand-in portal used by the benchmark
+    :param origins: Dictionary mapping the portal (Page.otomoto or Page.olx) to its origin, None restores the defaults
+    :return: None
+    """
+    portal_origins.clear()
+    portal_origins.update(DEFAULT_PORTAL_ORIGINS)
+    portal_origins.update(origins or {})
+
+
+def get_portal(page: str) -> Page | None:
+    """
+    Method that returns the portal the url belongs to
+    :param page: Url of the page
+    :return: Page.otomoto, Page.olx or None if the url is not from any of the portals
+    """
+    for portal, origin in portal_origins.items():
+        if page.startswith(origin + '/'):
+            return portal
+    return None
+
+
+def get_listing_url(from_page: Page) -> str:
+    """
+    Method that returns the url of the first listing page of the portal
+    :param from_page: Page to scrape from (Page.otomoto, Page.otomoto_url, Page.olx or Page.olx_url)
+    :return: Url of the listing page without the page number
+    """
+    portal = Page.olx if from_page in (Page.olx, Page.olx_url) else Page.otomoto
+    return portal_origins[portal] + LISTING_PATHS[portal]
+
+
+def use_response_cache(cache: ResponseCache | None) -> None:
+    """
+    Method that sets the response cache used by all the requests of the scraper
+    :param cache: Response cache or None to disable caching
+    :return: None
+    """
+    global response_cache
+    response_cache = cache
+
+
+def get_cached_page(page: str, max_age: float = None) -> str | None:
+    """
+    Method that returns the html of the page from the response cache
+    :param page: Url of the page
+    :param max_age: Maximum age of the cached response in seconds, if None the ttl of the cache is used
+    :return: Html of the page or None if the page is not cached or caching is disabled
+    """
+    return response_cache.get(page, max_age) if response_cache is not None else None
+
+
+def get_page(page: str, max_age: float = None) -> str:
+    """
+    Method returns the html of the page from the response cache or sends request to the page with the shared
+    session, after waiting for the permission of the rate limiter
+    :param page: Url of page to request
+    :param max_age: Maximum age of the cached response in seconds, if None the ttl of the cache is used
+    :return: Html of the page
+    """
+    html = get_cached_page(page, max_age)
+    if html is not None:
+        return html
+
+    rate_limiter.wait(page)
+    start = time.monotonic()
+    status = None
+    try:
+        response = session.get(page, headers=headers)
+        status = response.status_code
+        response.raise_for_status()
+    finally:
+        rate_limiter.report(page, status, time.monotonic() - start)
+
+    if response_cache is not None:
+        response_cache.put(page, response.text)
+    return response.text
+
+
+def load_page(driver, page: str) -> None:
+    """
+    Method loads the page in the Selenium driver, after waiting for the permission of the rate limiter.
+    Loaded page is stored in the response cache
+    :param driver: Selenium WebDriver
+    :param page: Url of page to load
+    :return: None
+    """
+    rate_limiter.wait(page)
+    start = time.monotonic()
+    succeeded = False
+    try:
+        driver.get(page)
+        succeeded = True
+    finally:
+        # Selenium does not expose the status code, so only the failures and response times are reported
+        rate_limiter.report(page, 200 if succeeded else None, time.monotonic() - start)
+
+    if response_cache is not None:
+        response_cache.put(page, driver.page_source)
+
+
+def get_links_from_html(page: str, html: str) -> list[str]:
+    """
+    Method that creates beautiful soup object from html of the listing page and extracts links to cars from it
+    :param page: Url of the listing page
+    :param html: Html of the listing page
+    :return: List of links to cars
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    # Check if page is otomoto or olx
+    if get_portal(page) == Page.otomoto:
+        return get_links_otomoto(soup)
+    elif get_portal(page) == Page.olx:
+        return get_links_olx(soup)
+    return []
+
+
 def get_links_otomoto(soup) -> list[str]:
     """
     Method that returns links to cars with BeautifulSoup object from response
@@ -156,42 +408,132 @@ def get_links_olx(soup) -> list[str]:
         for car_article in car_articles:  # Iterate through car offers elements
             # Get the particular html elements representing needed car properties
             url_element = car_article.find('a', href=True)
-            if Page.otomoto_url.value in url_element['href']:  # Some auctions on olx are from otomoto
+            if get_portal(url_element['href']) == Page.otomoto:  # Some auctions on olx are from otomoto
                 links.append(url_element['href'])
             else:
-                links.append('https://www.olx.pl' + url_element['href'] if url_element is not None else None)
+                links.append(portal_origins[Page.olx] + url_element['href'] if url_element is not None else None)
         return links
     except Exception as e:
         print(f'Encountered problem while extracting urls of cars, error message: {e}')
         return []
 
 
-def scrape_car_info(page) -> None:
+def scrape_car_info(page, driver_pool: DriverPool, car_writer: CarWriter = None, fast_path=True,
+                    max_age: float = None) -> bool:
     """
-    Method sends request to the page to scrape, then creates beautiful soup object to work with
+    Method scrapes the car from the page and saves it. The plain html of the page is parsed first
+    and the page is loaded with the driver leased from the pool only when required fields are missing in it
     :param page: Url of page to scrape
-    :return: None
+    :param driver_pool: Pool of drivers to lease the driver from
+    :param car_writer: Buffered writer to store the car with, if None the car is added to the database directly
+    :param fast_path: If True, the page is first parsed without the browser
+    :param max_age: Maximum age of the cached page in seconds (0 means the page is always downloaded), if None the
+        ttl of the cache is used
+    :return: True if the car was scraped and saved
     """
+    if fast_path:
+        car = scrape_car_info_without_browser(page, max_age)
+        if has_required_fields(car):
+            save_car(car, car_writer)
+            return True
+
     try:
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.add_argument('--headless')
-        driver = webdriver.Chrome(options=chrome_options)
-        driver.get(page)
-        # Check if page is otomoto or olx
-        if str(Page.otomoto_url.value) in page:
-            save_cars_otomoto(driver)
-        elif str(Page.olx.value) in page:
-            save_cars_olx(driver)
+        # The browser that could not be started fails only this car, not the whole crawl
+        with driver_pool.lease() as driver:
+            load_page(driver, page)
+            # Check if page is otomoto or olx
+            if get_portal(page) == Page.otomoto:
+                return save_cars_otomoto(driver, car_writer)
+            elif get_portal(page) == Page.olx:
+                return save_cars_olx(driver, car_writer)
+            return False
     except Exception as e:
         print(f'Encountered problem on the page {page}, error message: {e}')
-    finally:
-        driver.quit()
+        return False
+
+
+def scrape_car_info_without_browser(page, max_age: float = None) -> Car | None:
+    """
+    Method sends plain request to the page and parses the car from the server-rendered html
+    :param page: Url of page to scrape
+    :param max_age: Maximum age of the cached page in seconds, if None the ttl of the cache is used
+    :return: Car object or None if the page could not be downloaded or parsed
+    """
+    try:
+        html = get_page(page, max_age)
+    except Exception as e:
+        print(f'Encountered problem on the page {page}, error message: {e}')
+        return None
+
+    return parse_car(page, html)
+
+
+def parse_car(page: str, html: str) -> Car | None:
+    """
+    Method parses the car from the html of the offer page
+    :param page: Url of the offer page
+    :param html: Html of the offer page
+    :return: Car object or None if the page is not the offer from the supported portal or could not be parsed
+    """
+    # Check if page is otomoto or olx
+    if get_portal(page) == Page.otomoto:
+        return parse_car_otomoto(page, html)
+    elif get_portal(page) == Page.olx:
+        return parse_car_olx(page, html)
+    return None
+
+
+def reparse_from_cache(cache_dir='.cache/responses', print_steps=True, chunk_size=500) -> int:
+    """
+    Method rebuilds the cars from all the offer pages stored in the response cache, without any request.
+    Cars already in the database are overwritten, so the changed parser can be applied to the scraped offers
+    :param cache_dir: Directory of the response cache
+    :param print_steps: If True, method will print the steps it's taking
+    :param chunk_size: Number of cars written to the database in one transaction
+    :return: Number of rebuilt cars
+    """
+    cache = ResponseCache(cache_dir, ttl=None)
+    listing_pages = (get_listing_url(Page.otomoto), get_listing_url(Page.olx))
+    cars, n_rebuilt, n_skipped = [], 0, 0
+    for page, html, _ in cache.iter_entries():
+        if page.split('?')[0] in listing_pages:
+            continue
+        car = parse_car(page, html)
+        if not has_required_fields(car):
+            n_skipped += 1
+            continue
+        cars.append(car)
+        if len(cars) >= chunk_size:
+            n_rebuilt += car_repo.upsert_cars(cars, chunk_size)
+            cars.clear()
+    n_rebuilt += car_repo.upsert_cars(cars, chunk_size)
+    # Overwritten cars are not tracked by the peer-price aggregates, so they are computed again
+    peer_price_repo.rebuild_aggregates()
+
+    if print_steps:
+        print(f'Rebuilt {n_rebuilt} cars from the response cache, skipped {n_skipped} pages with missing fields')
+    return n_rebuilt
+
+
+def save_car(car: Car, car_writer: CarWriter = None) -> None:
+    """
+    Method that saves the car with the buffered writer or directly to the database when there is no writer
+    :param car: Car to save
+    :param car_writer: Buffered writer to store the car with
+    :return: None
+    """
+    if car_writer is not None:
+        car_writer.add(car)
+    else:
+        car_repo.add_car_if_not_exists(car)  # Add car to the database
 
 
-def save_cars_otomoto(driver) -> None:
+def save_cars_otomoto(driver, car_writer: CarWriter = None) -> bool:
     """
     Method that saves cars to the database with Selenium driver for Otomoto
     :param driver: Selenium WebDriver
+    :param car_writer: Buffered writer to store the car with
+    :return: True if the car was saved
     """
     try:
         # Dictionary to store label-value pairs
@@ -203,10 +545,6 @@ def save_cars_otomoto(driver) -> None:
         # Find all div elements with specific class
         details = driver.find_elements(By.CSS_SELECTOR, 'div.ooa-162vy3d.e18eslyg3')
 
-        location_element = driver.find_elements(By.XPATH, '//a[@class="edhv9y51 ooa-oxkwx3"]')
-        location_element = [element for element in location_element
-                            if 'Przejdź do' not in element.text and 'Zobacz więcej' not in element.text]
-
         # Filter the details list to keep only the elements that have labels we want to keep
         details = [detail for detail in details if detail.find_element(By.CSS_SELECTOR, 'p.e18eslyg4.ooa-12b2ph5').text.strip() in labels_to_find_otomoto]
 
@@ -225,36 +563,23 @@ def save_cars_otomoto(driver) -> None:
                 car_details[label] = value
 
         # Create car object
-        car = Car(
-            link=driver.current_url,
-            brand=car_details[labels_to_find_otomoto[0]] if labels_to_find_otomoto[0] in car_details else None,
-            model=car_details[labels_to_find_otomoto[1]] if labels_to_find_otomoto[1] in car_details else None,
-            mileage=int(car_details[labels_to_find_otomoto[2]].replace('km', '').replace(' ', '')) if labels_to_find_otomoto[2] in car_details else None,
-            engine_capacity=int(car_details[labels_to_find_otomoto[3]].replace('cm3', '').replace(' ', '')) if labels_to_find_otomoto[3] in car_details else None,
-            engine_power=int(car_details[labels_to_find_otomoto[4]].replace('KM', '').replace(' ', '')) if labels_to_find_otomoto[4] in car_details else None,
-            year=int(car_details[labels_to_find_otomoto[5]]) if labels_to_find_otomoto[5] in car_details else None,
-            fuel_type=car_details[labels_to_find_otomoto[6]] if labels_to_find_otomoto[6] in car_details else None,
-            gearbox=car_details[labels_to_find_otomoto[7]] if labels_to_find_otomoto[7] in car_details else None,
-            body_type=car_details[labels_to_find_otomoto[8]] if labels_to_find_otomoto[8] in car_details else None,
-            colour=car_details[labels_to_find_otomoto[9]] if labels_to_find_otomoto[9] in car_details else None,
-            type_of_color=car_details[labels_to_find_otomoto[10]] if labels_to_find_otomoto[10] in car_details else None,
-            accident_free=car_details[labels_to_find_otomoto[11]] if labels_to_find_otomoto[11] in car_details else None,
-            state=car_details[labels_to_find_otomoto[12]] if labels_to_find_otomoto[12] in car_details else None,
-            price_pln=int(price_element.text.replace(' ', '')) if price_element else None,
-            location=location_element[0].text.strip() if len(location_element) > 0 else ''
-        )
+        car = build_car_otomoto(driver.current_url, car_details, price_element.text if price_element else None,
+                                get_location_otomoto(driver))
 
-        car_repo.add_car_if_not_exists(car)  # Add car to the database
+        save_car(car, car_writer)
+        return True
 
     except Exception as e:
         print(f'Encountered a problem while extracting car data from page {driver.current_url}, error message: {e}')
+        return False
 
 
-def save_cars_olx(driver) -> None:
+def save_cars_olx(driver, car_writer: CarWriter = None) -> bool:
     """
     Method that saves cars to the database with Selenium.
     :param driver: Selenium WebDriver
-    :return: None
+    :param car_writer: Buffered writer to store the car with
+    :return: True if the car was saved
     """
     try:
 
@@ -270,23 +595,7 @@ def save_cars_olx(driver) -> None:
         # Get the price element
         price_element = driver.find_element(By.CSS_SELECTOR, 'h3.css-93ez2t')
 
-        # Wait for location element to be present
-        location_element = WebDriverWait(driver, 5).until(
-            EC.presence_of_element_located((By.XPATH, '//p[@class="css-1cju8pu er34gjf0"]'))
-        )
-
-        # Wait for region elements to be present
-        region_element = WebDriverWait(driver, 5).until(
-            EC.presence_of_all_elements_located((By.XPATH, '//p[@class="css-b5m1rv er34gjf0"]'))
-        )
-        location = ''
-        if location_element:
-            location += location_element.text.strip()
-            if location.endswith(','):
-                location = location[:-1]
-        if region_element:
-            if region_element[-1] != 'Więcej od tego ogłoszeniodawcy':
-                location += ' - ' + region_element[-1].text.strip()
+        location = get_location_olx(driver)
 
         # Find all list items with class "css-1r0si1e"
         list_items = driver.find_elements(By.CSS_SELECTOR, 'li.css-1r0si1e')
@@ -302,83 +611,101 @@ def save_cars_olx(driver) -> None:
                 car_details[label] = value
 
         # Create car object
-        car = Car(
-            link=driver.current_url,
-            brand=brand_element[1].text.strip() if len(brand_element) > 0 else None,
-            model=car_details[labels_to_find_olx[0]] if labels_to_find_olx[0] in car_details else None,
-            mileage=int(car_details[labels_to_find_olx[1]].replace('km', '').replace(' ', '')) if labels_to_find_olx[1] in car_details else None,
-            engine_capacity=int(car_details[labels_to_find_olx[2]].replace('cm³', '').replace(' ', '')) if labels_to_find_olx[2] in car_details else None,
-            engine_power=int(car_details[labels_to_find_olx[3]].replace('KM', '').replace(' ', '')) if labels_to_find_olx[3] in car_details else None,
-            year=int(car_details[labels_to_find_olx[4]]) if labels_to_find_olx[4] in car_details else None,
-            fuel_type=car_details[labels_to_find_olx[5]] if labels_to_find_olx[5] in car_details else None,
-            gearbox=car_details[labels_to_find_olx[6]] if labels_to_find_olx[6] in car_details else None,
-            body_type=car_details[labels_to_find_olx[7]] if labels_to_find_olx[7] in car_details else None,
-            colour=car_details[labels_to_find_olx[8]] if labels_to_find_olx[8] in car_details else None,
-            type_of_color=None,
-            accident_free=car_details[labels_to_find_olx[9]] if labels_to_find_olx[9] in car_details else None,
-            state=None,
-            price_pln=int(price_element.text.strip().replace(' ', '').replace('zł', '')) if price_element else None,
-            location=location
-        )
+        car = build_car_olx(driver.current_url, brand_element[1].text.strip() if len(brand_element) > 1 else None,
+                            car_details, price_element.text if price_element else None, location)
 
-        # Set the state of the car based on mileage
-        if car.mileage < 500:
-            car.state = 'Nowy'
-        else:
-            car.state = 'Używany'
-
-        car_repo.add_car_if_not_exists(car)  # Add car to the database
+        save_car(car, car_writer)
+        return True
 
     except Exception as e:
         print(f'Encountered a problem while extracting car data from the page {driver.current_url}, error message: {e}')
+        return False
 
 
-def set_missing_locations() -> None:
+def get_location_otomoto(driver) -> str:
     """
-    Method needed after db update (Added location row to Car table)
-    :return: None
+    Method that returns the location of the car from the Otomoto offer loaded in Selenium driver
+    :param driver: Selenium WebDriver
+    :return: Location of the car or empty string if not found
     """
-    cars = car_repo.get_all_cars()
-    chrome_options = webdriver.ChromeOptions()
-    chrome_options.add_argument('--headless')
-    driver = webdriver.Chrome(options=chrome_options)
-    for car in cars[15531:]:
-        try:
-            driver.get(car.link)
+    location_element = driver.find_elements(By.XPATH, '//a[@class="edhv9y51 ooa-oxkwx3"]')
+    location_element = [element for element in location_element
+                        if 'Przejdź do' not in element.text and 'Zobacz więcej' not in element.text]
+    return location_element[0].text.strip() if len(location_element) > 0 else ''
 
-            print(f'Updating the location for car with id {car.id}...')
-            # Check if page is otomoto or olx
-            if str(Page.otomoto_url.value) in car.link:
-                location_element = driver.find_elements(By.XPATH, '//a[@class="edhv9y51 ooa-oxkwx3"]')
-                location_element = [element for element in location_element
-                                    if 'Przejdź do' not in element.text and 'Zobacz więcej' not in element.text]
-                car.location = (location_element[0].text.strip() if len(location_element) > 0 else '')
-            elif str(Page.olx.value) in car.link:
-                # Wait for location element to be present
-                location_element = WebDriverWait(driver, 5).until(
-                    EC.presence_of_element_located((By.XPATH, '//p[@class="css-1cju8pu er34gjf0"]'))
-                )
-                # Wait for region elements to be present
-                region_element = WebDriverWait(driver, 5).until(
-                    EC.presence_of_all_elements_located((By.XPATH, '//p[@class="css-b5m1rv er34gjf0"]'))
-                )
-                car.location = ''
-                if location_element:
-                    car.location += location_element.text.strip()
-                    if car.location.endswith(','):
-                        car.location = car.location[:-1]
-                if region_element:
-                    if region_element[-1] != 'Więcej od tego ogłoszeniodawcy':
-                        car.location += ' - ' + region_element[-1].text.strip()
-            else:
-                continue
-            print(car.location)
-            car_repo.update_car(car)
-        except Exception as e:
-            print(f'Encountered problem on the page {car.link}, error message: {e}\n')
-            driver.quit()  # Close the browser
-            driver = webdriver.Chrome(options=chrome_options)
-            continue
 
-        print(f'    Delay after car at link {car.link}...\n')
-        time.sleep(random.uniform(1.0, 1.5))  # Wait some time delay to mimic human behavior
+def get_location_olx(driver) -> str:
+    """
+    Method that returns the location of the car ("City - Region") from the Olx offer loaded in Selenium driver
+    :param driver: Selenium WebDriver
+    :return: Location of the car
+    """
+    # Wait for location element to be present
+    location_element = WebDriverWait(driver, 5).until(
+        EC.presence_of_element_located((By.XPATH, '//p[@class="css-1cju8pu er34gjf0"]'))
+    )
+    # Wait for region elements to be present
+    region_element = WebDriverWait(driver, 5).until(
+        EC.presence_of_all_elements_located((By.XPATH, '//p[@class="css-b5m1rv er34gjf0"]'))
+    )
+    location = ''
+    if location_element:
+        location += location_element.text.strip()
+        if location.endswith(','):
+            location = location[:-1]
+    if region_element:
+        if region_element[-1].text.strip() != 'Więcej od tego ogłoszeniodawcy':
+            location += ' - ' + region_element[-1].text.strip()
+    return location
+
+
+def set_missing_locations(job_name='set_missing_locations', max_attempts=3, chunk_size=100) -> None:
+    """
+    Method needed after db update (Added location row to Car table). The progress is stored in the crawl job,
+    so the interrupted run continues with the cars that were not updated yet
+    :param job_name: Name of the crawl job storing the progress
+    :param max_attempts: Maximum number of attempts for the car that could not be updated
+    :param chunk_size: Number of locations written to the database in one transaction
+    :return: None
+    """
+    job_id = crawl_repo.get_or_create_job(job_name)
+    # Links are streamed from the database in batches, so the memory use does not grow with the table
+    crawl_repo.add_urls(job_id, car_repo.iter_links(missing_location=True), crawl_repo.LOCATION)
+
+    locations, done_links = [], []
+
+    def flush() -> None:
+        # Locations are written before the urls are marked as done, so the interrupted run never loses an update
+        car_repo.update_cars(locations, chunk_size)
+        crawl_repo.mark_urls(job_id, done_links, True)
+        locations.clear()
+        done_links.clear()
+
+    with DriverPool() as driver_pool:
+        while links := crawl_repo.get_pending_urls(job_id, crawl_repo.LOCATION, max_attempts, limit=1000):
+            car_ids = car_repo.get_ids_by_links(links)
+            for link in links:
+                # Check if page is otomoto or olx
+                portal = get_portal(link)
+                if link not in car_ids or portal is None:
+                    done_links.append(link)
+                    continue
+                try:
+                    # The browser that could not be started fails only this car, not the whole job
+                    with driver_pool.lease() as driver:
+                        load_page(driver, link)
+
+                        print(f'Updating the location for car with id {car_ids[link]}...')
+                        location = get_location_otomoto(driver) if portal == Page.otomoto else get_location_olx(driver)
+                        print(location)
+                        locations.append((car_ids[link], {'location': location}))
+                        done_links.append(link)
+                except Exception as e:
+                    # Broken driver is health-checked and restarted by the pool when it is given back
+                    print(f'Encountered problem on the page {link}, error message: {e}\n')
+                    crawl_repo.mark_url(job_id, link, False, str(e))
+                if len(done_links) >= chunk_size:
+                    flush()
+            flush()
+
+    crawl_repo.finish_job(job_id)
@@ -1,3 +1,15 @@
+import operator
+import re
+from functools import reduce
+from unidecode import unidecode
+
+# Voivodeships of Poland, normalized (see normalize)
+VOIVODESHIPS = {
+    'dolnoslaskie', 'kujawsko-pomorskie', 'lubelskie', 'lubuskie', 'lodzkie', 'malopolskie', 'mazowieckie', 'opolskie',
+    'podkarpackie', 'podlaskie', 'pomorskie', 'slaskie', 'swietokrzyskie', 'warminsko-mazurskie', 'wielkopolskie',
+    'zachodniopomorskie',
+}
+
 
 def get_average_price(cars):
     """
@@ -7,3 +19,86 @@ def get_average_price(cars):
     """
     prices = [car.price_pln for car in cars]
     return sum(prices) / len(prices) if prices else None
+
+
+def normalize(text) -> str:
+    """
+    Normalize the text for lookups: transliterate to ASCII, lower-case and strip the whitespaces
+    :param text: Text to normalize (None is treated as empty text)
+    :return: Normalized text, e.g. 'Łódzkie' -> 'lodzkie'
+    """
+    return unidecode(str(text)).lower().strip() if text is not None else ''
+
+
+def parse_location(location) -> tuple[str | None, str | None]:
+    """
+    Parse the location of the offer to the normalized city and voivodeship. Olx locations are
+    "City[, District] - Voivodeship", Otomoto ones are "[Street, ][Postal code ]City[, Voivodeship]"
+    :param location: Location of the car
+    :return: (city, voivodeship) pair with None for the part that was not found, e.g. 'Łódź - Łódzkie' ->
+        ('lodz', 'lodzkie')
+    """
+    text = normalize(location)
+    # Hyphen is the separator only with the whitespace around it, the hyphenated city names do not have it
+    olx = re.search(r'\s-(\s|$)', text) is not None
+    parts = [re.sub(r'^(woj\.|wojewodztwo)\s*', '', part.strip()) for part in re.split(r',|\s-(?=\s|$)', text)]
+    parts = [part for part in parts if part]
+    voivodeships = [i for i, part in enumerate(parts) if part in VOIVODESHIPS]
+    voivodeship = parts[voivodeships[-1]] if voivodeships else None
+
+    # City is the first part in the Olx location and the part right before the voivodeship in the Otomoto one
+    city_parts = parts[:voivodeships[-1]] if voivodeships else parts
+    city = (city_parts[0] if olx else city_parts[-1]) if city_parts else None
+    city = re.sub(r'^\d{2}-\d{3}\s*', '', city) if city is not None else None
+    return city or None, voivodeship
+
+
+def location_mask(cars_df, locations: list[str]):
+    """
+    Select the cars of the DataFrame (with the city and voivodeship columns) in any of the locations, matched
+    the same way as the database filters match them (see car_repository)
+    :param cars_df: DataFrame with the cars
+    :param locations: Locations to find, e.g. ['Łódzkie', 'Kraków']
+    :return: Boolean Series of the cars in the locations or None if no location is given
+    """
+    masks = []
+    for city, voivodeship in map(parse_location, locations):
+        conditions = [cars_df[column] == value
+                      for column, value in (('city', city), ('voivodeship', voivodeship)) if value is not None]
+        if conditions:
+            masks.append(reduce(operator.and_, conditions))
+    return reduce(operator.or_, masks) if masks else None
+
+
+def filter_mask(cars_df, brand, model, min_year, max_year, min_mileage, max_mileage, fuel_type, gearbox, status,
+                location):
+    """
+    Select the cars of the DataFrame matching the filters of car_repository.get_all_cars_filtered, matched the same
+    way as in the database (needs the brand_norm, model_norm, year, mileage, fuel_type, gearbox, state, city and
+    voivodeship columns)
+    :param cars_df: DataFrame with the cars
+    :param brand: brand of the car (part of it, e.g. 'mercedes' matches 'Mercedes-Benz')
+    :param model: models of the car (parts of them, e.g. '3' matches 'Seria 3')
+    :param min_year: minimum year of the car
+    :param max_year: maximum year of the car
+    :param min_mileage: minimum mileage of the car (in km)
+    :param max_mileage: maximum mileage of the car (in km)
+    :param fuel_type: fuel types of the car
+    :param gearbox: gearboxes of the car
+    :param status: used or new
+    :param location: locations of the car
+    :return: Boolean Series of the matching cars
+    """
+    mask = ((cars_df['year'] >= min_year) & (cars_df['year'] <= max_year)
+            & (cars_df['mileage'] >= min_mileage) & (cars_df['mileage'] <= max_mileage))
+    if normalize(brand):
+        mask &= cars_df['brand_norm'].str.contains(normalize(brand), regex=False, na=False)
+    if models := [normalize(m) for m in model if normalize(m)]:
+        mask &= cars_df['model_norm'].str.contains('|'.join(map(re.escape, models)), na=False)
+    for column, values in (('fuel_type', fuel_type), ('gearbox', gearbox), ('state', [status])):
+        if values := [value for value in values if value]:
+            mask &= cars_df[column].str.contains('|'.join(map(re.escape, values)), case=False, na=False)
+    if (locations := location_mask(cars_df, location)) is not None:
+        mask &= locations
+    # Missing values of the nullable columns do not match
+    return mask.fillna(False).astype(bool)
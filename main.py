@@ -1,22 +1,144 @@
-def main():
-    from car_scraping.scraper import scrape_n_pages, Page
-    from car_scraping.brand_analizer import get_brands_with_best_price
+"""
+Command line interface of the car scraping project. Every subcommand imports only the modules it needs,
+so the quick lookups do not pay for importing the scraper (selenium, requests) or the plotting libraries
+"""
+import argparse
+import sys
+
+
+def init_db(args=None) -> None:
+    # Create or migrate the database schema, only the subcommands using the database need it
+    from repository.db_connection import init_db as init_schema
+    init_schema()
+
+
+def scrape(args) -> None:
+    init_db()
+    from car_scraping.scraper import Page
+
+    if args.workers > 1:
+        from car_scraping.coordinator import crawl_sharded
+        crawl_sharded({Page[portal]: (args.start_page, args.pages) for portal in args.portal},
+                      n_workers=args.workers, print_steps=not args.quiet, async_fetch=args.async_fetch,
+                      n_drivers=args.drivers, skip_known=not args.no_skip_known, cache_dir=args.cache_dir)
+        return
+
+    from car_scraping.scraper import scrape_n_pages
+    for portal in args.portal:
+        stats = scrape_n_pages(Page[portal], args.pages, args.start_page, not args.quiet, args.async_fetch,
+                               n_drivers=args.drivers, skip_known=not args.no_skip_known, job_name=args.job,
+                               cache_dir=args.cache_dir)
+        print(f'Scraped {portal}: {stats}')
+
+
+def analyze(args) -> None:
+    if args.snapshot is None:
+        init_db()
     from car_scraping.data_analizer import analise_data
-    from car_scraping.scraper import set_missing_locations
+    analise_data(args.plots, args.snapshot)
+
+
+def best_price(args) -> None:
+    # The snapshot is read without the database, unless the cars are compared with the aggregates stored in it
+    if args.snapshot is None or args.aggregates:
+        init_db()
+    from car_scraping.brand_analizer import get_brands_with_best_price
+    get_brands_with_best_price(args.brand, args.model or [''], args.min_year, args.max_year,
+                               args.min_mileage, args.max_mileage, args.fuel_type or [''], args.gearbox or [''],
+                               args.status, args.location or [''], args.search, args.snapshot, args.aggregates,
+                               args.workers)
+
+
+def backfill(args) -> None:
+    init_db()
+    if args.job == 'locations':
+        from car_scraping.scraper import set_missing_locations
+        set_missing_locations()
+    elif args.job == 'clean-locations':
+        from car_scraping.backfills import clean_locations
+        clean_locations()
+    elif args.job == 'olx-states':
+        from car_scraping.backfills import derive_olx_states
+        derive_olx_states()
+    elif args.job == 'reparse':
+        from car_scraping.scraper import reparse_from_cache
+        reparse_from_cache(args.cache_dir)
+    elif args.job == 'peer-prices':
+        from repository.peer_price_repository import rebuild_aggregates
+        print(f'Rebuilt {rebuild_aggregates()} peer-price aggregates')
+    elif args.job == 'snapshot':
+        from repository.snapshot import export_snapshot
+        export_snapshot(args.snapshot, full=args.full)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='app', description='Scraping and analysis of the car offers from '
+                                                             'otomoto.pl and olx.pl')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scrape_parser = subparsers.add_parser('scrape', help='Scrape the car offers')
+    scrape_parser.add_argument('portal', nargs='+', choices=['otomoto', 'olx'], help='Portals to scrape')
+    scrape_parser.add_argument('--pages', type=int, default=1, help='Number of listing pages to scrape')
+    scrape_parser.add_argument('--start-page', type=int, default=1, help='Number of the first listing page')
+    scrape_parser.add_argument('--async-fetch', action='store_true', help='Download the listing pages concurrently')
+    scrape_parser.add_argument('--drivers', type=int, default=1, help='Number of car pages scraped in parallel')
+    scrape_parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (sharded crawl)')
+    scrape_parser.add_argument('--job', help='Name of the resumable crawl job (not with --workers > 1)')
+    scrape_parser.add_argument('--cache-dir', help='Directory of the response cache')
+    scrape_parser.add_argument('--no-skip-known', action='store_true',
+                               help='Scrape the known offers again to record their price changes')
+    scrape_parser.add_argument('--quiet', action='store_true', help='Do not print the steps of the crawl')
+    scrape_parser.set_defaults(handler=scrape)
+
+    analyze_parser = subparsers.add_parser('analyze', help='Print the statistics of the scraped cars')
+    analyze_parser.add_argument('--plots', action='store_true', help='Show the plots of the data')
+    analyze_parser.add_argument('--snapshot', help='Directory of the Parquet snapshot to read instead of the database')
+    analyze_parser.set_defaults(handler=analyze)
+
+    best_price_parser = subparsers.add_parser('best-price', help='Find the cars cheaper than the similar ones')
+    best_price_parser.add_argument('brand', help='Brand of the car, e.g. bmw')
+    best_price_parser.add_argument('--model', action='append', help='Model of the car (can be repeated)')
+    best_price_parser.add_argument('--min-year', type=int, default=1885)
+    best_price_parser.add_argument('--max-year', type=int, default=2050)
+    best_price_parser.add_argument('--min-mileage', type=int, default=0)
+    best_price_parser.add_argument('--max-mileage', type=int, default=1000000)
+    best_price_parser.add_argument('--fuel-type', action='append', help='Fuel type of the car (can be repeated)')
+    best_price_parser.add_argument('--gearbox', action='append', help='Gearbox of the car (can be repeated)')
+    best_price_parser.add_argument('--status', default='', help='Used or new')
+    best_price_parser.add_argument('--location', action='append', help='Location to compare locally (can be repeated)')
+    best_price_parser.add_argument('--search', help='Free-form text the cars have to match, e.g. "seria 3 kombi"')
+    best_price_parser.add_argument('--snapshot', help='Directory of the Parquet snapshot to read instead of the database')
+    best_price_parser.add_argument('--aggregates', action='store_true',
+                                   help='Compare the cars with the peer-price aggregates of all the stored cars')
+    best_price_parser.add_argument('--workers', type=int, default=1,
+                                   help='Number of worker processes comparing the cars (split by brand and model)')
+    best_price_parser.set_defaults(handler=best_price)
 
-    # Scrape the cars
-    # scrape_n_pages(Page.olx_url, 10, 1, 1.0, 2.0, True)
-    # scrape_n_pages(Page.otomoto_url, 20, 1, 1.0, 2.0, True)
+    backfill_parser = subparsers.add_parser('backfill', help='Re-derive the columns of the stored cars')
+    backfill_parser.add_argument('job', choices=['locations', 'clean-locations', 'olx-states', 'reparse', 'peer-prices',
+                                                 'snapshot'],
+                                 help='locations: scrape the missing locations, clean-locations: clean the stored '
+                                      'locations, olx-states: derive the state of olx cars, reparse: rebuild the cars '
+                                      'from the response cache, peer-prices: rebuild the peer-price aggregates, '
+                                      'snapshot: export the cars to the Parquet snapshot')
+    backfill_parser.add_argument('--cache-dir', default='.cache/responses', help='Directory of the response cache')
+    backfill_parser.add_argument('--snapshot', default='.snapshot/cars', help='Directory of the Parquet snapshot')
+    backfill_parser.add_argument('--full', action='store_true', help='Export the whole snapshot again')
+    backfill_parser.set_defaults(handler=backfill)
 
-    # Analyze the repository
-    # analise_data(True)
+    init_db_parser = subparsers.add_parser('init-db', help='Create the database schema or migrate the existing one')
+    init_db_parser.set_defaults(handler=init_db)
+    return parser
 
-    # Analyze given brand with best prices
-    get_brands_with_best_price('bmw', [''], 2006, 2024,
-                               0, 300000, [], [], '', ['Łódzkie'])
 
-    # set_missing_locations()
+def main(argv: list[str] = None) -> None:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'scrape' and args.workers > 1 and args.job is not None:
+        # Frontier of the job would be written by many processes, see coordinator.crawl_sharded
+        parser.error('--job is not supported with --workers > 1 (the sharded crawl does not resume jobs)')
+    args.handler(args)
 
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1:])
@@ -1,87 +1,412 @@
-from sqlalchemy import or_
-from sqlalchemy.exc import IntegrityError
+import re
+from collections.abc import Callable, Iterable, Iterator
+from itertools import groupby, islice
+from sqlalchemy import and_, bindparam, func, inspect, literal_column, or_, select, table, text, update
 import car_scraping.car as scrap
-from repository.models import Car
-from repository.db_connection import Session
+from car_scraping.utils import normalize, parse_location
+from repository.models import Car, CATEGORICAL_COLUMNS, NORMALIZED_COLUMNS, normalized_columns
+from repository.migrations import CARS_FTS
+from repository.db_connection import Session, engine, insert
+from repository import category_repository as category_repo
+from repository import observation_repository as observation_repo
+from repository import peer_price_repository as peer_price_repo
+
+# Columns searched by the free-form text search, the ones without the normalized copy are matched as they are
+SEARCH_COLUMNS = [Car.brand_norm, Car.model_norm, Car.location_norm, Car.body_type, Car.fuel_type]
+
+# Pandas dtypes of the columns loaded by load_cars_frame. Categorical columns are decoded from their ids and the other
+# text columns (except the unique link) are dictionary-encoded while they are loaded, both to pandas Categorical
+FRAME_DTYPES = {
+    'id': 'int64',
+    'mileage': 'Int32',
+    'engine_capacity': 'Int32',
+    'engine_power': 'Int32',
+    'year': 'Int32',
+    'price_pln': 'Int32',
+    'link': 'object',
+    **{f'{column}_id': 'Int32' for column in CATEGORICAL_COLUMNS},
+}
+
+# All the columns of the car loaded by default, the categorical ones by their names (they are read by their ids)
+FRAME_COLUMNS = [name.removesuffix('_id') if name.removesuffix('_id') in CATEGORICAL_COLUMNS else name
+                 for name in Car.__table__.columns.keys()]
+
+_full_text_index = False
 
 
 def get_all_cars() -> list[Car]:
+    return list(iter_cars())
+
+
+def iter_cars(columns: list[str] = None, where=None, batch_size=1000) -> Iterator:
+    # Cars in the order of id, read in batches with keyset pagination (WHERE id > last id of the previous batch).
+    # Every batch has its own short session, so the memory use does not grow with the table and no read transaction
+    # is held while the caller works on the cars. With columns the cars are read as lightweight rows (named tuples,
+    # always starting with id) instead of ORM entities. Errors are raised, so the caller never takes the stream
+    # stopped by the error for all the cars
+    entities = [Car.id, *[getattr(Car, column) for column in columns if column != 'id']] if columns else [Car]
+    last_id = None
+    while True:
+        session = Session()
+        try:
+            query = select(*entities).order_by(Car.id).limit(batch_size)
+            if where is not None:
+                query = query.where(where)
+            if last_id is not None:
+                query = query.where(Car.id > last_id)
+            result = session.execute(query)
+            batch = result.scalars().all() if columns is None else result.all()
+        finally:
+            session.close()
+
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].id
+
+
+def get_car_by_link(link: str) -> Car | None:
     session = Session()
     try:
-        return session.query(Car).all()
+        return session.scalar(select(Car).where(Car.link == link))
     except Exception as e:
-        print(f'An error occurred while getting all cars:\n    {e}')
-        return []
+        print(f'An error occurred while getting car by link:\n    {e}')
+        return None
+    finally:
+        session.close()
+
+
+def get_ids_by_links(links: list[str]) -> dict[str, int]:
+    session = Session()
+    try:
+        return dict(session.execute(select(Car.link, Car.id).where(Car.link.in_(links))).tuples().all())
+    except Exception as e:
+        print(f'An error occurred while getting ids of cars by links:\n    {e}')
+        return {}
+    finally:
+        session.close()
+
+
+def iter_links(missing_location=False, batch_size=10000) -> Iterator[str]:
+    where = or_(Car.location.is_(None), Car.location == '') if missing_location else None
+    return (row.link for row in iter_cars(['link'], where, batch_size))
+
+
+def count_cars() -> int:
+    session = Session()
+    try:
+        return session.scalar(select(func.count(Car.id)))
+    except Exception as e:
+        print(f'An error occurred while counting cars:\n    {e}')
+        return 0
     finally:
         session.close()
 
 
 def get_all_cars_filtered(brand, model, min_year, max_year, min_mileage, max_mileage,
-                          fuel_type, gearbox, status, location) -> list[Car]:
+                          fuel_type, gearbox, status, location, search: str = None) -> list[Car]:
+    return list(iter_cars_filtered(brand, model, min_year, max_year, min_mileage, max_mileage,
+                                   fuel_type, gearbox, status, location, search))
+
+
+def iter_cars_filtered(brand, model, min_year, max_year, min_mileage, max_mileage, fuel_type, gearbox, status,
+                       location, search: str = None, columns: list[str] = None, batch_size=1000) -> Iterator:
+    # Streaming version of get_all_cars_filtered, see iter_cars
+    filters = _car_filters(brand, model, min_year, max_year, min_mileage, max_mileage,
+                           fuel_type, gearbox, status, location, search)
+    return iter_cars(columns, and_(*filters), batch_size)
+
+
+def load_cars_frame(columns: list[str], where=None, chunk_size=50000):
+    # Cars (matching the condition) as the DataFrame with the compact dtypes (see FRAME_DTYPES). The Core select of the
+    # columns is streamed from the cursor in chunks and every chunk is converted to the typed arrays right away, so the
+    # rows are never held as the objects and the repeated texts are stored once. Errors of the query are raised
+    import numpy as np
+    import pandas as pd
+
+    # A column requested twice (also by its id) is read once
+    query_columns = list(dict.fromkeys(category_repo.encoded_columns(columns)))
+    codes = {column: {} for column in query_columns if column not in FRAME_DTYPES}
+    chunks = {column: [] for column in query_columns}
     session = Session()
     try:
-        model_filters = or_(*[Car.model.like(f'%{m}%') for m in model if m])
-        fuel_type_filters = or_(*[Car.fuel_type.like(f'%{f_t}%') for f_t in fuel_type if f_t])
-        gearbox_filters = or_(*[Car.gearbox.like(f'%{g}%') for g in gearbox if g])
-        location_filters = or_(*[Car.location.like(f'%{loc}%') for loc in location if loc])
-
-        return session.query(Car).filter(
-            Car.brand.like(f'%{brand}%'),
-            model_filters,
-            Car.year >= min_year,
-            Car.year <= max_year,
-            Car.mileage >= min_mileage,
-            Car.mileage <= max_mileage,
-            fuel_type_filters,
-            gearbox_filters,
-            Car.state.like(f'%{status}%'),
-            location_filters
-        ).all()
+        query = select(*[getattr(Car, column) for column in query_columns]).order_by(Car.id)
+        if where is not None:
+            query = query.where(where)
+        # Core execution on the connection, so the rows do not go through the ORM loading
+        result = session.connection().execute(query, execution_options={'stream_results': True,
+                                                                           'yield_per': chunk_size})
+        for rows in result.partitions():
+            for column, values in zip(query_columns, zip(*rows)):
+                if column in codes:
+                    # Codes of the chunk are mapped to the codes of the whole load (None stays -1, missing value)
+                    chunk_codes, uniques = pd.factorize(np.array(values, dtype=object))
+                    value_codes = codes[column]
+                    mapping = np.array([value_codes.setdefault(value, len(value_codes)) for value in uniques] + [-1],
+                                       dtype=np.int32)
+                    chunks[column].append(mapping[chunk_codes])
+                else:
+                    chunks[column].append(pd.array(values, dtype=FRAME_DTYPES[column]))
+    finally:
+        session.close()
+
+    frame = {}
+    for column in query_columns:
+        if column in codes:
+            column_codes = np.concatenate(chunks[column]) if chunks[column] else np.array([], dtype=np.int32)
+            frame[column] = pd.Categorical.from_codes(column_codes, categories=list(codes[column]))
+        elif chunks[column]:
+            frame[column] = pd.concat([pd.Series(chunk) for chunk in chunks[column]], ignore_index=True)
+        else:
+            frame[column] = pd.Series([], dtype=FRAME_DTYPES[column])
+    cars_df = pd.DataFrame(frame)
+    return category_repo.decode_categoricals(cars_df)
+
+
+def load_cars_filtered(brand, model, min_year, max_year, min_mileage, max_mileage, fuel_type, gearbox, status,
+                       location, search: str = None, columns: list[str] = None):
+    # DataFrame version of get_all_cars_filtered, see load_cars_frame
+    filters = _car_filters(brand, model, min_year, max_year, min_mileage, max_mileage,
+                           fuel_type, gearbox, status, location, search)
+    return load_cars_frame(columns or FRAME_COLUMNS, and_(*filters))
+
+
+def load_cars_filtered_any(filters: list[dict], columns: list[str]):
+    # Cars matching any of the filters (keyword arguments of get_all_cars_filtered) loaded with one query, for the
+    # callers evaluating many filters on the same cars, see load_cars_frame
+    return load_cars_frame(columns, or_(*[and_(*_car_filters(**car_filter)) for car_filter in filters]))
+
+
+def search_car_ids(query: str, limit=None) -> list[int]:
+    # Ids of the cars whose brand, model, location, body type or fuel type contain words starting with every word
+    # of the query, e.g. 'seria 3 lodzkie'. Full-text index is used when SQLite supports it
+    session = Session()
+    try:
+        condition = _text_search_condition(query)
+        if condition is None:
+            return []
+        return list(session.scalars(select(Car.id).where(condition).order_by(Car.id).limit(limit)))
     except Exception as e:
-        print(f'An error occurred while getting all cars by brand and model:\n    {e}')
+        print(f'An error occurred while searching cars:\n    {e}')
         return []
     finally:
         session.close()
 
 
+def has_full_text_index() -> bool:
+    # Only the existing index is remembered, so the index created later by init_db is found
+    global _full_text_index
+    if not _full_text_index:
+        _full_text_index = engine.dialect.name == 'sqlite' and CARS_FTS in inspect(engine).get_table_names()
+    return _full_text_index
+
+
+def _text_search_condition(query: str = None):
+    # Condition matching the words of the free-form query in all the search columns
+    words = re.findall(r'\w+', normalize(query))
+    if not words:
+        return None
+
+    if has_full_text_index():
+        match_ids = (select(literal_column('rowid')).select_from(table(CARS_FTS))
+                     .where(text(f'{CARS_FTS} MATCH :match')
+                            .bindparams(match=' AND '.join(f'"{word}"*' for word in words))))
+        return Car.id.in_(match_ids)
+    return and_(*[or_(*[column.ilike(f'%{word}%') for column in SEARCH_COLUMNS]) for word in words])
+
+
+def _location_condition(locations: list[str]):
+    # Condition matching any of the locations by equality on the parsed city and voivodeship, e.g. 'Łódzkie' matches
+    # the voivodeship, 'Łódź' the city and 'Łódź, Łódzkie' both (see car_scraping.utils.location_mask)
+    conditions = []
+    for city, voivodeship in map(parse_location, locations):
+        condition = [column == value for column, value in ((Car.city, city), (Car.voivodeship, voivodeship))
+                     if value is not None]
+        if condition:
+            conditions.append(and_(*condition))
+    return or_(*conditions) if conditions else None
+
+
+def _car_filters(brand, model, min_year, max_year, min_mileage, max_mileage,
+                 fuel_type, gearbox, status, location, search: str = None) -> list:
+    # Brand and models match the cars whose brand and model contain them (on the normalized columns). They are matched
+    # by equality with the existing values containing them, so the filter is a range scan of the (brand_norm,
+    # model_norm, year, mileage) index. Other columns are checked only on the rows found in it, the categorical ones
+    # by their ids (see category_repository.matching_ids)
+    filters = [Car.year >= min_year, Car.year <= max_year, Car.mileage >= min_mileage, Car.mileage <= max_mileage]
+    brand_filters = []
+    if brand_norm := normalize(brand):
+        brand_filters.append(Car.brand_norm.in_(_matching_brands(brand_norm)))
+    filters += brand_filters
+    if models := [normalize(m) for m in model if normalize(m)]:
+        model_condition = or_(*[Car.model_norm.contains(m, autoescape=True) for m in models])
+        if brand_filters:
+            # Models of the brand are read from the index, the cars are then found by them
+            model_values = select(Car.model_norm).where(*brand_filters, model_condition).distinct().correlate(None)
+            filters.append(Car.model_norm.in_(model_values))
+        else:
+            filters.append(model_condition)
+    if fuel_types := [f_t for f_t in fuel_type if f_t]:
+        filters.append(Car.fuel_type_id.in_(category_repo.matching_ids('fuel_type', fuel_types)))
+    if gearboxes := [g for g in gearbox if g]:
+        filters.append(Car.gearbox_id.in_(category_repo.matching_ids('gearbox', gearboxes)))
+    if status:
+        filters.append(Car.state_id.in_(category_repo.matching_ids('state', [status])))
+    location_condition = _location_condition([loc for loc in location if loc])
+    if location_condition is not None:
+        filters.append(location_condition)
+    text_condition = _text_search_condition(search)
+    if text_condition is not None:
+        filters.append(text_condition)
+    return filters
+
+
+def _matching_brands(brand_norm: str) -> list[str]:
+    # Normalized brands containing the normalized brand, found in the few distinct brands of the category values
+    return sorted({normalize(value) for value in category_repo.get_values('brand')[1] if brand_norm in normalize(value)})
+
+
 def add_car_if_not_exists(new_car: scrap.Car) -> None:
-    session = Session()
     try:
-        new_car = Car(
-            link=new_car.link,
-            brand=new_car.brand,
-            model=new_car.model,
-            mileage=new_car.mileage,
-            engine_capacity=new_car.engine_capacity,
-            engine_power=new_car.engine_power,
-            year=new_car.year,
-            fuel_type=new_car.fuel_type,
-            gearbox=new_car.gearbox,
-            body_type=new_car.body_type,
-            colour=new_car.colour,
-            type_of_color=new_car.type_of_color,
-            accident_free=new_car.accident_free,
-            state=new_car.state,
-            price_pln=new_car.price_pln,
-            location=new_car.location
-        )
-        session.add(new_car)
-        session.commit()
-    except IntegrityError:
-        session.rollback()  # Rollback the transaction in case of IntegrityError (duplicate entry)
+        inserted, changed = ingest_cars([new_car])
+    except Exception as e:
+        print(f'An error occurred while adding Car to database:\n    {e}')
+        return
+    if not inserted and not changed:
         print(f'Duplicate entry: {new_car} already exists in the database.')
+
+
+def ingest_cars(new_cars: list[scrap.Car], chunk_size=500) -> tuple[int, int]:
+    # New cars are inserted and for the known ones (by link) only the changes of the price, mileage and state are
+    # written: to the car and as the observation in its history. Peer-price aggregates are updated with the inserted
+    # and the changed cars. Every chunk is written in one transaction, so the aggregates never miss the cars of the
+    # interrupted write, and the errors are raised (nothing of the failed chunk is stored).
+    # Returns (number of inserted, number of changed) cars
+    inserted, changed = 0, 0
+    for i in range(0, len(new_cars), chunk_size):
+        # The last observation of the link in the chunk wins
+        cars_by_link = {car.link: car for car in new_cars[i:i + chunk_size]}
+        # Category values are added before the transaction (see category_repository.get_ids), in it they are cached
+        rows = category_repo.encode_rows([car_to_row(car) for car in cars_by_link.values()])
+        session = Session()
+        try:
+            connection = session.connection()
+            observed = observation_repo.select_observed_values(connection, list(cars_by_link))
+            new_rows = [row for row in rows if row['link'] not in observed]
+            if new_rows:
+                statement = insert(Car).on_conflict_do_nothing(index_elements=[Car.link])
+                inserted += connection.execute(statement, new_rows).rowcount
+
+            observed_at = observation_repo.now()
+            observations, updates, added_prices, removed_prices = [], [], [], []
+            new_ids = connection.execute(select(Car.link, Car.id)
+                                         .where(Car.link.in_([row['link'] for row in new_rows]))) if new_rows else []
+            for link, car_id in new_ids:
+                observations.append({'car_id': car_id, 'observed_at': observed_at,
+                                     **_observation_values(cars_by_link[link], observation_repo.OBSERVED_COLUMNS)})
+                added_prices.append(vars(cars_by_link[link]))
+            for link, row in observed.items():
+                values = {column: getattr(cars_by_link[link], column) for column in observation_repo.OBSERVED_COLUMNS
+                          if getattr(cars_by_link[link], column) not in (None, getattr(row, column))}
+                if not values:
+                    continue
+                if not row.has_history:
+                    # Car stored before its history was recorded, its previous values were observed at unknown time
+                    observations.append({'car_id': row.id,
+                                         **_observation_values(row, observation_repo.OBSERVED_COLUMNS)})
+                observations.append({'car_id': row.id, 'observed_at': observed_at,
+                                     **_observation_values(cars_by_link[link], values)})
+                updates.append((row.id, values))
+                removed_prices.append(row._asdict())
+                added_prices.append({**row._asdict(), **values})
+            observation_repo.insert_observations(connection, observations)
+            changed += _update_rows(connection, updates, peer_prices=False)
+            peer_price_repo.write_deltas(connection, added_prices, removed_prices)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    return inserted, changed
+
+
+def _observation_values(car, columns) -> dict:
+    return {observation_repo.OBSERVED_COLUMNS[column]: getattr(car, column) for column in columns}
+
+
+def add_cars_if_not_exist(new_cars: list[scrap.Car], chunk_size=500) -> int:
+    # One INSERT ... ON CONFLICT DO NOTHING and one transaction per chunk, duplicates (by link) are skipped
+    session = Session()
+    inserted = 0
+    try:
+        statement = insert(Car).on_conflict_do_nothing(index_elements=[Car.link])
+        for i in range(0, len(new_cars), chunk_size):
+            rows = category_repo.encode_rows([car_to_row(new_car) for new_car in new_cars[i:i + chunk_size]])
+            inserted += session.connection().execute(statement, rows).rowcount
+            session.commit()
+        return inserted
     except Exception as e:
         # Rollback changes if error occurs
-        print(f'An error occurred while adding Car to database:\n    {e}')
+        print(f'An error occurred while adding Cars to database:\n    {e}')
         session.rollback()
+        return inserted
     finally:
         session.close()
 
 
+def upsert_cars(cars: list[scrap.Car], chunk_size=500) -> int:
+    # Existing cars (by link) are overwritten with the new values. Peer-price aggregates are not updated, the caller
+    # rebuilds them after the cars are written (see peer_price_repository.rebuild_aggregates)
+    session = Session()
+    upserted = 0
+    try:
+        statement = insert(Car)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Car.link],
+            set_={column: statement.excluded[column]
+                  for column in category_repo.encoded_columns(list(car_to_row(cars[0]))) if column != 'link'}
+        ) if cars else None
+        for i in range(0, len(cars), chunk_size):
+            rows = category_repo.encode_rows([car_to_row(car) for car in cars[i:i + chunk_size]])
+            upserted += session.connection().execute(statement, rows).rowcount
+            session.commit()
+        return upserted
+    except Exception as e:
+        print(f'An error occurred while upserting Cars to database:\n    {e}')
+        session.rollback()
+        return upserted
+    finally:
+        session.close()
+
+
+def car_to_row(car: scrap.Car) -> dict:
+    return {
+        'link': car.link,
+        'brand': car.brand,
+        'model': car.model,
+        'mileage': car.mileage,
+        'engine_capacity': car.engine_capacity,
+        'engine_power': car.engine_power,
+        'year': car.year,
+        'fuel_type': car.fuel_type,
+        'gearbox': car.gearbox,
+        'body_type': car.body_type,
+        'colour': car.colour,
+        'type_of_color': car.type_of_color,
+        'accident_free': car.accident_free,
+        'state': car.state,
+        'price_pln': car.price_pln,
+        'location': car.location,
+        **normalized_columns(car.brand, car.model, car.location)
+    }
+
+
 def update_car(car: Car) -> None:
+    # Peer-price aggregates are moved from the previous values of the car to the new ones
     session = Session()
     try:
-        session.query(Car).filter(Car.id == car.id).update({
+        values = {
             'link': car.link,
             'brand': car.brand,
             'model': car.model,
@@ -97,11 +422,89 @@ def update_car(car: Car) -> None:
             'accident_free': car.accident_free,
             'state': car.state,
             'price_pln': car.price_pln,
-            'location': car.location
-        })
+            'location': car.location,
+        }
+        previous = _peer_values(session.connection(), [car.id])
+        session.query(Car).filter(Car.id == car.id).update(category_repo.encode_rows([{
+            **values, **normalized_columns(car.brand, car.model, car.location)
+        }])[0])
+        peer_price_repo.write_deltas(session.connection(), [{**previous[car.id], **values}] if previous else [],
+                                     previous.values())
         session.commit()
     except Exception as e:
         print(f'An error occurred while updating Car in database:\n    {e}')
         session.rollback()
     finally:
         session.close()
+
+
+def update_cars(changes: Iterable[tuple[int, dict]], chunk_size=500, peer_prices=True) -> int:
+    # Partial update of many cars: (id, {column: new value}) pairs are written with executemany, one transaction per
+    # chunk, and only the given columns are set. Normalized copies and category ids of the changed columns are
+    # updated with them. Peer-price aggregates of the cars with the changed key or price are moved from their previous
+    # values to the new ones, unless peer_prices is False (the caller updates them, see ingest_cars)
+    session = Session()
+    updated = 0
+    try:
+        changes = iter(changes)
+        while chunk := list(islice(changes, chunk_size)):
+            updated += _update_rows(session.connection(), chunk, peer_prices)
+            session.commit()
+        return updated
+    except Exception as e:
+        print(f'An error occurred while updating Cars in database:\n    {e}')
+        session.rollback()
+        return updated
+    finally:
+        session.close()
+
+
+def backfill_cars(derive: Callable[..., dict | None], columns: list[str], where=None,
+                  batch_size=1000, chunk_size=500) -> int:
+    # Generic backfill: every car (matching the condition) is streamed as the row of the columns and derive returns
+    # its new values. Only the values that differ from the current ones are written with update_cars
+    def changes() -> Iterator[tuple[int, dict]]:
+        for row in iter_cars(columns, where, batch_size):
+            values = derive(row) or {}
+            values = {column: value for column, value in values.items()
+                      if column not in row._fields or getattr(row, column) != value}
+            if values:
+                yield row.id, values
+
+    return update_cars(changes(), chunk_size)
+
+
+def _update_rows(connection, changes: list[tuple[int, dict]], peer_prices=True) -> int:
+    # Changes of the cars (see update_cars) written in the transaction of the connection, with the changes of their
+    # peer-price aggregates
+    peer_changes = {car_id: values for car_id, values in changes
+                    if peer_prices and not values.keys().isdisjoint(peer_price_repo.CAR_COLUMNS)}
+    previous = _peer_values(connection, list(peer_changes)) if peer_changes else {}
+    rows = category_repo.encode_rows([{'car_id': car_id, **values, **_changed_normalized_columns(values)}
+                                      for car_id, values in changes])
+    updated = 0
+    # Executemany needs the same columns in every row, so the rows are grouped by their set of columns
+    rows.sort(key=lambda row: sorted(row))
+    for columns, group in groupby(rows, key=lambda row: sorted(row)):
+        statement = (update(Car.__table__).where(Car.__table__.c.id == bindparam('car_id'))
+                     .values({column: bindparam(column) for column in columns if column != 'car_id'}))
+        updated += connection.execute(statement, list(group)).rowcount
+    peer_price_repo.write_deltas(connection,
+                                 [{**values, **peer_changes[car_id]} for car_id, values in previous.items()],
+                                 previous.values())
+    return updated
+
+
+def _peer_values(connection, car_ids: list[int]) -> dict[int, dict]:
+    # Current values of the peer-price columns of the cars, by their id. The columns are labeled, so the categorical
+    # ones keep their names in the rows of the connection
+    columns = [getattr(Car, column).label(column) for column in peer_price_repo.CAR_COLUMNS]
+    rows = connection.execute(select(Car.id, *columns).where(Car.id.in_(car_ids))).all()
+    return {row.id: {column: getattr(row, column) for column in peer_price_repo.CAR_COLUMNS} for row in rows}
+
+
+def _changed_normalized_columns(values: dict) -> dict:
+    normalized = normalized_columns(values.get('brand'), values.get('model'), values.get('location'))
+    return {normalized_column: normalized[normalized_column]
+            for column, derived_columns in NORMALIZED_COLUMNS.items() if column in values
+            for normalized_column in derived_columns}
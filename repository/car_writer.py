@@ -0,0 +1,134 @@
+"""
+file that contains the write-behind buffer which collects the scraped cars and stores them in the database
+in chunks on the background thread, so scraping never waits for the database
+"""
+import queue
+import threading
+import time
+from collections.abc import Callable
+import car_scraping.car as scrap
+from repository import car_repository as car_repo
+from repository.known_links import KnownLinks
+
+
+class CarWriter:
+    """
+    Buffered, write-behind ingestion of the scraped cars. Cars are flushed to the database when the buffer reaches
+    chunk_size, when the oldest buffered car waited flush_interval seconds, or explicitly with flush() and close()
+    """
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, chunk_size=200, flush_interval=5., known_links: KnownLinks = None):
+        """
+        :param chunk_size: Number of cars written in one transaction
+        :param flush_interval: Maximum time in seconds the cars wait in the buffer
+        :param known_links: Index of known links updated with the link of every stored car
+        """
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.known_links = known_links
+        self.n_inserted = 0
+        self.n_changed = 0  # Number of known cars with the changed price, mileage or state
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='car-writer', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, car: scrap.Car, on_written: Callable[[], None] = None) -> None:
+        """
+        Method that adds the car to the buffer, it never blocks on the database
+        :param car: Car to store
+        :param on_written: Function called on the writer thread after the chunk with the car is committed (never when
+            the chunk could not be written), e.g. to mark the car as done in the crawl job only when it cannot be lost
+            anymore
+        :return: None
+        """
+        if self._closed:
+            raise RuntimeError('Car writer is already closed')
+        if self.known_links is not None:
+            self.known_links.add(car.link)
+        self._queue.put((car, on_written))
+
+    def flush(self) -> None:
+        """
+        Method that blocks until all cars added so far are written to the database
+        :return: None
+        """
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done))
+        done.wait()
+
+    def close(self) -> None:
+        """
+        Method that flushes the buffer and stops the background thread
+        :return: None
+        """
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self) -> None:
+        buffer, callbacks = [], []
+        deadline = None  # Time by which the oldest buffered car has to be written, None for the empty buffer
+        while True:
+            try:
+                item = self._queue.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                self._write(buffer, callbacks)
+                return
+            if item is not None and item[0] is self._FLUSH:
+                self._write(buffer, callbacks)
+                deadline = None
+                item[1].set()
+                continue
+
+            if item is not None:
+                car, on_written = item
+                buffer.append(car)
+                if on_written is not None:
+                    callbacks.append(on_written)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if buffer and (len(buffer) >= self.chunk_size or time.monotonic() >= deadline):
+                self._write(buffer, callbacks)
+                deadline = None
+
+    def _write(self, buffer: list, callbacks: list) -> None:
+        # The callbacks are called only when the cars are committed. The chunk that could not be written is dropped
+        # (its pages stay pending in the crawl job) and the thread goes on, so flush() never waits for a dead thread
+        if not buffer:
+            return
+        try:
+            inserted, changed = car_repo.ingest_cars(buffer, self.chunk_size)
+        except Exception as e:
+            print(f'An error occurred while writing {len(buffer)} cars to database:\n    {e}')
+            buffer.clear()
+            callbacks.clear()
+            return
+        if changed:
+            print(f'Recorded the changed price, mileage or state of {changed} cars that already exist in the database.')
+        if inserted + changed < len(buffer):
+            print(f'Skipped {len(buffer) - inserted - changed} unchanged cars that already exist in the database.')
+        self.n_inserted += inserted
+        self.n_changed += changed
+        buffer.clear()
+        for on_written in callbacks:
+            try:
+                on_written()
+            except Exception as e:
+                print(f'An error occurred while confirming the written car:\n    {e}')
+        callbacks.clear()
@@ -0,0 +1,91 @@
+from collections.abc import Iterable
+from sqlalchemy import or_, select
+from repository.models import CategoryValue, CATEGORICAL_COLUMNS
+from repository.db_connection import Session, insert
+
+# Ids of the category values by (category, value). Values are only ever added to the table, so the cached ids stay valid
+_ids: dict[tuple[str, str], int] = {}
+
+
+def get_ids(category: str, values: Iterable[str | None]) -> dict[str, int]:
+    # Ids of the values of the categorical column, the values missing in the table are added to it. Errors are raised,
+    # the car written without the id of its value would lose the value
+    values = {value for value in values if value is not None}
+    missing = [value for value in values if (category, value) not in _ids]
+    if missing:
+        session = Session()
+        try:
+            statement = insert(CategoryValue).on_conflict_do_nothing(
+                index_elements=[CategoryValue.category, CategoryValue.value])
+            session.connection().execute(statement, [{'category': category, 'value': value} for value in missing])
+            session.commit()
+            rows = session.execute(select(CategoryValue.value, CategoryValue.id)
+                                   .where(CategoryValue.category == category, CategoryValue.value.in_(missing)))
+            _ids.update(((category, value), value_id) for value, value_id in rows)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    return {value: _ids[category, value] for value in values if (category, value) in _ids}
+
+
+def encode_rows(rows: list[dict]) -> list[dict]:
+    # Replaces the values of the categorical columns present in the rows with their <column>_id (in place), the cars
+    # table stores only the ids. Returns the rows
+    for category in CATEGORICAL_COLUMNS:
+        ids = get_ids(category, (row[category] for row in rows if category in row))
+        for row in rows:
+            if category in row:
+                row[f'{category}_id'] = ids.get(row.pop(category))
+    return rows
+
+
+def encoded_columns(columns: list[str]) -> list[str]:
+    # Columns to read with the categorical columns replaced by their ids, see decode_categoricals
+    return [f'{column}_id' if column in CATEGORICAL_COLUMNS else column for column in columns]
+
+
+def get_values(category: str) -> tuple[list[int], list[str]]:
+    # Ids and values of the categorical column, in the order of id
+    session = Session()
+    try:
+        rows = session.execute(select(CategoryValue.id, CategoryValue.value)
+                               .where(CategoryValue.category == category).order_by(CategoryValue.id)).all()
+        return [row.id for row in rows], [row.value for row in rows]
+    except Exception as e:
+        print(f'An error occurred while getting category values:\n    {e}')
+        return [], []
+    finally:
+        session.close()
+
+
+def matching_ids(category: str, patterns: list[str]):
+    # Subquery of the ids of the values containing any of the patterns. The patterns are matched in the small lookup
+    # table and the cars are filtered by the integer ids
+    return (select(CategoryValue.id)
+            .where(CategoryValue.category == category,
+                   or_(*[CategoryValue.value.like(f'%{pattern}%') for pattern in patterns])))
+
+
+def decode_categoricals(cars_df):
+    # Replaces the <column>_id columns of the DataFrame (in place) with the pandas Categorical columns of the values,
+    # built directly from the ids without creating the string of every row. Returns the DataFrame
+    import numpy as np
+    import pandas as pd
+
+    for category in CATEGORICAL_COLUMNS:
+        id_column = f'{category}_id'
+        if id_column not in cars_df.columns:
+            continue
+        ids, values = get_values(category)
+        # Position of every id in the values, -1 (missing value) for the unknown ids. The last slot is never an id,
+        # so the missing ids of the cars are mapped to it
+        positions = np.full(max(ids, default=0) + 2, -1, dtype=np.int32)
+        positions[ids] = np.arange(len(ids), dtype=np.int32)
+        car_ids = pd.to_numeric(cars_df[id_column]).fillna(-1).to_numpy(dtype=np.int64)
+        codes = positions[np.where((car_ids >= 0) & (car_ids < len(positions)), car_ids, -1)]
+        position = cars_df.columns.get_loc(id_column)
+        cars_df.drop(columns=id_column, inplace=True)
+        cars_df.insert(position, category, pd.Categorical.from_codes(codes, categories=values))
+    return cars_df
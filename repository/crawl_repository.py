@@ -0,0 +1,122 @@
+from collections.abc import Iterable
+from itertools import islice
+from sqlalchemy import func, or_, select, update
+from repository.models import CrawlJob, CrawlUrl
+from repository.db_connection import Session, insert
+
+# Kinds of the urls in the crawl frontier
+LISTING = 'listing'
+DETAIL = 'detail'
+LOCATION = 'location'
+
+# Statuses of the urls in the crawl frontier
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_or_create_job(name: str) -> int:
+    session = Session()
+    try:
+        session.execute(insert(CrawlJob).values(name=name).on_conflict_do_nothing(index_elements=[CrawlJob.name]))
+        session.commit()
+        return session.scalar(select(CrawlJob.id).where(CrawlJob.name == name))
+    finally:
+        session.close()
+
+
+def add_urls(job_id: int, urls: Iterable[str], kind: str, chunk_size=1000) -> None:
+    # Urls already present in the job keep their status, so adding them again is a no-op. Errors (also of the streamed
+    # urls) are raised, the job with the partial frontier would be finished without the missing urls
+    session = Session()
+    try:
+        statement = insert(CrawlUrl).on_conflict_do_nothing(index_elements=[CrawlUrl.job_id, CrawlUrl.url])
+        urls = iter(url for url in urls if url)
+        while chunk := list(islice(urls, chunk_size)):
+            session.connection().execute(statement, [{'job_id': job_id, 'url': url, 'kind': kind,
+                                                      'status': PENDING, 'attempts': 0} for url in chunk])
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_pending_urls(job_id: int, kind: str, max_attempts: int, urls: list[str] = None, limit=None) -> list[str]:
+    # Pending urls and failed urls that did not run out of attempts, in the order they were added
+    session = Session()
+    try:
+        query = select(CrawlUrl.url).where(
+            CrawlUrl.job_id == job_id,
+            CrawlUrl.kind == kind,
+            or_(CrawlUrl.status == PENDING, (CrawlUrl.status == FAILED) & (CrawlUrl.attempts < max_attempts))
+        ).order_by(CrawlUrl.id).limit(limit)
+        if urls is not None:
+            pending = set(session.scalars(query.where(CrawlUrl.url.in_(urls))))
+            return [url for url in urls if url in pending]
+        return list(session.scalars(query))
+    except Exception as e:
+        print(f'An error occurred while getting pending urls of the crawl job:\n    {e}')
+        return []
+    finally:
+        session.close()
+
+
+def mark_url(job_id: int, url: str, succeeded: bool, error: str = None) -> None:
+    session = Session()
+    try:
+        session.execute(update(CrawlUrl).where(CrawlUrl.job_id == job_id, CrawlUrl.url == url).values(
+            status=DONE if succeeded else FAILED,
+            attempts=CrawlUrl.attempts + 1,
+            last_error=None if succeeded else error
+        ))
+        session.commit()
+    except Exception as e:
+        print(f'An error occurred while updating the url of the crawl job:\n    {e}')
+        session.rollback()
+    finally:
+        session.close()
+
+
+def mark_urls(job_id: int, urls: list[str], succeeded: bool, error: str = None) -> None:
+    # Same as mark_url for many urls at once, in one transaction
+    if not urls:
+        return
+    session = Session()
+    try:
+        session.execute(update(CrawlUrl).where(CrawlUrl.job_id == job_id, CrawlUrl.url.in_(urls)).values(
+            status=DONE if succeeded else FAILED,
+            attempts=CrawlUrl.attempts + 1,
+            last_error=None if succeeded else error
+        ))
+        session.commit()
+    except Exception as e:
+        print(f'An error occurred while updating the urls of the crawl job:\n    {e}')
+        session.rollback()
+    finally:
+        session.close()
+
+
+def get_job_progress(job_id: int) -> dict[tuple[str, str], int]:
+    # Number of urls of the job by (kind, status)
+    session = Session()
+    try:
+        rows = session.execute(select(CrawlUrl.kind, CrawlUrl.status, func.count(CrawlUrl.id))
+                               .where(CrawlUrl.job_id == job_id)
+                               .group_by(CrawlUrl.kind, CrawlUrl.status))
+        return {(kind, status): count for kind, status, count in rows}
+    finally:
+        session.close()
+
+
+def finish_job(job_id: int) -> None:
+    session = Session()
+    try:
+        session.execute(update(CrawlJob).where(CrawlJob.id == job_id).values(finished_at=func.now()))
+        session.commit()
+    except Exception as e:
+        print(f'An error occurred while finishing the crawl job:\n    {e}')
+        session.rollback()
+    finally:
+        session.close()
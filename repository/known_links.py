@@ -0,0 +1,76 @@
+"""
+file that contains the index of offer links already stored in the database, used to skip the known offers
+before any detail page is fetched
+"""
+import hashlib
+import math
+from repository import car_repository as car_repo
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set of strings. It never misses the added string, but with probability error_rate
+    it reports the string that was never added
+    """
+
+    def __init__(self, capacity: int, error_rate=0.001):
+        """
+        :param capacity: Expected number of added strings
+        :param error_rate: Probability of false positive when the filter holds capacity strings
+        """
+        capacity = max(capacity, 1)
+        self.n_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.n_hashes = max(int(round(self.n_bits / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, value: str):
+        # Double hashing, the positions are derived from the two halves of a single digest
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class KnownLinks:
+    """
+    Index of the offer links that are already stored in the database. It is backed by the hash set by default
+    or by the Bloom filter for very large tables (rare false positives mean that some new offers are skipped)
+    """
+
+    def __init__(self, links=(), use_bloom_filter=False, expected_size=0, error_rate=0.001):
+        """
+        :param links: Links to put in the index
+        :param use_bloom_filter: If True, the index is backed by the Bloom filter instead of the set
+        :param expected_size: Expected number of links, used to size the Bloom filter
+        :param error_rate: False positive rate of the Bloom filter
+        """
+        if use_bloom_filter:
+            # Leave room for the links added while scraping
+            self._links = BloomFilter(max(expected_size * 2, 100000), error_rate)
+        else:
+            self._links = set()
+        for link in links:
+            self.add(link)
+
+    @classmethod
+    def load(cls, use_bloom_filter=False, error_rate=0.001) -> 'KnownLinks':
+        """
+        Method that loads the index with all the links from the cars table
+        :param use_bloom_filter: If True, the index is backed by the Bloom filter instead of the set
+        :param error_rate: False positive rate of the Bloom filter
+        :return: Loaded index
+        """
+        return cls(car_repo.iter_links(), use_bloom_filter, car_repo.count_cars(), error_rate)
+
+    def add(self, link: str) -> None:
+        if link:
+            self._links.add(link)
+
+    def __contains__(self, link: str) -> bool:
+        return link in self._links
@@ -0,0 +1,244 @@
+"""
+file that contains the migrations of the existing databases to the current models. create_all only creates the missing
+tables, so the columns and indexes added to the existing tables (and the SQLite full-text index) are created here and
+the columns no longer in the models are dropped
+"""
+from sqlalchemy import (Float, bindparam, cast, column, delete, exists, func, insert, inspect, literal, select, table,
+                        text, update)
+from sqlalchemy.orm import aliased
+from car_scraping.utils import parse_location
+from repository.models import (Base, Car, CategoryValue, CATEGORICAL_COLUMNS, MILEAGE_BUCKET, PeerPriceAggregate,
+                               normalized_columns)
+
+# Columns added to the cars table after it was created, with their SQL type
+CAR_COLUMNS = {
+    'brand_norm': 'VARCHAR',
+    'model_norm': 'VARCHAR',
+    'location_norm': 'VARCHAR',
+    'city': 'VARCHAR',
+    'voivodeship': 'VARCHAR',
+    **{f'{column}_id': 'INTEGER REFERENCES category_values(id)' for column in CATEGORICAL_COLUMNS},
+}
+
+# Text columns of the categorical columns stored in the cars table before only their ids were kept, they are dropped
+# from the existing databases once their ids are set
+LEGACY_CAR_COLUMNS = CATEGORICAL_COLUMNS
+
+# Full-text index of the cars, it reads the values from the view of the cars (external content) and is kept in sync
+# with the cars table by the triggers. Normalized columns are indexed, so 'Łódzkie' and 'lodzkie' find the same cars.
+# Values of the categorical columns are read from the category_values table by their ids
+CARS_FTS = 'cars_fts'
+CARS_FTS_CONTENT = 'cars_fts_content'
+CARS_FTS_COLUMNS = {
+    'brand_norm': '{row}.brand_norm',
+    'model_norm': '{row}.model_norm',
+    'location_norm': '{row}.location_norm',
+    'body_type': '(SELECT value FROM category_values WHERE id = {row}.body_type_id)',
+    'fuel_type': '(SELECT value FROM category_values WHERE id = {row}.fuel_type_id)',
+}
+
+
+def migrate(engine) -> None:
+    """
+    Method that adds the missing columns and indexes to the existing tables and fills the added columns.
+    Running it on the up-to-date database does nothing
+    :param engine: Engine of the database
+    :return: None
+    """
+    existing_columns = {column['name'] for column in inspect(engine).get_columns(Car.__tablename__)}
+    missing_columns = [name for name in CAR_COLUMNS if name not in existing_columns]
+    legacy_columns = [name for name in LEGACY_CAR_COLUMNS if name in existing_columns]
+    with engine.begin() as connection:
+        for name in missing_columns:
+            connection.execute(text(f'ALTER TABLE {Car.__tablename__} ADD COLUMN {name} {CAR_COLUMNS[name]}'))
+    # Ids are set first, the other backfills read the values of the categorical columns by them
+    if legacy_columns:
+        backfill_category_ids(engine, legacy_columns)
+    if any(name.endswith('_norm') for name in missing_columns):
+        backfill_normalized_columns(engine)
+    if 'city' in missing_columns or 'voivodeship' in missing_columns:
+        backfill_locations(engine)
+    if legacy_columns:
+        drop_legacy_columns(engine, legacy_columns)
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    if engine.dialect.name == 'sqlite':
+        create_full_text_index(engine)
+
+    # Aggregates table created in the existing database is filled from its cars
+    with engine.connect() as connection:
+        has_aggregates = connection.scalar(select(PeerPriceAggregate.n_cars).limit(1)) is not None
+        has_cars = connection.scalar(select(Car.id).limit(1)) is not None
+    if has_cars and not has_aggregates:
+        rebuild_peer_price_aggregates(engine)
+
+
+def create_full_text_index(engine) -> bool:
+    """
+    Method that creates the FTS5 index of the cars with the triggers keeping it in sync and fills it with the existing
+    cars. Running it when the index exists does nothing
+    :param engine: Engine of the SQLite database
+    :return: True if the index exists, False if SQLite is compiled without FTS5
+    """
+    if CARS_FTS in inspect(engine).get_table_names():
+        return True
+    columns = ', '.join(CARS_FTS_COLUMNS)
+    content_values = ', '.join(f'{value.format(row="cars")} AS {name}' for name, value in CARS_FTS_COLUMNS.items())
+    new_values = ', '.join(value.format(row='new') for value in CARS_FTS_COLUMNS.values())
+    old_values = ', '.join(value.format(row='old') for value in CARS_FTS_COLUMNS.values())
+    delete_old = (f"INSERT INTO {CARS_FTS}({CARS_FTS}, rowid, {columns}) "
+                  f"VALUES ('delete', old.id, {old_values});")
+    insert_new = f"INSERT INTO {CARS_FTS}(rowid, {columns}) VALUES (new.id, {new_values});"
+    try:
+        with engine.begin() as connection:
+            connection.execute(text(f'CREATE VIEW IF NOT EXISTS {CARS_FTS_CONTENT} AS '
+                                    f'SELECT cars.id AS id, {content_values} FROM cars'))
+            connection.execute(text(f"CREATE VIRTUAL TABLE {CARS_FTS} USING fts5({columns}, "
+                                    f"content='{CARS_FTS_CONTENT}', content_rowid='id', "
+                                    f"tokenize='unicode61 remove_diacritics 2')"))
+            connection.execute(text(f'CREATE TRIGGER cars_fts_insert AFTER INSERT ON cars BEGIN {insert_new} END'))
+            connection.execute(text(f'CREATE TRIGGER cars_fts_delete AFTER DELETE ON cars BEGIN {delete_old} END'))
+            connection.execute(text(f'CREATE TRIGGER cars_fts_update AFTER UPDATE ON cars BEGIN '
+                                    f'{delete_old} {insert_new} END'))
+            connection.execute(text(f"INSERT INTO {CARS_FTS}({CARS_FTS}) VALUES ('rebuild')"))
+        return True
+    except Exception as e:
+        print(f'An error occurred while creating the full-text index of cars, text search falls back to LIKE:\n'
+              f'    {e}')
+        return False
+
+
+def backfill_normalized_columns(engine, chunk_size=5000) -> int:
+    """
+    Method that fills the normalized brand, model and location of the cars where they are missing. City and
+    voivodeship are left to backfill_locations, which parses every distinct location once
+    :param engine: Engine of the database
+    :param chunk_size: Number of cars updated in one transaction
+    :return: Number of updated cars
+    """
+    query = (select(Car.id, Car.brand, Car.model, Car.location)
+             .where(Car.brand_norm.is_(None), Car.brand.is_not(None) | Car.model.is_not(None)
+                    | Car.location.is_not(None))
+             .order_by(Car.id))
+    statement = update(Car.__table__).where(Car.__table__.c.id == bindparam('car_id'))
+    updated = 0
+    with engine.connect() as connection:
+        rows = connection.execute(query).all()
+        for i in range(0, len(rows), chunk_size):
+            connection.execute(statement, [{'car_id': car_id, **_normalized_text_columns(brand, model, location)}
+                                           for car_id, brand, model, location in rows[i:i + chunk_size]])
+            connection.commit()
+            updated += len(rows[i:i + chunk_size])
+    return updated
+
+
+def _normalized_text_columns(brand: str | None, model: str | None, location: str | None) -> dict:
+    return {column: value for column, value in normalized_columns(brand, model, location).items()
+            if column.endswith('_norm')}
+
+
+def backfill_locations(engine, chunk_size=5000) -> int:
+    """
+    Method that fills the city and voivodeship of the cars parsed from their location. Cars share few distinct
+    locations, so every distinct location is parsed once and the parsed values are spread to the cars by the codes
+    of their locations, without parsing the location of every car
+    :param engine: Engine of the database
+    :param chunk_size: Number of cars updated in one transaction
+    :return: Number of updated cars
+    """
+    import numpy as np
+    import pandas as pd
+
+    query = (select(Car.id, Car.location)
+             .where(Car.location.is_not(None), Car.city.is_(None), Car.voivodeship.is_(None)).order_by(Car.id))
+    statement = update(Car.__table__).where(Car.__table__.c.id == bindparam('car_id'))
+    updated = 0
+    with engine.connect() as connection:
+        cars = pd.read_sql(query, connection)
+        codes, locations = pd.factorize(cars['location'])
+        parsed = [parse_location(location) for location in locations]
+        cities = np.array([city for city, _ in parsed], dtype=object)[codes]
+        voivodeships = np.array([voivodeship for _, voivodeship in parsed], dtype=object)[codes]
+        found = [(car_id, city, voivodeship)
+                 for car_id, city, voivodeship in zip(cars['id'].tolist(), cities, voivodeships)
+                 if city is not None or voivodeship is not None]
+        for i in range(0, len(found), chunk_size):
+            connection.execute(statement, [{'car_id': car_id, 'city': city, 'voivodeship': voivodeship}
+                                           for car_id, city, voivodeship in found[i:i + chunk_size]])
+            connection.commit()
+            updated += len(found[i:i + chunk_size])
+    return updated
+
+
+def backfill_category_ids(engine, categories: list[str] = LEGACY_CAR_COLUMNS) -> int:
+    """
+    Method that adds the values of the legacy text columns of the cars to the category_values table and sets the ids
+    of the values where they are missing. Both are done by the set-based statements, one per column
+    :param engine: Engine of the database
+    :param categories: Categorical columns whose text columns are still in the cars table
+    :return: Number of the set ids (a car with several categorical columns is counted once per column)
+    """
+    updated = 0
+    with engine.begin() as connection:
+        for category in categories:
+            # Text column is no longer in the model, so the table is described with it here
+            cars = table(Car.__tablename__, column('id'), column(category), column(f'{category}_id'))
+            value_column, id_column = cars.c[category], cars.c[f'{category}_id']
+            is_known = exists().where(CategoryValue.category == category, CategoryValue.value == value_column)
+            new_values = select(literal(category), value_column).where(value_column.is_not(None), ~is_known).distinct()
+            connection.execute(insert(CategoryValue).from_select(['category', 'value'], new_values))
+            value_id = (select(CategoryValue.id)
+                        .where(CategoryValue.category == category, CategoryValue.value == value_column)
+                        .scalar_subquery())
+            updated += connection.execute(update(cars).where(id_column.is_(None), value_column.is_not(None))
+                                          .values({id_column: value_id})).rowcount
+    return updated
+
+
+def drop_legacy_columns(engine, columns: list[str]) -> None:
+    """
+    Method that drops the legacy text columns of the categorical columns from the cars table, their values are kept
+    in the category_values table (see backfill_category_ids). The SQLite full-text index reading them is dropped
+    first and created again over the ids by create_full_text_index, the freed space is returned by VACUUM
+    :param engine: Engine of the database
+    :param columns: Legacy columns present in the cars table
+    :return: None
+    """
+    with engine.begin() as connection:
+        if engine.dialect.name == 'sqlite':
+            for trigger in ('cars_fts_insert', 'cars_fts_delete', 'cars_fts_update'):
+                connection.execute(text(f'DROP TRIGGER IF EXISTS {trigger}'))
+            connection.execute(text(f'DROP TABLE IF EXISTS {CARS_FTS}'))
+        for name in columns:
+            connection.execute(text(f'ALTER TABLE {Car.__tablename__} DROP COLUMN {name}'))
+    if engine.dialect.name == 'sqlite':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('VACUUM'))
+
+
+def rebuild_peer_price_aggregates(engine) -> int:
+    """
+    Method that computes the peer-price aggregates of all the cars again, with one set-based statement
+    :param engine: Engine of the database
+    :return: Number of the aggregates
+    """
+    # Brand and gearbox are joined from the category values, so the cars are grouped by the values themselves
+    brand, gearbox = aliased(CategoryValue), aliased(CategoryValue)
+    columns = [brand.value, Car.model, gearbox.value, Car.year]
+    mileage_bucket = Car.mileage // MILEAGE_BUCKET
+    query = (select(*columns, mileage_bucket, func.count(Car.price_pln), func.sum(Car.price_pln),
+                    func.sum(cast(Car.price_pln, Float) * cast(Car.price_pln, Float)))
+             .select_from(Car)
+             .join(brand, brand.id == Car.brand_id)
+             .join(gearbox, gearbox.id == Car.gearbox_id)
+             .where(Car.model.is_not(None), Car.year.is_not(None), Car.mileage.is_not(None),
+                    Car.price_pln.is_not(None))
+             .group_by(*columns, mileage_bucket))
+    with engine.begin() as connection:
+        connection.execute(delete(PeerPriceAggregate))
+        return connection.execute(insert(PeerPriceAggregate).from_select(
+            ['brand', 'model', 'gearbox', 'year', 'mileage_bucket', 'n_cars', 'price_sum', 'price_sum_squares'], query
+        )).rowcount
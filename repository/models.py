@@ -1,26 +1,162 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Index, Integer, String, UniqueConstraint, func, select
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import column_property
+from car_scraping.utils import normalize, parse_location
 
 Base = declarative_base()
 
+# Columns of the car with few distinct values, their values are stored once in the category_values table and the
+# car references them by the id in the <column>_id column
+CATEGORICAL_COLUMNS = ['brand', 'fuel_type', 'gearbox', 'body_type', 'colour', 'type_of_color', 'accident_free',
+                       'state']
+
+
+class CategoryValue(Base):
+    __tablename__ = 'category_values'
+    __table_args__ = (
+        UniqueConstraint('category', 'value'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    category = Column(String, nullable=False)  # Name of the categorical column of the car
+    value = Column(String, nullable=False)
+
+
+def category_value(id_column):
+    # Value of the categorical column of the car read by its id, usable in the queries like the column itself
+    return column_property(select(CategoryValue.value).where(CategoryValue.id == id_column)
+                           .correlate_except(CategoryValue).scalar_subquery())
+
 
 class Car(Base):
     __tablename__ = 'cars'
+    __table_args__ = (
+        Index('ix_cars_brand_model_year_mileage', 'brand_norm', 'model_norm', 'year', 'mileage'),
+        Index('ix_cars_voivodeship_city', 'voivodeship', 'city'),
+        Index('ix_cars_city', 'city'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     link = Column(String, unique=True)
-    brand = Column(String)
     model = Column(String)
     mileage = Column(Integer)
     engine_capacity = Column(Integer)
     engine_power = Column(Integer)
     year = Column(Integer)
-    fuel_type = Column(String)
-    gearbox = Column(String)
-    body_type = Column(String)
-    colour = Column(String)
-    type_of_color = Column(String)
-    accident_free = Column(String)
-    state = Column(String)
     price_pln = Column(Integer)
     location = Column(String)
+    # Lower-cased and transliterated to ASCII copies of the columns used by the filters (see car_scraping.utils)
+    brand_norm = Column(String)
+    model_norm = Column(String)
+    location_norm = Column(String)
+    # Normalized city and voivodeship parsed from the location (see car_scraping.utils.parse_location)
+    city = Column(String)
+    voivodeship = Column(String)
+    # Ids of the values of the categorical columns in the category_values table (see CATEGORICAL_COLUMNS), only
+    # the ids are stored in the cars table
+    brand_id = Column(Integer, ForeignKey('category_values.id'))
+    fuel_type_id = Column(Integer, ForeignKey('category_values.id'))
+    gearbox_id = Column(Integer, ForeignKey('category_values.id'))
+    body_type_id = Column(Integer, ForeignKey('category_values.id'))
+    colour_id = Column(Integer, ForeignKey('category_values.id'))
+    type_of_color_id = Column(Integer, ForeignKey('category_values.id'))
+    accident_free_id = Column(Integer, ForeignKey('category_values.id'))
+    state_id = Column(Integer, ForeignKey('category_values.id'))
+    # Values of the categorical columns, read from the category_values table. They are written by their ids (see
+    # category_repository.encode_rows) and a query selecting them has to select some column of the car as well
+    brand = category_value(brand_id)
+    fuel_type = category_value(fuel_type_id)
+    gearbox = category_value(gearbox_id)
+    body_type = category_value(body_type_id)
+    colour = category_value(colour_id)
+    type_of_color = category_value(type_of_color_id)
+    accident_free = category_value(accident_free_id)
+    state = category_value(state_id)
+
+
+# Lookup columns of the car derived from its other columns, by the column they are derived from
+NORMALIZED_COLUMNS = {
+    'brand': ['brand_norm'],
+    'model': ['model_norm'],
+    'location': ['location_norm', 'city', 'voivodeship'],
+}
+
+
+def normalized_columns(brand: str | None, model: str | None, location: str | None) -> dict:
+    """
+    Method that returns the normalized lookup columns of the car
+    :param brand: Brand of the car
+    :param model: Model of the car
+    :param location: Location of the car
+    :return: Dictionary with brand_norm, model_norm, location_norm, city and voivodeship (None for the missing values)
+    """
+    city, voivodeship = parse_location(location)
+    return {
+        'brand_norm': normalize(brand) if brand is not None else None,
+        'model_norm': normalize(model) if model is not None else None,
+        'location_norm': normalize(location) if location is not None else None,
+        'city': city,
+        'voivodeship': voivodeship,
+    }
+
+
+class CrawlJob(Base):
+    __tablename__ = 'crawl_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, unique=True, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    finished_at = Column(DateTime)
+
+
+class CrawlUrl(Base):
+    __tablename__ = 'crawl_urls'
+    __table_args__ = (
+        UniqueConstraint('job_id', 'url'),
+        Index('ix_crawl_urls_job_kind_status', 'job_id', 'kind', 'status'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(Integer, ForeignKey('crawl_jobs.id'), nullable=False)
+    url = Column(String, nullable=False)
+    kind = Column(String, nullable=False)  # listing, detail or location
+    status = Column(String, nullable=False, default='pending')  # pending, done or failed
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class CarObservation(Base):
+    __tablename__ = 'car_observations'
+    __table_args__ = (
+        # Id is stored in the index of car_id, so the observations of the car are read in the order of insertion
+        Index('ix_car_observations_car_id', 'car_id'),
+        Index('ix_car_observations_observed_at', 'observed_at'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    car_id = Column(Integer, ForeignKey('cars.id'), nullable=False)
+    observed_at = Column(DateTime)  # None for the values the car had before its history was recorded
+    # Only the values that changed since the previous observation are stored, the unchanged ones are None
+    price_pln = Column(Integer)
+    mileage = Column(Integer)
+    status = Column(String)  # State of the car (used or new)
+
+
+# Size of the mileage buckets of the peer-price aggregates (in km)
+MILEAGE_BUCKET = 10000
+
+
+class PeerPriceAggregate(Base):
+    __tablename__ = 'peer_price_aggregates'
+
+    # Key of the similar cars, the primary key index finds the aggregates of the brand and model
+    brand = Column(String, primary_key=True)
+    model = Column(String, primary_key=True)
+    gearbox = Column(String, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    mileage_bucket = Column(Integer, primary_key=True)  # Mileage // MILEAGE_BUCKET
+    # Aggregates of the prices of the cars with the key
+    n_cars = Column(Integer, nullable=False, default=0)
+    price_sum = Column(Float, nullable=False, default=0.)
+    price_sum_squares = Column(Float, nullable=False, default=0.)
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import exists, insert, select
+from sqlalchemy.orm import aliased
+from repository.models import Car, CarObservation
+from repository.db_connection import Session
+
+# Columns of the car whose history is recorded, mapped to their column in the observations
+OBSERVED_COLUMNS = {'price_pln': 'price_pln', 'mileage': 'mileage', 'state': 'status'}
+
+
+def now() -> datetime:
+    # Observations are stored in UTC, the same as the timestamps set by the database
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_observed_values(links: list[str]) -> dict:
+    session = Session()
+    try:
+        return select_observed_values(session.connection(), links)
+    except Exception as e:
+        print(f'An error occurred while getting observed values of cars:\n    {e}')
+        return {}
+    finally:
+        session.close()
+
+
+def select_observed_values(connection, links: list[str]) -> dict:
+    # Current observed values of the known cars by link, with the flag telling if their history is recorded already
+    # and the other columns of their peer-price key (see peer_price_repository). The columns are labeled, so the
+    # categorical ones keep their names in the rows of the connection
+    has_history = exists().where(CarObservation.car_id == Car.id).label('has_history')
+    observed_columns = [getattr(Car, column).label(column) for column in OBSERVED_COLUMNS]
+    rows = connection.execute(select(Car.link, Car.id, *observed_columns, Car.brand.label('brand'), Car.model,
+                                     Car.gearbox.label('gearbox'), Car.year, has_history)
+                              .where(Car.link.in_(links)))
+    return {row.link: row for row in rows}
+
+
+def add_observations(observations: list[dict]) -> None:
+    session = Session()
+    try:
+        insert_observations(session.connection(), observations)
+        session.commit()
+    except Exception as e:
+        print(f'An error occurred while adding observations of cars:\n    {e}')
+        session.rollback()
+    finally:
+        session.close()
+
+
+def insert_observations(connection, observations: list[dict]) -> None:
+    # Observations written in the transaction of the connection, the missing values are None
+    if not observations:
+        return
+    rows = [{'car_id': None, 'observed_at': None, 'price_pln': None, 'mileage': None, 'status': None,
+             **observation} for observation in observations]
+    connection.execute(insert(CarObservation), rows)
+
+
+def get_price_changes(days=7, limit=None) -> list:
+    # Price changes observed in the last days, the newest first: (car_id, link, observed_at, previous_price, price_pln)
+    session = Session()
+    try:
+        observation, previous = aliased(CarObservation), aliased(CarObservation)
+        previous_price = (select(previous.price_pln)
+                          .where(previous.car_id == observation.car_id, previous.id < observation.id,
+                                 previous.price_pln.is_not(None))
+                          .order_by(previous.id.desc()).limit(1).scalar_subquery())
+        query = (select(observation.car_id, Car.link, observation.observed_at,
+                        previous_price.label('previous_price'), observation.price_pln)
+                 .join(Car, Car.id == observation.car_id)
+                 .where(observation.observed_at >= now() - timedelta(days=days),
+                        observation.price_pln.is_not(None), previous_price.is_not(None))
+                 .order_by(observation.observed_at.desc()).limit(limit))
+        return session.execute(query).all()
+    except Exception as e:
+        print(f'An error occurred while getting price changes:\n    {e}')
+        return []
+    finally:
+        session.close()
+
+
+def get_price_series(car_id: int) -> list[tuple[datetime | None, int]]:
+    # Prices of the car in the order they were observed, (observed_at, price_pln) pairs
+    session = Session()
+    try:
+        query = (select(CarObservation.observed_at, CarObservation.price_pln)
+                 .where(CarObservation.car_id == car_id, CarObservation.price_pln.is_not(None))
+                 .order_by(CarObservation.id))
+        return [tuple(row) for row in session.execute(query)]
+    except Exception as e:
+        print(f'An error occurred while getting price series of car:\n    {e}')
+        return []
+    finally:
+        session.close()
@@ -0,0 +1,89 @@
+from collections import defaultdict
+from collections.abc import Iterable
+from sqlalchemy import select, tuple_
+from repository.models import MILEAGE_BUCKET, PeerPriceAggregate
+from repository.migrations import rebuild_peer_price_aggregates
+from repository.db_connection import Session, engine, insert
+
+# Columns of the key of the aggregates and of the aggregated prices
+KEY_COLUMNS = ['brand', 'model', 'gearbox', 'year', 'mileage_bucket']
+AGGREGATE_COLUMNS = [*KEY_COLUMNS, 'n_cars', 'price_sum', 'price_sum_squares']
+# Columns of the car its aggregate is computed from
+CAR_COLUMNS = ['brand', 'model', 'gearbox', 'year', 'mileage', 'price_pln']
+
+
+def peer_key(car: dict) -> tuple | None:
+    # Key of the aggregate of the car (brand, model, gearbox, year, mileage and price_pln values), None for the cars
+    # with any of the values missing, they are not aggregated
+    values = [car.get(column) for column in CAR_COLUMNS]
+    if any(value is None for value in values):
+        return None
+    return car['brand'], car['model'], car['gearbox'], car['year'], car['mileage'] // MILEAGE_BUCKET
+
+
+def update_aggregates(added: Iterable[dict] = (), removed: Iterable[dict] = ()) -> None:
+    # Adds the prices of the added cars to their aggregates and subtracts the prices of the removed ones (the previous
+    # values of the changed cars), in its own transaction
+    session = Session()
+    try:
+        write_deltas(session.connection(), added, removed)
+        session.commit()
+    except Exception as e:
+        print(f'An error occurred while updating peer-price aggregates:\n    {e}')
+        session.rollback()
+    finally:
+        session.close()
+
+
+def write_deltas(connection, added: Iterable[dict] = (), removed: Iterable[dict] = ()) -> None:
+    # Changes of the aggregates (see update_aggregates) written in the transaction of the connection, so they are
+    # committed together with the cars they come from. Changes of the same aggregate are summed and written with one
+    # upsert per aggregate
+    deltas = defaultdict(lambda: [0, 0., 0.])
+    for cars, sign in ((added, 1), (removed, -1)):
+        for car in cars:
+            if (key := peer_key(car)) is not None:
+                delta = deltas[key]
+                delta[0] += sign
+                delta[1] += sign * car['price_pln']
+                delta[2] += sign * float(car['price_pln']) ** 2
+    rows = [{**dict(zip(KEY_COLUMNS, key)), 'n_cars': n_cars, 'price_sum': price_sum,
+             'price_sum_squares': price_sum_squares}
+            for key, (n_cars, price_sum, price_sum_squares) in deltas.items() if n_cars or price_sum]
+    if not rows:
+        return
+    statement = insert(PeerPriceAggregate)
+    statement = statement.on_conflict_do_update(index_elements=KEY_COLUMNS, set_={
+        column: getattr(PeerPriceAggregate, column) + statement.excluded[column]
+        for column in ('n_cars', 'price_sum', 'price_sum_squares')
+    })
+    connection.execute(statement, rows)
+
+
+def get_aggregates(brands_models: Iterable[tuple[str, str]], chunk_size=500) -> list:
+    # Aggregates of the (brand, model) pairs, rows of the AGGREGATE_COLUMNS found with the primary key index
+    brands_models = list(set(brands_models))
+    session = Session()
+    try:
+        columns = [getattr(PeerPriceAggregate, column) for column in AGGREGATE_COLUMNS]
+        aggregates = []
+        for i in range(0, len(brands_models), chunk_size):
+            aggregates += session.execute(
+                select(*columns).where(tuple_(PeerPriceAggregate.brand, PeerPriceAggregate.model)
+                                       .in_(brands_models[i:i + chunk_size]), PeerPriceAggregate.n_cars > 0)
+            ).all()
+        return aggregates
+    except Exception as e:
+        print(f'An error occurred while getting peer-price aggregates:\n    {e}')
+        return []
+    finally:
+        session.close()
+
+
+def rebuild_aggregates() -> int:
+    # Bulk rebuild from all the cars, needed after the cars are written outside of car_repository.ingest_cars
+    try:
+        return rebuild_peer_price_aggregates(engine)
+    except Exception as e:
+        print(f'An error occurred while rebuilding peer-price aggregates:\n    {e}')
+        return 0
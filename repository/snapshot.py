@@ -0,0 +1,163 @@
+"""
+file that contains the columnar snapshot of the cars table. Cars are exported to Parquet files partitioned by the
+normalized brand and the year, new cars are appended incrementally (by the id high-water mark) and the analyzers
+load the snapshot with column pruning and predicate pushdown, without reading the scraping database
+"""
+import json
+import os
+import shutil
+import time
+from itertools import islice
+from urllib.parse import unquote
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from car_scraping.utils import filter_mask, normalize
+from repository import car_repository as car_repo
+from repository.models import Car
+
+# Categorical columns (see models.CATEGORICAL_COLUMNS) are dictionary-encoded, so they are loaded as pandas Categorical
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('link', pa.string()),
+    ('brand', CATEGORY),
+    ('model', pa.string()),
+    ('mileage', pa.int32()),
+    ('engine_capacity', pa.int32()),
+    ('engine_power', pa.int32()),
+    ('year', pa.int32()),
+    ('fuel_type', CATEGORY),
+    ('gearbox', CATEGORY),
+    ('body_type', CATEGORY),
+    ('colour', CATEGORY),
+    ('type_of_color', CATEGORY),
+    ('accident_free', CATEGORY),
+    ('state', CATEGORY),
+    ('price_pln', pa.int64()),
+    ('location', pa.string()),
+    ('brand_norm', pa.string()),
+    ('model_norm', pa.string()),
+    ('location_norm', pa.string()),
+    ('city', pa.string()),
+    ('voivodeship', pa.string()),
+])
+
+PARTITIONING = ds.partitioning(pa.schema([('brand_norm', pa.string()), ('year', pa.int32())]), flavor='hive')
+
+# File with the high-water mark of the snapshot (the highest exported car id)
+STATE_FILE = '_snapshot.json'
+
+# Pandas dtypes of the integer columns, nullable like the ones of car_repository.load_cars_frame, so the missing
+# values do not turn the columns to floats
+PANDAS_TYPES = {
+    pa.int32(): 'Int32',
+    pa.int64(): 'Int64',
+}
+
+
+def export_snapshot(directory='.snapshot/cars', full=False, batch_size=50000, print_steps=True) -> int:
+    """
+    Method that appends the cars added since the last export to the Parquet snapshot. Cars are exported in the order
+    of id, so the highest exported id is the high-water mark of the next export
+    :param directory: Directory of the snapshot
+    :param full: If True, the snapshot is removed and exported again from scratch (needed to pick up the updates
+        of the already exported cars)
+    :param batch_size: Number of cars read from the database and written to one file at once
+    :param print_steps: If True, method will print the number of exported cars
+    :return: Number of exported cars
+    """
+    if full and os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+    max_id = _read_state(directory).get('max_id', 0)
+
+    exported = 0
+    rows = car_repo.iter_cars(SCHEMA.names, Car.id > max_id, batch_size)
+    while batch := list(islice(rows, batch_size)):
+        table = pa.Table.from_pylist([row._asdict() for row in batch], schema=SCHEMA)
+        ds.write_dataset(table, directory, format='parquet', partitioning=PARTITIONING,
+                         basename_template=f'part-{batch[0].id}-{{i}}.parquet',
+                         existing_data_behavior='overwrite_or_ignore')
+        # State is written after the data, so the interrupted export only repeats the last batch
+        max_id = batch[-1].id
+        _write_state(directory, {'max_id': max_id, 'exported_at': time.time()})
+        exported += len(batch)
+
+    if print_steps:
+        print(f'Exported {exported} cars to the snapshot {directory} (high-water mark id {max_id})')
+    return exported
+
+
+def load_snapshot(directory='.snapshot/cars', columns: list[str] = None, filters=None):
+    """
+    Method that loads the snapshot to the DataFrame. Only the given columns are read and the filters are pushed down
+    to the partitions and the row groups of the files
+    :param directory: Directory of the snapshot
+    :param columns: Columns to read, if None all the columns are read
+    :param filters: Filters in the pyarrow format, e.g. [('brand_norm', '=', 'bmw'), ('year', '>=', 2010)]
+        or the pyarrow expression
+    :return: DataFrame with the cars
+    """
+    if isinstance(filters, list):
+        filters = pq.filters_to_expression(filters) if filters else None
+    dataset = ds.dataset(directory, schema=SCHEMA, format='parquet', partitioning=PARTITIONING)
+    import pandas as pd
+
+    types = {arrow_type: pd.api.types.pandas_dtype(dtype) for arrow_type, dtype in PANDAS_TYPES.items()}
+    return dataset.to_table(columns=columns, filter=filters).to_pandas(types_mapper=types.get)
+
+
+def load_cars_filtered(directory, brand, model, min_year, max_year, min_mileage, max_mileage,
+                       fuel_type, gearbox, status, location, columns: list[str] = None):
+    """
+    Method that loads the cars matching the filters of car_repository.get_all_cars_filtered from the snapshot.
+    Brand (the partitions of the brands containing it), year and mileage are pushed down to the files, the text
+    filters are applied to the loaded cars
+    :param directory: Directory of the snapshot
+    :param brand: brand of the car
+    :param model: models (parts of them) of the car
+    :param min_year: minimum year of the car
+    :param max_year: maximum year of the car
+    :param min_mileage: minimum mileage of the car (in km)
+    :param max_mileage: maximum mileage of the car (in km)
+    :param fuel_type: fuel types of the car
+    :param gearbox: gearboxes of the car
+    :param status: used or new
+    :param location: locations of the car
+    :param columns: Columns to return, if None all the columns are returned
+    :return: DataFrame with the cars
+    """
+    filters = [('year', '>=', min_year), ('year', '<=', max_year),
+               ('mileage', '>=', min_mileage), ('mileage', '<=', max_mileage)]
+    if brand_norm := normalize(brand):
+        filters.append(('brand_norm', 'in', pa.array(_matching_brands(directory, brand_norm), pa.string())))
+    filter_columns = ['brand_norm', 'model_norm', 'year', 'mileage', 'fuel_type', 'gearbox', 'state', 'city',
+                      'voivodeship']
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, *filter_columns]))
+    cars_df = load_snapshot(directory, read_columns, filters)
+    cars_df = cars_df[filter_mask(cars_df, brand, model, min_year, max_year, min_mileage, max_mileage,
+                                  fuel_type, gearbox, status, location)].reset_index(drop=True)
+    return cars_df[columns] if columns is not None else cars_df
+
+
+def _matching_brands(directory: str, brand_norm: str) -> list[str]:
+    # Brands of the partitions (brand_norm=<brand> directories) containing the normalized brand
+    brands = [unquote(name.partition('=')[2]) for name in os.listdir(directory) if name.startswith('brand_norm=')]
+    return [brand for brand in brands if brand_norm in brand]
+
+
+def _read_state(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_state(directory: str, state: dict) -> None:
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(path + '.tmp', path)
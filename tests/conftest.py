@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+# Tests use their own SQLite database, the engine of repository.db_connection is created with it when it is imported
+os.environ['CAR_SCRAPING_DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'car-scraping.db')
+
+import pytest
+from sqlalchemy import delete
+from car_scraping.car import Car as ScrapedCar
+from repository.db_connection import engine, init_db
+from repository.models import Car, CarObservation, PeerPriceAggregate
+
+
+def make_car(link: str, **values) -> ScrapedCar:
+    car = {'brand': 'BMW', 'model': 'Seria 3', 'mileage': 150000, 'engine_capacity': 1995, 'engine_power': 150,
+           'year': 2015, 'fuel_type': 'Diesel', 'gearbox': 'Manualna', 'body_type': 'Kombi', 'colour': 'Czarny',
+           'type_of_color': 'Metalik', 'accident_free': 'Tak', 'state': 'Używany', 'price_pln': 50000,
+           'location': 'Kraków, Małopolskie', **values}
+    return ScrapedCar(link=link, **car)
+
+
+@pytest.fixture
+def db():
+    init_db()
+    yield
+    with engine.begin() as connection:
+        for model in (CarObservation, PeerPriceAggregate, Car):
+            connection.execute(delete(model))
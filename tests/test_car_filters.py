@@ -0,0 +1,55 @@
+import pandas as pd
+from car_scraping.utils import filter_mask
+from repository import car_repository as car_repo
+from tests.conftest import make_car
+
+
+def add_cars() -> None:
+    car_repo.ingest_cars([
+        make_car('https://example.com/1', brand='BMW', model='Seria 3'),
+        make_car('https://example.com/2', brand='BMW', model='320'),
+        make_car('https://example.com/3', brand='Mercedes-Benz', model='Klasa C'),
+        make_car('https://example.com/4', brand='Audi', model='A4'),
+    ])
+
+
+def filtered_links(brand, model) -> set[str]:
+    cars = car_repo.get_all_cars_filtered(brand, model, 1885, 2050, 0, 1000000, [''], [''], '', [''])
+    return {car.link for car in cars}
+
+
+def test_existing_brand_and_model_prefix_are_matched(db):
+    add_cars()
+    assert filtered_links('bmw', ['']) == {'https://example.com/1', 'https://example.com/2'}
+    assert filtered_links('BMW', ['seria']) == {'https://example.com/1'}
+
+
+def test_part_of_brand_and_model_is_matched(db):
+    add_cars()
+    assert filtered_links('mercedes', ['']) == {'https://example.com/3'}
+    assert filtered_links('bmw', ['3']) == {'https://example.com/1', 'https://example.com/2'}
+    assert filtered_links('', ['klasa c', 'a4']) == {'https://example.com/3', 'https://example.com/4'}
+    assert filtered_links('opel', ['']) == set()
+
+
+def test_filter_mask_matches_the_database_filters():
+    cars_df = pd.DataFrame({'brand_norm': ['bmw', 'bmw', 'mercedes-benz', 'audi'],
+                            'model_norm': ['seria 3', '320', 'klasa c', 'a4'], 'year': 2015, 'mileage': 150000,
+                            'fuel_type': 'Diesel', 'gearbox': 'Manualna', 'state': 'Używany', 'city': 'krakow',
+                            'voivodeship': 'malopolskie'})
+
+    def mask(brand, model):
+        return filter_mask(cars_df, brand, model, 1885, 2050, 0, 1000000, [''], [''], '', ['']).tolist()
+
+    assert mask('bmw', ['seria']) == [True, False, False, False]
+    assert mask('mercedes', ['']) == [False, False, True, False]
+    assert mask('bmw', ['3']) == [True, True, False, False]
+
+
+def test_filtered_frame_has_all_columns_by_default(db):
+    add_cars()
+    cars_df = car_repo.load_cars_filtered('bmw', [''], 1885, 2050, 0, 1000000, [''], [''], '', [''])
+    assert list(cars_df.columns) == car_repo.FRAME_COLUMNS
+    assert len(cars_df) == 2
+    assert set(cars_df['brand']) == {'BMW'}
+    assert set(cars_df['model']) == {'Seria 3', '320'}
@@ -0,0 +1,12 @@
+import pytest
+from sqlalchemy import text
+from repository import car_repository as car_repo
+from tests.conftest import make_car
+
+
+def test_failed_stream_of_cars_is_raised(db):
+    car_repo.ingest_cars([make_car(f'https://example.com/{i}') for i in range(5)])
+    assert [row.link for row in car_repo.iter_cars(['link'], batch_size=2)] == \
+        [f'https://example.com/{i}' for i in range(5)]
+    with pytest.raises(Exception):
+        list(car_repo.iter_cars(['link'], text('no_such_column = 1'), batch_size=2))
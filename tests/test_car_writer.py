@@ -0,0 +1,30 @@
+import time
+from repository import car_repository as car_repo
+from repository.car_writer import CarWriter
+from tests.conftest import make_car
+
+
+def test_cars_arriving_steadily_are_written_within_flush_interval(db):
+    with CarWriter(flush_interval=0.3) as writer:
+        for i in range(10):
+            writer.add(make_car(f'https://example.com/{i}'))
+            time.sleep(0.1)
+        # The buffer never idles for flush_interval, the cars are written by the age of the oldest one
+        assert car_repo.count_cars() >= 6
+
+
+def test_failed_chunk_is_not_confirmed(db, monkeypatch):
+    def fail(*args):
+        raise RuntimeError('database is locked')
+
+    confirmed = []
+    with CarWriter() as writer:
+        monkeypatch.setattr(car_repo, 'ingest_cars', fail)
+        writer.add(make_car('https://example.com/1'), on_written=lambda: confirmed.append(1))
+        writer.flush()
+        monkeypatch.undo()
+        # The writer thread survives the failed chunk
+        writer.add(make_car('https://example.com/2'), on_written=lambda: confirmed.append(2))
+        writer.flush()
+    assert confirmed == [2]
+    assert car_repo.count_cars() == 1
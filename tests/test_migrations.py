@@ -0,0 +1,73 @@
+import os
+import pytest
+import tempfile
+from sqlalchemy import inspect, select, text
+from sqlalchemy.orm import Session
+from repository import car_repository as car_repo
+from repository import category_repository as category_repo
+from repository.db_connection import create_db_engine
+from repository.migrations import LEGACY_CAR_COLUMNS, migrate
+from repository.models import Base, Car
+from tests.conftest import make_car
+
+# Cars table as it was created before the lookup columns were added, with the categorical values stored as the text
+LEGACY_CARS_TABLE = '''
+CREATE TABLE cars (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, link VARCHAR UNIQUE, brand VARCHAR, model VARCHAR, mileage INTEGER,
+    engine_capacity INTEGER, engine_power INTEGER, year INTEGER, fuel_type VARCHAR, gearbox VARCHAR,
+    body_type VARCHAR, colour VARCHAR, type_of_color VARCHAR, accident_free VARCHAR, state VARCHAR,
+    price_pln INTEGER, location VARCHAR
+)
+'''
+
+
+def test_legacy_text_columns_are_replaced_by_ids():
+    engine = create_db_engine('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'legacy.db'))
+    with engine.begin() as connection:
+        connection.execute(text(LEGACY_CARS_TABLE))
+        connection.execute(text(
+            "INSERT INTO cars (link, brand, model, mileage, year, fuel_type, gearbox, body_type, state, price_pln, "
+            "location) VALUES ('https://example.com/1', 'Škoda', 'Octavia', 120000, 2016, 'Diesel', 'Manualna', "
+            "'Kombi', 'Używany', 40000, 'Łódź, Łódzkie'), ('https://example.com/2', 'BMW', 'X5', 90000, 2019, "
+            "'Benzyna', 'Automatyczna', 'SUV', 'Używany', 150000, NULL)"))
+    Base.metadata.create_all(engine)
+    migrate(engine)
+
+    columns = {column['name'] for column in inspect(engine).get_columns('cars')}
+    assert not columns & set(LEGACY_CAR_COLUMNS)
+    with Session(engine) as session:
+        cars = session.scalars(select(Car).order_by(Car.id)).all()
+        assert [(car.brand, car.fuel_type, car.gearbox, car.body_type, car.state, car.colour) for car in cars] == [
+            ('Škoda', 'Diesel', 'Manualna', 'Kombi', 'Używany', None),
+            ('BMW', 'Benzyna', 'Automatyczna', 'SUV', 'Używany', None),
+        ]
+        assert [(car.brand_norm, car.city) for car in cars] == [('skoda', 'lodz'), ('bmw', None)]
+    with engine.connect() as connection:
+        assert connection.scalar(text("SELECT rowid FROM cars_fts WHERE cars_fts MATCH '\"kombi\"*'")) == 1
+
+    # Migrating the migrated database does nothing
+    migrate(engine)
+    engine.dispose()
+
+
+def test_categorical_values_are_written_by_ids(db):
+    car_repo.ingest_cars([make_car('https://example.com/1', gearbox='Automatyczna')])
+    car = car_repo.get_car_by_link('https://example.com/1')
+    assert (car.brand, car.gearbox, car.body_type) == ('BMW', 'Automatyczna', 'Kombi')
+    assert car.gearbox_id is not None
+
+    car.gearbox = 'Manualna'
+    car_repo.update_car(car)
+    assert car_repo.get_car_by_link('https://example.com/1').gearbox == 'Manualna'
+    assert car_repo.search_car_ids('bmw kombi') == [car.id]
+
+
+def test_car_is_not_written_without_the_id_of_its_value(db, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(category_repo, 'insert', fail)
+    with pytest.raises(RuntimeError):
+        car_repo.ingest_cars([make_car('https://example.com/1', brand='Dacia')])
+    monkeypatch.undo()
+    assert car_repo.count_cars() == 0
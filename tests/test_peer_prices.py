@@ -0,0 +1,60 @@
+from dataclasses import asdict
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import select
+from repository import car_repository as car_repo
+from repository import peer_price_repository as peer_price_repo
+from car_scraping.peer_prices import aggregate_peer_stats, peer_price_stats
+from repository.db_connection import engine
+from repository.models import PeerPriceAggregate
+from tests.conftest import make_car
+
+
+def aggregates() -> set[tuple]:
+    columns = [getattr(PeerPriceAggregate, column) for column in peer_price_repo.AGGREGATE_COLUMNS]
+    with engine.connect() as connection:
+        return {tuple(row) for row in connection.execute(select(*columns).where(PeerPriceAggregate.n_cars > 0))}
+
+
+def test_updated_cars_move_their_aggregates(db):
+    car_repo.ingest_cars([make_car('https://example.com/1', price_pln=40000),
+                          make_car('https://example.com/2', price_pln=60000),
+                          make_car('https://example.com/3', brand='Audi', model='A4')])
+    first, second = (car_repo.get_car_by_link(f'https://example.com/{i}') for i in (1, 2))
+
+    car_repo.update_cars([(first.id, {'gearbox': 'Automatyczna', 'price_pln': 45000}),
+                          (second.id, {'colour': 'Biały'})])
+    second.mileage, second.price_pln = 95000, 2 ** 20
+    car_repo.update_car(second)
+
+    updated = aggregates()
+    assert peer_price_repo.rebuild_aggregates() == 3
+    assert updated == aggregates()
+    assert ('BMW', 'Seria 3', 'Manualna', 2015, 9, 1, 2. ** 20, 2. ** 40) in updated
+
+
+def test_failed_ingest_writes_nothing(db, monkeypatch):
+    def fail(*args):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(peer_price_repo, 'write_deltas', fail)
+    with pytest.raises(RuntimeError):
+        car_repo.ingest_cars([make_car('https://example.com/1')])
+    assert car_repo.count_cars() == 0
+
+
+def test_deal_score_is_the_same_from_the_cars_and_the_aggregates(db):
+    cars = [make_car(f'https://example.com/{i}', price_pln=price)
+            for i, price in enumerate([30000, 40000, 50000, 60000])]
+    car_repo.ingest_cars(cars)
+    cars_df = pd.DataFrame([asdict(car) for car in cars])
+
+    stats = peer_price_stats(cars_df)
+    prices = cars_df['price_pln'].to_numpy(dtype=np.float64)
+    assert stats['peer_count'].tolist() == [4] * 4
+    assert np.allclose(stats['deal_score'], (prices.mean() - prices) / prices.std())
+    assert stats['deal_score'].iloc[0] > 0
+
+    aggregates = peer_price_repo.get_aggregates([('BMW', 'Seria 3')])
+    assert np.allclose(aggregate_peer_stats(cars_df, aggregates), stats)
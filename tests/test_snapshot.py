@@ -0,0 +1,16 @@
+import tempfile
+from repository import car_repository as car_repo
+from repository.snapshot import export_snapshot, load_snapshot
+from tests.conftest import make_car
+
+
+def test_snapshot_keeps_integer_columns_with_missing_values(db):
+    car_repo.ingest_cars([make_car('https://example.com/1', price_pln=160226),
+                          make_car('https://example.com/2', engine_power=None)])
+    directory = tempfile.mkdtemp()
+    export_snapshot(directory, print_steps=False)
+    cars_df = load_snapshot(directory, ['link', 'engine_power', 'price_pln']).sort_values('link')
+    assert str(cars_df['engine_power'].dtype) == 'Int32'
+    assert cars_df['engine_power'].isna().tolist() == [False, True]
+    assert cars_df['price_pln'].tolist() == [160226, 50000]
+    assert isinstance(cars_df['price_pln'].iloc[0].item(), int)